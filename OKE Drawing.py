@@ -1,7 +1,11 @@
 import streamlit as st
 import pdfplumber
+from pdfplumber.page import Page as PdfplumberPage
+from pdfplumber.utils.exceptions import PdfminerException
+from pdfminer.pdfpage import PDFPage
 import pandas as pd
 import re
+import sys
 import numpy as np
 from collections import Counter
 import math
@@ -9,6 +13,116 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
 from sklearn.metrics.pairwise import euclidean_distances
 import io
+import os
+import json
+import time
+import sqlite3
+import heapq
+import bisect
+import weakref
+import signal
+import collections
+import itertools
+import hashlib
+import pickle
+import tempfile
+import uuid
+import datetime
+import glob
+import queue
+import tarfile
+import zipfile
+import argparse
+import threading
+import contextlib
+import multiprocessing
+import concurrent.futures
+from dataclasses import dataclass, field, fields
+from typing import NamedTuple
+
+# =============================================================================
+# CẤU HÌNH NGƯỠNG - TẤT CẢ "SỐ MA THUẬT" CỦA PIPELINE Ở 1 CHỖ
+# =============================================================================
+
+@dataclass(frozen=True, slots=True)
+class ExtractionSettings:
+    """
+    *** MỚI: Các ngưỡng của pipeline trích xuất - bất biến, kiểm tra 1 lần khi tạo ***
+    Vòng lặp nóng gán giá trị cần dùng vào biến cục bộ trước khi lặp.
+    """
+    excluded_font_size: float = 20.6        # Ký tự/số có size này không phải kích thước → bỏ qua
+    char_distance: float = 30.0             # Khoảng cách tối đa giữa 2 ký tự của cùng 1 số
+    mixed_font_char_distance: float = 20.0  # Như trên khi 2 ký tự khác font (bảng phụ)
+    vertical_alignment: float = 10.0        # Số dọc: lệch X tối đa so với tâm nhóm ký tự
+    horizontal_alignment: float = 8.0       # Số ngang: lệch Y tối đa so với tâm nhóm ký tự
+    orientation_ratio: float = 1.5          # Span Y > span X × ratio → số dọc
+    height_tolerance: float = 0.2           # Chênh lệch Char_Height tối đa khi phân nhóm
+    grain_search_distance: float = 200.0    # Phạm vi tìm chữ GRAIN quanh số (px)
+    grain_axis_tolerance: float = 20.0      # Lệch tối đa khỏi trục khi tìm GRAIN theo trục (px)
+    min_decimal_value: float = 0.1          # Số thập phân nhỏ nhất
+    max_dimension: float = 3500.0           # Kích thước lớn nhất
+    # Trọng số SCORE của nhóm
+    score_three_numbers: int = 30           # Nhóm có đúng 3 số
+    score_five_numbers: int = 10            # Nhóm có đúng 5 số
+    score_uniform_spacing: int = 10         # Char_Spacing các số chênh lệch < spacing_tolerance
+    spacing_tolerance: float = 0.2
+    score_hv_mix: int = 20                  # Has_HV_Mix
+
+    def __post_init__(self):
+        for settings_field in fields(self):
+            value = getattr(self, settings_field.name)
+            if settings_field.type is int:
+                if not isinstance(value, int) or isinstance(value, bool):
+                    raise ValueError(f"{settings_field.name} must be an integer, got {value!r}")
+            elif not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+                raise ValueError(f"{settings_field.name} must be a number, got {value!r}")
+            elif value < 0 or (value == 0 and settings_field.name != 'excluded_font_size'):
+                raise ValueError(f"{settings_field.name} must be positive, got {value!r}")
+
+        if self.orientation_ratio < 1:
+            raise ValueError(f"orientation_ratio must be at least 1, got {self.orientation_ratio!r}")
+        if self.min_decimal_value > self.max_dimension:
+            raise ValueError("min_decimal_value must not exceed max_dimension")
+
+    @classmethod
+    def from_dict(cls, values):
+        """Tạo settings từ dict (ví dụ JSON); ngưỡng không khai báo giữ giá trị mặc định"""
+        unknown = set(values) - {settings_field.name for settings_field in fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        return cls(**values)
+
+    def fingerprint(self):
+        """Chuỗi ngắn đại diện cho bộ ngưỡng (dùng trong khóa nhật ký/cache)"""
+        return hashlib.sha256(repr(self).encode('utf-8')).hexdigest()[:16]
+
+DEFAULT_SETTINGS = ExtractionSettings()
+SETTINGS_FILE = os.environ.get('OKE_DRAWING_SETTINGS')  # File JSON các profile theo mẫu bản vẽ
+
+def load_settings_profiles(path=None):
+    """
+    Đọc các profile ngưỡng theo mẫu bản vẽ từ file JSON: {"tên profile": {"ngưỡng": giá trị, ...}}
+
+    Returns:
+        dict: {tên profile: ExtractionSettings}, luôn có "default"
+    """
+    profiles = {"default": DEFAULT_SETTINGS}
+    if not path:
+        return profiles
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected an object of settings profiles")
+
+    for name, values in data.items():
+        if not isinstance(values, dict):
+            raise ValueError(f"{path}: profile '{name}' must be an object")
+        try:
+            profiles[name] = ExtractionSettings.from_dict(values)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"{path}: profile '{name}': {e}") from e
+    return profiles
 
 # =============================================================================
 # ENHANCED NUMBER EXTRACTION - XOAY SỐ TRƯỚC KHI TÍNH METRICS
@@ -38,26 +152,67 @@ def is_number_in_filename(number, filename):
         True
     """
     try:
-        # Chuyển số thành chuỗi
-        number_str = str(int(number)) if isinstance(number, (int, float)) and number == int(number) else str(number)
-        
-        # Loại bỏ extension và chuyển thành chữ hoa để so sánh
-        base_name = filename.upper()
-        if base_name.endswith('.PDF'):
-            base_name = base_name[:-4]
-        
-        # Kiểm tra số có trong tên file không
-        return number_str in base_name
+        return is_number_excluded(number, build_filename_exclusion(filename))
     
     except Exception as e:
         # Nếu có lỗi, mặc định không lọc
         return False
 
+def build_filename_exclusion(filename):
+    """
+    *** MỚI: Chuẩn hoá tên file 1 lần cho mỗi file ***
+    Lưu tập tất cả chuỗi con chỉ gồm chữ số (dài tối đa 5) trong tên file (bỏ đường dẫn
+    và .PDF) dưới dạng số nguyên → kiểm tra 1 số có trong tên file chỉ là 1 phép tra set.
+
+    Returns:
+        dict: {'base_name': str, 'digit_values': frozenset}
+
+    Examples:
+        >>> 921 in build_filename_exclusion("4009214.pdf")['digit_values']
+        True
+    """
+    # Bỏ đường dẫn (thành viên trong file nén), loại bỏ extension và chuyển thành chữ hoa
+    base_name = str(filename).replace('\\', '/').rsplit('/', 1)[-1].upper()
+    if base_name.endswith('.PDF'):
+        base_name = base_name[:-4]
+
+    # Chuỗi con có số 0 ở đầu ("0921") đổi thành số vẫn là chuỗi con hợp lệ ("921")
+    digit_values = set()
+    for run in re.findall(r'\d+', base_name):
+        for start in range(len(run)):
+            for end in range(start + 1, min(start + 5, len(run)) + 1):
+                digit_values.add(int(run[start:end]))
+
+    return {
+        'base_name': base_name,
+        'digit_values': frozenset(digit_values)
+    }
+
+def is_number_excluded(number, filename_exclusion):
+    """Kiểm tra số có trong tên file dựa trên bảng đã chuẩn hoá (build_filename_exclusion)"""
+    # *** MỚI: Ghi lại các số đã kiểm tra → biết tên file khác có cho cùng kết quả lọc không (DrawingIndex) ***
+    checked_numbers = filename_exclusion.get('checked_numbers')
+    if checked_numbers is not None:
+        checked_numbers.add(number)
+    try:
+        # Số nguyên (kể cả 12.0) tối đa 5 chữ số → tra set
+        if number == int(number) and 0 <= number < 100000:
+            return number in filename_exclusion['digit_values']
+
+        number_str = str(int(number)) if isinstance(number, (int, float)) and number == int(number) else str(number)
+        return number_str in filename_exclusion['base_name']
+
+    except Exception as e:
+        # Nếu có lỗi, mặc định không lọc
+        return False
+
 def get_font_weight(char):
     """Trích xuất độ đậm từ thông tin font của ký tự"""
-    try:
-        fontname = char.get('fontname', '')
+    return classify_font_weight(char.get('fontname', ''))
 
+def classify_font_weight(fontname):
+    """Phân loại độ đậm theo tên font"""
+    try:
         # Kiểm tra các từ khóa phổ biến cho độ đậm
         fontname_lower = fontname.lower()
 
@@ -73,7 +228,66 @@ def get_font_weight(char):
     except Exception:
         return 'Unknown'
 
-def calculate_advanced_metrics_with_rotation(group, number, x_pos, y_pos, orientation):
+# =============================================================================
+# FONT REGISTRY - PHÂN LOẠI FONT 1 LẦN CHO MỖI TÀI LIỆU
+# =============================================================================
+
+def register_font(font_registry, fontname):
+    """Thêm 1 font vào bảng phân loại (intern tên font, tính sẵn weight/priority/F2/F3)"""
+    fontname = sys.intern(fontname) if isinstance(fontname, str) else fontname
+    priority = get_font_priority(fontname) if isinstance(fontname, str) else 0
+    entry = {
+        'weight': classify_font_weight(fontname),
+        'priority': priority,
+        'is_f3': priority == 4,
+        'is_f2': priority == 3
+    }
+    font_registry[fontname] = entry
+    return entry
+
+def build_font_registry(chars):
+    """
+    *** MỚI: Bảng phân loại font cho tài liệu ***
+    Mỗi tài liệu chỉ có vài font khác nhau → phân loại 1 lần cho mỗi font,
+    các bước sau chỉ cần tra dict thay vì lower() + tìm chuỗi trên từng ký tự.
+
+    Returns:
+        dict: {fontname: {'weight', 'priority', 'is_f3', 'is_f2'}}
+    """
+    font_registry = {}
+    for c in chars:
+        fontname = c.get('fontname', 'Unknown')
+        if fontname not in font_registry:
+            register_font(font_registry, fontname)
+    return font_registry
+
+def lookup_font(font_registry, fontname):
+    """Tra thông tin font trong bảng, tự đăng ký nếu chưa có"""
+    entry = font_registry.get(fontname)
+    if entry is None:
+        entry = register_font(font_registry, fontname)
+    return entry
+
+def most_common_font_and_weight(group, font_registry):
+    """Font và độ đậm phổ biến nhất trong nhóm - 1 lần duyệt, tra bảng font"""
+    if not group:
+        return "Unknown", "Unknown"
+
+    font_counts = {}
+    weight_counts = {}
+    for ch in group:
+        fontname = ch.get("fontname", "Unknown")
+        font_counts[fontname] = font_counts.get(fontname, 0) + 1
+        # get_font_weight mặc định fontname = '' khi thiếu
+        weight = lookup_font(font_registry, ch.get('fontname', ''))['weight']
+        weight_counts[weight] = weight_counts.get(weight, 0) + 1
+
+    # max() giữ phần tử đầu tiên khi bằng nhau - giống Counter.most_common(1)
+    fontname = max(font_counts.items(), key=lambda x: x[1])[0]
+    common_weight = max(weight_counts.items(), key=lambda x: x[1])[0]
+    return fontname, common_weight
+
+def calculate_advanced_metrics_with_rotation(group, number, x_pos, y_pos, orientation, settings=DEFAULT_SETTINGS):
     """Tính toán 8 chỉ số khác biệt - XOAY SỐ TRƯỚC KHI TÍNH Font_Size, Char_Width, Char_Height - CHỈ TÍNH SỐ"""
     try:
         metrics = {}
@@ -90,8 +304,8 @@ def calculate_advanced_metrics_with_rotation(group, number, x_pos, y_pos, orient
         else:
             metrics['font_size'] = 0.0
 
-        # *** THÊM KIỂM TRA LOẠI BỎ FONT_SIZE = 20.6 ***
-        if metrics['font_size'] == 20.6:
+        # *** THÊM KIỂM TRA LOẠI BỎ FONT_SIZE = 20.6 (settings.excluded_font_size) ***
+        if metrics['font_size'] == settings.excluded_font_size:
             return None
 
         # 2 & 3. Character Width và Height - CHỈ TÍNH CHO KÝ TỰ SỐ - XOAY NẾU LÀ SỐ DỌC
@@ -216,21 +430,21 @@ def calculate_advanced_metrics_with_rotation(group, number, x_pos, y_pos, orient
             'text_angle': 0.0
         }
 
-def calculate_score_for_group(group_data):
+def calculate_score_for_group(group_data, settings=DEFAULT_SETTINGS):
     """
-    Tính SCORE cho nhóm theo các tiêu chí:
-    - Group có từ 3 đến 5 number thì +10đ
+    Tính SCORE cho nhóm theo các tiêu chí (trọng số trong ExtractionSettings):
+    - Group có 3 number thì +30đ, có 5 number thì +10đ
     - Char_Spacing tất cả number trong group chênh lệch nhau <0.2 thì +10đ
-    - Has_HV_Mix = true thì +10đ
+    - Has_HV_Mix = true thì +20đ
     """
     score = 0
 
     # Tiêu chí 1: Group có từ 3 đến 5 number thì +10đ
     group_size = len(group_data)
     if group_size == 3:
-        score += 30
+        score += settings.score_three_numbers
     elif group_size == 5:
-       score += 10
+       score += settings.score_five_numbers
 
     # Tiêu chí 2: Char_Spacing tất cả number trong group chênh lệch nhau <0.2 thì +10đ
     char_spacings = group_data['Char_Spacing'].tolist()
@@ -239,16 +453,59 @@ def calculate_score_for_group(group_data):
         min_spacing = min(char_spacings)
         spacing_diff = max_spacing - min_spacing
 
-        if spacing_diff < 0.2:
-            score += 10
+        if spacing_diff < settings.spacing_tolerance:
+            score += settings.score_uniform_spacing
 
     # Tiêu chí 3: Has_HV_Mix = true thì +10đ
     has_hv_mix = group_data['Has_HV_Mix'].iloc[0] if len(group_data) > 0 else False
     if has_hv_mix:
-        score += 20
+        score += settings.score_hv_mix
 
     return score
 
+# =============================================================================
+# PAGE GLYPH INDEX - CHỈ GIỮ KÝ TỰ CẦN CHO TÌM GRAIN, KHÔNG GIỮ PAGE OBJECT
+# =============================================================================
+
+GRAIN_LETTERS = frozenset(['G', 'R', 'A', 'I', 'N'])
+
+@dataclass(frozen=True, slots=True)
+class PageGlyphIndex:
+    """
+    *** MỚI: Chỉ mục ký tự của 1 trang cho bước tìm GRAIN ***
+    Chỉ gồm dữ liệu thuần (bool + tuple) → page/PDF có thể đóng ngay sau khi trích xuất
+    và kết quả có thể chuyển qua process khác.
+    """
+    has_grain: bool
+    letters: tuple = ()  # (ký tự in hoa G/R/A/I/N, x0, top) theo thứ tự trong page.chars
+
+def build_page_glyph_index(page, page_text=None):
+    """Tạo PageGlyphIndex từ page (page_text: text đã trích xuất sẵn, nếu có)"""
+    if page_text is None:
+        has_grain = check_grain_exists_in_page(page)
+    else:
+        text_upper = page_text.upper()
+        has_grain = 'GRAIN' in text_upper or 'NIARG' in text_upper
+
+    letters = []
+    try:
+        for char in page.chars:
+            char_text = char.get('text', '')
+            if char_text.isalpha():
+                char_upper = char_text.upper()
+                if char_upper in GRAIN_LETTERS:
+                    letters.append((char_upper, char.get('x0', 0), char.get('top', 0)))
+    except Exception as e:
+        letters = []
+
+    return PageGlyphIndex(has_grain=has_grain, letters=tuple(letters))
+
+def as_glyph_index(page_or_index):
+    """Chấp nhận cả page object (tương thích cũ) lẫn PageGlyphIndex"""
+    if isinstance(page_or_index, PageGlyphIndex):
+        return page_or_index
+    return build_page_glyph_index(page_or_index)
+
 def check_grain_exists_in_page(page):
     """
     *** MỚI: Kiểm tra xem trang có chứa chữ GRAIN/NIARG không ***
@@ -277,7 +534,7 @@ def extract_lines_from_pdf(pdf_path):
                     lines.append((page_num, line_num, line.strip()))
     return lines
 
-def extract_laminate_classification_with_detail(page):
+def extract_laminate_classification_with_detail(page, page_text=None):
     """
     *** CẬP NHẬT: Logic mới - Lấy cặp keyword đầu tiên theo thứ tự xuất hiện từ trên xuống ***
     *** CẬP NHẬT THÊM: Nếu chỉ tìm thấy 1 keyword thì để trống ***
@@ -295,7 +552,8 @@ def extract_laminate_classification_with_detail(page):
 
         # Trích text ra từng dòng
         lines = []
-        page_text = page.extract_text()
+        if page_text is None:
+            page_text = page.extract_text()
         if page_text:
             for line_num, line in enumerate(page_text.split("\n"), start=1):
                 lines.append((line_num, line.strip()))
@@ -404,13 +662,18 @@ def find_keyword_positions(text_chars, keyword):
     except Exception as e:
         return positions
 
-def search_grain_text_for_group_by_priority(page, group_data, search_distance=200):
+def search_grain_text_for_group_by_priority(glyph_index, group_data, search_distance=DEFAULT_SETTINGS.grain_search_distance,
+                                            axis_tolerance=DEFAULT_SETTINGS.grain_axis_tolerance,
+                                            orientation_ratio=DEFAULT_SETTINGS.orientation_ratio):
     """
     *** UPDATED: Kiểm tra GRAIN trước, nếu có thì mới tìm theo trục và hình vuông ***
+    *** CẬP NHẬT: Tìm trên PageGlyphIndex thay vì page object ***
     """
     try:
+        glyph_index = as_glyph_index(glyph_index)
+
         # BƯỚC 1: Kiểm tra có GRAIN trong trang không
-        if not check_grain_exists_in_page(page):
+        if not glyph_index.has_grain:
             return None, ""
 
         # BƯỚC 2: Nếu có GRAIN, tiến hành tìm kiếm như cũ
@@ -424,13 +687,14 @@ def search_grain_text_for_group_by_priority(page, group_data, search_distance=20
             num_orientation = row['Orientation']
 
             # Thử tìm theo trục trước
-            grain_result = search_grain_along_axis(page, num_x, num_y, num_orientation, search_distance)
+            grain_result = search_grain_along_axis(glyph_index, num_x, num_y, num_orientation, search_distance, axis_tolerance,
+                                                   orientation_ratio)
 
             if grain_result:
                 return idx, grain_result
             else:
                 # Nếu không tìm thấy theo trục, tìm trong hình vuông 200px
-                grain_result = search_grain_in_square_area(page, num_x, num_y, search_distance)
+                grain_result = search_grain_in_square_area(glyph_index, num_x, num_y, search_distance, orientation_ratio)
 
                 if grain_result:
                     return idx, grain_result
@@ -440,14 +704,16 @@ def search_grain_text_for_group_by_priority(page, group_data, search_distance=20
     except Exception as e:
         return None, ""
 
-def search_grain_along_axis(page, num_x, num_y, num_orientation, search_distance=200):
+def search_grain_along_axis(glyph_index, num_x, num_y, num_orientation, search_distance=DEFAULT_SETTINGS.grain_search_distance,
+                            axis_tolerance=DEFAULT_SETTINGS.grain_axis_tolerance,
+                            orientation_ratio=DEFAULT_SETTINGS.orientation_ratio):
     """
     Tìm GRAIN/NIARG theo trục (vuông góc với orientation của number)
     TRẢ VỀ ORIENTATION: "Horizontal" cho GRAIN, "Vertical" cho NIARG
     """
     try:
-        chars = page.chars
-        if not chars:
+        letters = as_glyph_index(glyph_index).letters
+        if not letters:
             return ""
 
         # Xác định hướng trục GRAIN (vuông góc với number)
@@ -461,45 +727,37 @@ def search_grain_along_axis(page, num_x, num_y, num_orientation, search_distance
             # Single → thử cả 2 trục
             search_axis = 'both'
 
-        # Lấy tất cả ký tự text từ page
-        text_chars = [c for c in chars if c.get('text', '').isalpha()]
-
-        # Tìm ký tự trong vùng trục GRAIN
+        # Tìm ký tự trong vùng trục GRAIN (chỉ mục chỉ chứa chữ G/R/A/I/N)
         candidate_chars = []
 
-        for char in text_chars:
-            char_x = char.get('x0', 0)
-            char_y = char.get('top', 0)
-            char_text = char.get('text', '').upper()
-
+        for char_text, char_x, char_y in letters:
             # Kiểm tra ký tự có nằm trên trục không
             on_axis = False
 
             if search_axis == 'horizontal':
                 # Trục ngang: cùng Y, khác X
-                if (abs(char_y - num_y) <= 20 and  # Cùng hàng Y (±20px)
+                if (abs(char_y - num_y) <= axis_tolerance and  # Cùng hàng Y (±20px)
                     abs(char_x - num_x) <= search_distance):  # Trong phạm vi tìm kiếm X
                     on_axis = True
 
             elif search_axis == 'vertical':
                 # Trục dọc: cùng X, khác Y
-                if (abs(char_x - num_x) <= 20 and  # Cùng cột X (±20px)
+                if (abs(char_x - num_x) <= axis_tolerance and  # Cùng cột X (±20px)
                     abs(char_y - num_y) <= search_distance):  # Trong phạm vi tìm kiếm Y
                     on_axis = True
 
             elif search_axis == 'both':
                 # Thử cả 2 trục cho Single
-                if ((abs(char_y - num_y) <= 20 and abs(char_x - num_x) <= search_distance) or
-                    (abs(char_x - num_x) <= 20 and abs(char_y - num_y) <= search_distance)):
+                if ((abs(char_y - num_y) <= axis_tolerance and abs(char_x - num_x) <= search_distance) or
+                    (abs(char_x - num_x) <= axis_tolerance and abs(char_y - num_y) <= search_distance)):
                     on_axis = True
 
-            if on_axis and char_text in ['G', 'R', 'A', 'I', 'N']:
+            if on_axis:
                 candidate_chars.append({
                     'char': char_text,
                     'x': char_x,
                     'y': char_y,
-                    'distance': math.sqrt((char_x - num_x)**2 + (char_y - num_y)**2),
-                    'original_char': char
+                    'distance': math.sqrt((char_x - num_x)**2 + (char_y - num_y)**2)
                 })
 
         # Sắp xếp theo khoảng cách gần nhất
@@ -507,7 +765,7 @@ def search_grain_along_axis(page, num_x, num_y, num_orientation, search_distance
 
         # Thử ghép thành chữ GRAIN hoặc NIARG
         if len(candidate_chars) >= 5:
-            grain_sequence_info = find_grain_sequence_with_direction(candidate_chars)
+            grain_sequence_info = find_grain_sequence_with_direction(candidate_chars, orientation_ratio)
 
             if grain_sequence_info:
                 sequence_type = grain_sequence_info['type']  # 'GRAIN' hoặc 'NIARG'
@@ -528,38 +786,30 @@ def search_grain_along_axis(page, num_x, num_y, num_orientation, search_distance
     except Exception as e:
         return ""
 
-def search_grain_in_square_area(page, num_x, num_y, search_distance=200):
+def search_grain_in_square_area(glyph_index, num_x, num_y, search_distance=DEFAULT_SETTINGS.grain_search_distance,
+                                orientation_ratio=DEFAULT_SETTINGS.orientation_ratio):
     """
     Tìm GRAIN/NIARG trong phạm vi hình vuông quanh number
     TRẢ VỀ ORIENTATION: "Horizontal" cho GRAIN, "Vertical" cho NIARG
     """
     try:
-        chars = page.chars
-        if not chars:
+        letters = as_glyph_index(glyph_index).letters
+        if not letters:
             return ""
 
-        # Lấy tất cả ký tự text từ page
-        text_chars = [c for c in chars if c.get('text', '').isalpha()]
-
-        # Tìm ký tự trong hình vuông
+        # Tìm ký tự trong hình vuông (chỉ mục chỉ chứa chữ G/R/A/I/N)
         candidate_chars = []
 
-        for char in text_chars:
-            char_x = char.get('x0', 0)
-            char_y = char.get('top', 0)
-            char_text = char.get('text', '').upper()
-
+        for char_text, char_x, char_y in letters:
             # Kiểm tra ký tự có nằm trong hình vuông không
             if (abs(char_x - num_x) <= search_distance and
-                abs(char_y - num_y) <= search_distance and
-                char_text in ['G', 'R', 'A', 'I', 'N']):
+                abs(char_y - num_y) <= search_distance):
 
                 candidate_chars.append({
                     'char': char_text,
                     'x': char_x,
                     'y': char_y,
-                    'distance': math.sqrt((char_x - num_x)**2 + (char_y - num_y)**2),
-                    'original_char': char
+                    'distance': math.sqrt((char_x - num_x)**2 + (char_y - num_y)**2)
                 })
 
         # Sắp xếp theo khoảng cách gần nhất
@@ -567,7 +817,7 @@ def search_grain_in_square_area(page, num_x, num_y, search_distance=200):
 
         # Thử ghép thành chữ GRAIN hoặc NIARG
         if len(candidate_chars) >= 5:
-            grain_sequence_info = find_grain_sequence_with_direction(candidate_chars)
+            grain_sequence_info = find_grain_sequence_with_direction(candidate_chars, orientation_ratio)
 
             if grain_sequence_info:
                 sequence_type = grain_sequence_info['type']  # 'GRAIN' hoặc 'NIARG'
@@ -588,9 +838,10 @@ def search_grain_in_square_area(page, num_x, num_y, search_distance=200):
     except Exception as e:
         return ""
 
-def find_grain_sequence_with_direction(candidate_chars):
+def find_grain_sequence_with_direction(candidate_chars, orientation_ratio=DEFAULT_SETTINGS.orientation_ratio):
     """
     *** MỚI: Tìm chuỗi GRAIN/NIARG và xác định hướng dựa trên layout của text ***
+    *** CẬP NHẬT: Ngưỡng hướng lấy từ settings.orientation_ratio thay vì cố định 1.5 ***
     """
     try:
         # Nhóm ký tự theo loại
@@ -626,9 +877,9 @@ def find_grain_sequence_with_direction(candidate_chars):
         y_span = max(y_positions) - min(y_positions)
 
         # Xác định hướng của text GRAIN
-        if x_span > y_span * 1.5:
+        if x_span > y_span * orientation_ratio:
             text_direction = "Horizontal"  # Text nằm ngang
-        elif y_span > x_span * 1.5:
+        elif y_span > x_span * orientation_ratio:
             text_direction = "Vertical"    # Text nằm dọc
         else:
             # Không rõ ràng → mặc định Horizontal
@@ -691,46 +942,58 @@ def calculate_sequence_similarity(actual_sequence, target_sequence):
     except:
         return 0
 
-def expand_small_groups(df):
+def expand_small_groups(df, settings=DEFAULT_SETTINGS):
     try:
+        excluded_font_size = settings.excluded_font_size
+        height_tolerance = settings.height_tolerance
+
         group_counts = df['Group'].value_counts()
         groups_with_2_numbers = group_counts[group_counts == 2].index.tolist()
 
         if not groups_with_2_numbers:
             return df
 
+        # *** CẬP NHẬT: Duyệt trên list thuần (theo thứ tự dòng) thay vì iterrows/df.loc ***
+        font_sizes = df['Font_Size'].tolist()
+        char_widths = df['Char_Width'].tolist()
+        char_heights = df['Char_Height'].tolist()
+        font_names = df['Font Name'].tolist()
+        orientations = df['Orientation'].tolist()
+        groups = df['Group'].tolist()
+        hv_mix = df['Has_HV_Mix'].tolist()
+        rows = range(len(groups))
+
         for group_name in groups_with_2_numbers:
-            group_data = df[df['Group'] == group_name]
-            if len(group_data) != 2:
+            members = [k for k in rows if groups[k] == group_name]
+            if len(members) != 2:
                 continue
 
-            group_char_widths = group_data['Char_Width'].unique()
+            group_char_widths = {char_widths[k] for k in members}
             if len(group_char_widths) != 1:
                 continue
 
-            target_char_width = group_char_widths[0]
-            group_char_heights = group_data['Char_Height'].tolist()
-            group_font_names = group_data['Font Name'].unique()
-            group_orientations = set(group_data['Orientation'].tolist())
-
-            candidate_data = df[df['Group'] != group_name]
+            target_char_width = char_widths[members[0]]
+            group_char_heights = [char_heights[k] for k in members]
+            group_font_names = {font_names[k] for k in members}
+            group_orientations = {orientations[k] for k in members}
 
             candidates = []
-            for idx, row in candidate_data.iterrows():
-                candidate_font_size = row['Font_Size']
-                candidate_char_width = row['Char_Width']
-                candidate_char_height = row['Char_Height']
-                candidate_font_name = row['Font Name']
-                candidate_orientation = row['Orientation']
-                candidate_current_group = row['Group']
-
-                if candidate_font_size == 20.6:
+            for k in rows:
+                if groups[k] == group_name:
+                    continue
+
+                candidate_font_size = font_sizes[k]
+                candidate_char_width = char_widths[k]
+                candidate_char_height = char_heights[k]
+                candidate_orientation = orientations[k]
+
+                if candidate_font_size == excluded_font_size:
                     continue
 
                 condition_1 = (candidate_font_size == candidate_char_width)
                 condition_2 = (candidate_char_width == target_char_width)
-                condition_3 = any(abs(candidate_char_height - gh) <= 0.2 for gh in group_char_heights)
-                condition_4 = (candidate_font_name in group_font_names)
+                condition_3 = any(abs(candidate_char_height - gh) <= height_tolerance for gh in group_char_heights)
+                condition_4 = (font_names[k] in group_font_names)
 
                 condition_5 = True
                 if candidate_orientation == 'Single':
@@ -743,83 +1006,88 @@ def expand_small_groups(df):
                         condition_5 = False
 
                 if condition_1 and condition_2 and condition_3 and condition_4 and condition_5:
-                    candidates.append({
-                        'index': idx,
-                        'number': row['Valid Number'],
-                        'font_size': candidate_font_size,
-                        'char_width': candidate_char_width,
-                        'char_height': candidate_char_height,
-                        'font_name': candidate_font_name,
-                        'orientation': candidate_orientation,
-                        'current_group': candidate_current_group
-                    })
+                    candidates.append(k)
 
             if candidates:
                 groups_to_check_empty = set()
 
-                for candidate in candidates:
-                    old_group = candidate['current_group']
+                for k in candidates:
+                    old_group = groups[k]
                     if old_group != 'UNGROUPED':
                         groups_to_check_empty.add(old_group)
 
-                    df.loc[candidate['index'], 'Group'] = group_name
-                    df.loc[candidate['index'], 'Has_HV_Mix'] = True
+                    groups[k] = group_name
+                    hv_mix[k] = True
 
-                df.loc[df['Group'] == group_name, 'Has_HV_Mix'] = True
+                for k in rows:
+                    if groups[k] == group_name:
+                        hv_mix[k] = True
 
                 for old_group in groups_to_check_empty:
-                    remaining_count = len(df[df['Group'] == old_group])
-                    if remaining_count == 1:
-                        last_number_idx = df[df['Group'] == old_group].index[0]
-                        df.loc[last_number_idx, 'Group'] = 'UNGROUPED'
-                        df.loc[last_number_idx, 'Has_HV_Mix'] = False
+                    remaining = [k for k in rows if groups[k] == old_group]
+                    if len(remaining) == 1:
+                        groups[remaining[0]] = 'UNGROUPED'
+                        hv_mix[remaining[0]] = False
 
+        df['Group'] = groups
+        df['Has_HV_Mix'] = hv_mix
         return df
 
     except Exception as e:
         return df
 
-def group_numbers_by_font_characteristics(df):
+def group_numbers_by_font_characteristics(df, settings=DEFAULT_SETTINGS):
     """
     Phân nhóm số theo đặc tính font - CẬP NHẬT LOGIC CHO PHÉP Single orientation nhóm với H/V
     *** CẬP NHẬT: Kiểm tra uniform metrics để đặt Has_HV_Mix = False ***
+    *** CẬP NHẬT: So sánh từng cặp trên list thuần, chỉ ghi cột Group/Has_HV_Mix vào DataFrame 1 lần ***
     """
     try:
+        excluded_font_size = settings.excluded_font_size
+        height_tolerance = settings.height_tolerance
+
         if len(df) < 1:
             df['Group'] = 'INSUFFICIENT_DATA'
             df['Has_HV_Mix'] = False
             return df
 
-        df['Group'] = 'UNGROUPED'
-        df['Has_HV_Mix'] = False
+        font_sizes = df['Font_Size'].tolist()
+        char_widths = df['Char_Width'].tolist()
+        char_heights = df['Char_Height'].tolist()
+        orientations = df['Orientation'].tolist()
+        font_names = df['Font Name'].tolist()
+        rows = range(len(df))
+
+        groups = ['UNGROUPED'] * len(df)
+        hv_mix = [False] * len(df)
         group_counter = 1
 
-        for i, row in df.iterrows():
-            if df.loc[i, 'Group'] != 'UNGROUPED':
+        for i in rows:
+            if groups[i] != 'UNGROUPED':
                 continue
 
-            current_font_size = row['Font_Size']
-            current_char_width = row['Char_Width']
-            current_char_height = row['Char_Height']
-            current_orientation = row['Orientation']
-            current_font_name = row['Font Name']
+            current_font_size = font_sizes[i]
+            current_char_width = char_widths[i]
+            current_char_height = char_heights[i]
+            current_orientation = orientations[i]
+            current_font_name = font_names[i]
 
-            if current_font_size == 20.6:
+            if current_font_size == excluded_font_size:
                 continue
 
             group_indices = [i]
 
-            for j, other_row in df.iterrows():
-                if i == j or df.loc[j, 'Group'] != 'UNGROUPED':
+            for j in rows:
+                if i == j or groups[j] != 'UNGROUPED':
                     continue
 
-                other_font_size = other_row['Font_Size']
-                other_char_width = other_row['Char_Width']
-                other_char_height = other_row['Char_Height']
-                other_orientation = other_row['Orientation']
-                other_font_name = other_row['Font Name']
+                other_font_size = font_sizes[j]
+                other_char_width = char_widths[j]
+                other_char_height = char_heights[j]
+                other_orientation = orientations[j]
+                other_font_name = font_names[j]
 
-                if other_font_size == 20.6:
+                if other_font_size == excluded_font_size:
                     continue
 
                 is_same_group = False
@@ -833,29 +1101,28 @@ def group_numbers_by_font_characteristics(df):
                 elif (current_font_name == other_font_name and
                       current_char_width == other_char_width and
                       current_font_size == other_font_size and
-                      abs(current_char_height - other_char_height) <= 0.2):
+                      abs(current_char_height - other_char_height) <= height_tolerance):
                     is_same_group = True
 
                 elif (current_font_name == other_font_name and
                       current_char_width == other_char_width and
                       current_font_size == other_font_size and
-                      abs(current_char_height - other_char_height) <= 0.2):
+                      abs(current_char_height - other_char_height) <= height_tolerance):
 
-                    orientations = {current_orientation, other_orientation}
-                    if 'Single' in orientations and ('Horizontal' in orientations or 'Vertical' in orientations):
+                    orientations_pair = {current_orientation, other_orientation}
+                    if 'Single' in orientations_pair and ('Horizontal' in orientations_pair or 'Vertical' in orientations_pair):
                         is_same_group = True
 
                 elif (current_font_name == other_font_name and
                       current_char_width == other_char_width and
-                      abs(current_char_height - other_char_height) <= 0.2):
+                      abs(current_char_height - other_char_height) <= height_tolerance):
 
                     if ((current_orientation == 'Horizontal' and other_orientation == 'Vertical') or
                         (current_orientation == 'Vertical' and other_orientation == 'Horizontal')):
 
-                        horizontal_row = row if current_orientation == 'Horizontal' else other_row
-                        vertical_row = other_row if current_orientation == 'Horizontal' else row
+                        vertical_idx = j if current_orientation == 'Horizontal' else i
 
-                        if vertical_row['Font_Size'] == vertical_row['Char_Width']:
+                        if font_sizes[vertical_idx] == char_widths[vertical_idx]:
                             is_same_group = True
 
                 if is_same_group:
@@ -864,27 +1131,28 @@ def group_numbers_by_font_characteristics(df):
             if len(group_indices) >= 1:
                 group_name = f"GROUP_{group_counter}"
                 for idx in group_indices:
-                    df.loc[idx, 'Group'] = group_name
+                    groups[idx] = group_name
 
                 if len(group_indices) > 1:
-                    numbers_in_group = [df.loc[idx, 'Valid Number'] for idx in group_indices]
-                    orientations_in_group = [df.loc[idx, 'Orientation'] for idx in group_indices]
+                    orientations_in_group = [orientations[idx] for idx in group_indices]
 
-                    group_data = df[df['Group'] == group_name]
-                    is_uniform = check_uniform_metrics_for_has_hv_mix(group_data)
+                    is_uniform = check_uniform_metrics_for_has_hv_mix(df.iloc[group_indices])
 
                     if is_uniform:
                         for idx in group_indices:
-                            df.loc[idx, 'Has_HV_Mix'] = False
+                            hv_mix[idx] = False
                     else:
                         unique_orientations = set(orientations_in_group)
                         if len(unique_orientations) > 1 and ('Horizontal' in unique_orientations or 'Vertical' in unique_orientations or 'Single' in unique_orientations):
                             for idx in group_indices:
-                                df.loc[idx, 'Has_HV_Mix'] = True
+                                hv_mix[idx] = True
 
                 group_counter += 1
 
-        df = expand_small_groups(df)
+        df['Group'] = groups
+        df['Has_HV_Mix'] = hv_mix
+
+        df = expand_small_groups(df, settings)
 
         for group_name in df['Group'].unique():
             if group_name not in ['UNGROUPED', 'INSUFFICIENT_DATA', 'ERROR']:
@@ -922,12 +1190,12 @@ def check_uniform_metrics_for_has_hv_mix(group_data):
     except Exception as e:
         return False
 
-def extract_foil_classification_with_detail(page):
+def extract_foil_classification_with_detail(page, page_text=None):
     """
     CẬP NHẬT: Đếm FOIL/LIOF từ text với logic mới - tìm số trong ngoặc từ pattern
     """
     try:
-        text = page.extract_text()
+        text = page_text if page_text is not None else page.extract_text()
         if not text:
             return "", ""
 
@@ -995,10 +1263,10 @@ def extract_foil_classification_with_detail(page):
     except Exception as e:
         return "", ""
 
-def extract_edgeband_classification_with_detail(page):
+def extract_edgeband_classification_with_detail(page, page_text=None):
     """Đếm EDGEBAND/DNABEGDE từ text đơn giản"""
     try:
-        text = page.extract_text()
+        text = page_text if page_text is not None else page.extract_text()
         if not text:
             return "", ""
 
@@ -1029,10 +1297,10 @@ def extract_edgeband_classification_with_detail(page):
     except Exception as e:
         return "", ""
 
-def extract_profile_from_page(page):
+def extract_profile_from_page(page, page_text=None):
     """Trích xuất thông tin profile từ trang PDF - CẬP NHẬT: Tìm tối đa 3 profile khác nhau"""
     try:
-        text = page.extract_text()
+        text = page_text if page_text is not None else page.extract_text()
         if not text:
             return "", "", ""
 
@@ -1070,85 +1338,114 @@ def extract_profile_from_page(page):
     except Exception as e:
         return "", "", ""
 
-def determine_preferred_font_with_frequency_3(all_fonts, digit_chars):
-    """Xác định font ưu tiên - ƯU TIÊN F2/F3, FALLBACK CHO FONT CÓ FREQUENCY = 3"""
+def summarize_digit_fonts(digit_chars, font_registry=None, settings=DEFAULT_SETTINGS):
+    """
+    *** MỚI: Tổng hợp ký tự số theo font trong 1 lần duyệt ***
+    Bỏ qua ký tự size 20.6 (settings.excluded_font_size). Thứ tự font = thứ tự xuất hiện đầu tiên trong digit_chars.
+
+    Returns:
+        dict: {fontname: {'count', 'sum_x', 'sum_y', 'priority'}}
+    """
+    if font_registry is None:
+        font_registry = {}
+
+    excluded_font_size = settings.excluded_font_size
+    summary = {}
+    for char in digit_chars:
+        if char.get('size', 0) == excluded_font_size:
+            continue
+        fontname = char.get('fontname', 'Unknown')
+        entry = summary.get(fontname)
+        if entry is None:
+            entry = summary[fontname] = {
+                'count': 0,
+                'sum_x': 0,
+                'sum_y': 0,
+                'priority': lookup_font(font_registry, fontname)['priority']
+            }
+        entry['count'] += 1
+        entry['sum_x'] += char.get('x0', 0)
+        entry['sum_y'] += char.get('top', 0)
+    return summary
+
+def select_lowest_font(font_summary, fontnames):
+    """Chọn font có vị trí trung bình thấp nhất trên trang (top lớn nhất, rồi x0 lớn nhất)"""
+    best_font = None
+    best_key = None
+    for fontname in fontnames:
+        entry = font_summary[fontname]
+        key = (entry['sum_y'] / entry['count'], entry['sum_x'] / entry['count'])
+        # Chỉ thay khi lớn hơn hẳn → giữ font xuất hiện trước khi bằng nhau
+        if best_key is None or key > best_key:
+            best_font, best_key = fontname, key
+    return best_font
+
+def determine_preferred_font_with_frequency_3(all_fonts, digit_chars, font_registry=None, trace=None,
+                                              settings=DEFAULT_SETTINGS):
+    """
+    Xác định font ưu tiên - ƯU TIÊN F2/F3, FALLBACK CHO FONT CÓ FREQUENCY = 3
+    *** CẬP NHẬT: Tổng hợp 1 lần (summarize_digit_fonts) rồi chọn font trên bản tổng hợp ***
+
+    Args:
+        trace (list): Nếu truyền vào, ghi lại từng bước quyết định để debug
+    """
     if not all_fonts:
         return None
 
-    # BƯỚC 1: Kiểm tra có font F2/F3 không
-    font_priorities = [(font, get_font_priority(font)) for font in all_fonts]
-    valid_font_priorities = [(font, priority) for font, priority in font_priorities if priority > 0]
-
-    # Nếu có font F2/F3 hợp lệ
-    if valid_font_priorities:
-        font_char_counts = {}
-        for char in digit_chars:
-            fontname = char.get('fontname', 'Unknown')
-            if char.get('size', 0) == 20.6:
-                continue
-            if fontname in [fp[0] for fp in valid_font_priorities]:
-                if fontname not in font_char_counts:
-                    font_char_counts[fontname] = []
-                font_char_counts[fontname].append(char)
+    if font_registry is None:
+        font_registry = {}
 
-        total_valid_chars = sum(len(chars) for chars in font_char_counts.values())
+    def log(message):
+        if trace is not None:
+            trace.append(message)
 
-        if total_valid_chars >= 3 and len(font_char_counts) >= 2:
-            font_avg_positions = {}
-            for fontname, chars in font_char_counts.items():
-                avg_x = sum(c.get('x0', 0) for c in chars) / len(chars)
-                avg_y = sum(c.get('top', 0) for c in chars) / len(chars)
-                font_avg_positions[fontname] = (avg_x, avg_y)
+    font_summary = summarize_digit_fonts(digit_chars, font_registry, settings)
+    log("Font summary: " + ", ".join(
+        f"{font} (count={entry['count']}, priority={entry['priority']})" for font, entry in font_summary.items()))
 
-            sorted_fonts = sorted(font_avg_positions.items(),
-                                key=lambda x: (x[1][1], x[1][0]), reverse=True)
+    # BƯỚC 1: Kiểm tra có font F2/F3 không
+    valid_fonts = [font for font in all_fonts if lookup_font(font_registry, font)['priority'] > 0]
 
-            selected_font = sorted_fonts[0][0]
+    # Nếu có font F2/F3 hợp lệ
+    if valid_fonts:
+        log(f"F2/F3 fonts: {valid_fonts}")
+        valid_font_set = set(valid_fonts)
+        used_fonts = [font for font in font_summary if font in valid_font_set]
+        total_valid_chars = sum(font_summary[font]['count'] for font in used_fonts)
+
+        if total_valid_chars >= 3 and len(used_fonts) >= 2:
+            selected_font = select_lowest_font(font_summary, used_fonts)
+            log(f"{total_valid_chars} digits in {len(used_fonts)} F2/F3 fonts → lowest average position: {selected_font}")
             return selected_font
 
         else:
-            valid_font_priorities.sort(key=lambda x: x[1], reverse=True)
-            selected_font = valid_font_priorities[0][0]
+            selected_font = max(valid_fonts, key=lambda font: lookup_font(font_registry, font)['priority'])
+            log(f"{total_valid_chars} digits in {len(used_fonts)} F2/F3 font(s) → highest priority: {selected_font}")
             return selected_font
 
     else:
         # BƯỚC 2: FALLBACK - TÌM FONT CÓ FREQUENCY = 3
-        font_frequencies = {}
-        for char in digit_chars:
-            if char.get('size', 0) == 20.6:
-                continue
-            fontname = char.get('fontname', 'Unknown')
-            if fontname not in font_frequencies:
-                font_frequencies[fontname] = 0
-            font_frequencies[fontname] += 1
-
-        fonts_with_freq_3 = [font for font, freq in font_frequencies.items() if freq == 3]
+        log("No F2/F3 font → frequency fallback")
+        fonts_with_freq_3 = [font for font, entry in font_summary.items() if entry['count'] == 3]
 
         if fonts_with_freq_3:
             if len(fonts_with_freq_3) == 1:
                 selected_font = fonts_with_freq_3[0]
+                log(f"Only font with frequency 3: {selected_font}")
                 return selected_font
             else:
-                font_avg_positions = {}
-                for fontname in fonts_with_freq_3:
-                    chars_of_font = [c for c in digit_chars if c.get('fontname', 'Unknown') == fontname and c.get('size', 0) != 20.6]
-                    if chars_of_font:
-                        avg_x = sum(c.get('x0', 0) for c in chars_of_font) / len(chars_of_font)
-                        avg_y = sum(c.get('top', 0) for c in chars_of_font) / len(chars_of_font)
-                        font_avg_positions[fontname] = (avg_x, avg_y)
-
-                if font_avg_positions:
-                    sorted_fonts = sorted(font_avg_positions.items(),
-                                        key=lambda x: (x[1][1], x[1][0]), reverse=True)
-                    selected_font = sorted_fonts[0][0]
-                    return selected_font
-
-        valid_fallback_fonts = {font: freq for font, freq in font_frequencies.items() if freq >= 3}
+                selected_font = select_lowest_font(font_summary, fonts_with_freq_3)
+                log(f"Fonts with frequency 3: {fonts_with_freq_3} → lowest average position: {selected_font}")
+                return selected_font
+
+        valid_fallback_fonts = [font for font, entry in font_summary.items() if entry['count'] >= 3]
 
         if valid_fallback_fonts:
-            selected_font = max(valid_fallback_fonts.items(), key=lambda x: x[1])[0]
+            selected_font = max(valid_fallback_fonts, key=lambda font: font_summary[font]['count'])
+            log(f"Most frequent font with ≥3 digits: {selected_font}")
             return selected_font
         else:
+            log("No font with ≥3 digits → no preferred font")
             return None
 
 def get_font_priority(fontname):
@@ -1160,13 +1457,18 @@ def get_font_priority(fontname):
     else:
         return 0  # Không hợp lệ
 
-def extract_numbers_and_decimals_from_chars(page, filename):
+def extract_numbers_and_decimals_from_chars(page, filename, font_registry=None, filename_exclusion=None,
+                                            settings=DEFAULT_SETTINGS, preferred_font=None):
     """
     *** CẬP NHẬT: METHOD trích xuất số và số thập phân - LỌC SỐ CÓ TRONG TÊN FILE ***
     
     Args:
         page: Page object từ pdfplumber
         filename (str): Tên file PDF
+        font_registry (dict): Bảng phân loại font của tài liệu (build_font_registry)
+        filename_exclusion (dict): Tên file đã chuẩn hoá (build_filename_exclusion)
+        settings (ExtractionSettings): Các ngưỡng trích xuất
+        preferred_font (str): Font kích thước đã biết (TemplateCache) → không chọn lại từ trang
     
     Returns:
         tuple: (numbers, orientations, font_info)
@@ -1182,31 +1484,41 @@ def extract_numbers_and_decimals_from_chars(page, filename):
         if not digit_and_dot_chars:
             return numbers, orientations, font_info
 
-        all_fonts = list(set([c.get('fontname', 'Unknown') for c in digit_and_dot_chars]))
-        preferred_font = determine_preferred_font_with_frequency_3(all_fonts, digit_and_dot_chars)
+        if font_registry is None:
+            font_registry = build_font_registry(digit_and_dot_chars)
+
+        if filename_exclusion is None:
+            filename_exclusion = build_filename_exclusion(filename)
+
+        if preferred_font is None:
+            all_fonts = list(set([c.get('fontname', 'Unknown') for c in digit_and_dot_chars]))
+            preferred_font = determine_preferred_font_with_frequency_3(all_fonts, digit_and_dot_chars, font_registry,
+                                                                       settings=settings)
 
         if not preferred_font:
             return numbers, orientations, font_info
 
-        char_groups = create_character_groups_with_decimals(digit_and_dot_chars, preferred_font)
+        char_groups = create_character_groups_with_decimals(digit_and_dot_chars, preferred_font, settings)
         extracted_numbers = []
+        excluded_font_size = settings.excluded_font_size
+        max_dimension = settings.max_dimension
 
         for group in char_groups:
             if len(group) == 1 and group[0]['text'].isdigit():
                 try:
-                    if group[0].get('size', 0) == 20.6:
+                    if group[0].get('size', 0) == excluded_font_size:
                         continue
 
                     num_value = int(group[0]['text'])
                     
                     # *** KIỂM TRA SỐ CÓ TRONG TÊN FILE ***
-                    if is_number_in_filename(num_value, filename):
+                    if is_number_excluded(num_value, filename_exclusion):
                         continue
                     
                     fontname = group[0].get('fontname', 'Unknown')
-                    font_weight = get_font_weight(group[0])
+                    font_weight = lookup_font(font_registry, group[0].get('fontname', ''))['weight']
 
-                    if (1 <= num_value <= 3500 and fontname == preferred_font):
+                    if (1 <= num_value <= max_dimension and fontname == preferred_font):
                         numbers.append(num_value)
                         orientations[f"{num_value}_{len(numbers)}"] = 'Single'
                         font_info[f"{num_value}_{len(numbers)}"] = {
@@ -1219,12 +1531,12 @@ def extract_numbers_and_decimals_from_chars(page, filename):
                 except:
                     continue
             else:
-                result = process_character_group_with_decimals(group, extracted_numbers, preferred_font)
+                result = process_character_group_with_decimals(group, extracted_numbers, preferred_font, settings)
                 if result:
                     number, orientation, is_decimal = result
                     
                     # *** KIỂM TRA SỐ CÓ TRONG TÊN FILE ***
-                    if is_number_in_filename(number, filename):
+                    if is_number_excluded(number, filename_exclusion):
                         continue
 
                     if is_decimal:
@@ -1233,12 +1545,7 @@ def extract_numbers_and_decimals_from_chars(page, filename):
                         numbers.append(int(number))
 
                     orientations[f"{number}_{len(numbers)}"] = orientation
-                    fonts = [ch.get("fontname", "Unknown") for ch in group]
-                    fontname = Counter(fonts).most_common(1)[0][0] if fonts else "Unknown"
-
-                    weights = [get_font_weight(ch) for ch in group]
-                    weight_counter = Counter(weights)
-                    common_weight = weight_counter.most_common(1)[0][0] if weights else "Unknown"
+                    fontname, common_weight = most_common_font_and_weight(group, font_registry)
 
                     font_info[f"{number}_{len(numbers)}"] = {
                         'chars': group,
@@ -1253,12 +1560,23 @@ def extract_numbers_and_decimals_from_chars(page, filename):
 
     return numbers, orientations, font_info
 
-def create_character_groups_with_decimals(digit_and_dot_chars, preferred_font):
+def grouping_limits(settings=DEFAULT_SETTINGS):
+    """
+    *** MỚI: Các ngưỡng ghép ký tự dạng tuple, lấy 1 lần trước vòng lặp O(n²) ***
+    Thứ tự: (excluded_font_size, char_distance, mixed_font_char_distance,
+             orientation_ratio, vertical_alignment, horizontal_alignment)
+    """
+    return (settings.excluded_font_size, settings.char_distance, settings.mixed_font_char_distance,
+            settings.orientation_ratio, settings.vertical_alignment, settings.horizontal_alignment)
+
+def create_character_groups_with_decimals(digit_and_dot_chars, preferred_font, settings=DEFAULT_SETTINGS):
     """Tạo các nhóm ký tự bao gồm số và dấu chấm thập phân"""
     char_groups = []
     used_chars = set()
 
-    valid_chars = [c for c in digit_and_dot_chars if c.get('fontname', 'Unknown') == preferred_font and c.get('size', 0) != 20.6]
+    limits = grouping_limits(settings)
+    excluded_font_size = limits[0]
+    valid_chars = [c for c in digit_and_dot_chars if c.get('fontname', 'Unknown') == preferred_font and c.get('size', 0) != excluded_font_size]
 
     if not valid_chars:
         return char_groups
@@ -1276,7 +1594,7 @@ def create_character_groups_with_decimals(digit_and_dot_chars, preferred_font):
             if i == j or id(other_char) in used_chars:
                 continue
 
-            if should_group_characters_with_decimals(base_char, other_char, current_group, preferred_font):
+            if should_group_characters_with_decimals(base_char, other_char, current_group, preferred_font, settings, limits):
                 current_group.append(other_char)
                 used_chars.add(id(other_char))
 
@@ -1285,16 +1603,23 @@ def create_character_groups_with_decimals(digit_and_dot_chars, preferred_font):
 
     return char_groups
 
-def should_group_characters_with_decimals(base_char, other_char, current_group, preferred_font):
-    """Xác định xem 2 ký tự có nên được nhóm lại không - BAO GỒM DẤU CHẤM"""
+def should_group_characters_with_decimals(base_char, other_char, current_group, preferred_font, settings=DEFAULT_SETTINGS,
+                                          limits=None):
+    """
+    Xác định xem 2 ký tự có nên được nhóm lại không - BAO GỒM DẤU CHẤM
+    *** CẬP NHẬT: limits = grouping_limits(settings) do vòng lặp gọi truyền vào ***
+    """
     try:
+        (excluded_font_size, char_distance, _,
+         orientation_ratio, vertical_alignment, horizontal_alignment) = limits or grouping_limits(settings)
+
         base_font = base_char.get('fontname', 'Unknown')
         other_font = other_char.get('fontname', 'Unknown')
 
         if not (base_font == preferred_font and other_font == preferred_font):
             return False
 
-        if base_char.get('size', 0) == 20.6 or other_char.get('size', 0) == 20.6:
+        if base_char.get('size', 0) == excluded_font_size or other_char.get('size', 0) == excluded_font_size:
             return False
 
         distance = math.sqrt(
@@ -1302,22 +1627,22 @@ def should_group_characters_with_decimals(base_char, other_char, current_group,
             (base_char['top'] - other_char['top'])**2
         )
 
-        if distance > 30:
+        if distance > char_distance:
             return False
 
         if len(current_group) > 1:
             group_x_span = max(c['x0'] for c in current_group) - min(c['x0'] for c in current_group)
             group_y_span = max(c['top'] for c in current_group) - min(c['top'] for c in current_group)
 
-            is_group_vertical = group_y_span > group_x_span * 1.5
+            is_group_vertical = group_y_span > group_x_span * orientation_ratio
 
             if is_group_vertical:
                 group_x_center = sum(c['x0'] for c in current_group) / len(current_group)
-                if abs(other_char['x0'] - group_x_center) > 10:
+                if abs(other_char['x0'] - group_x_center) > vertical_alignment:
                     return False
             else:
                 group_y_center = sum(c['top'] for c in current_group) / len(current_group)
-                if abs(other_char['top'] - group_y_center) > 8:
+                if abs(other_char['top'] - group_y_center) > horizontal_alignment:
                     return False
 
         return True
@@ -1325,7 +1650,7 @@ def should_group_characters_with_decimals(base_char, other_char, current_group,
     except Exception:
         return False
 
-def process_character_group_with_decimals(group, extracted_numbers, preferred_font):
+def process_character_group_with_decimals(group, extracted_numbers, preferred_font, settings=DEFAULT_SETTINGS):
     """Xử lý nhóm ký tự bao gồm số thập phân"""
     try:
         if len(group) < 1:
@@ -1335,14 +1660,16 @@ def process_character_group_with_decimals(group, extracted_numbers, preferred_fo
         if not all(font == preferred_font for font in fonts):
             return None
 
-        if any(ch.get('size', 0) == 20.6 for ch in group):
+        excluded_font_size = settings.excluded_font_size
+        if any(ch.get('size', 0) == excluded_font_size for ch in group):
             return None
 
+        max_dimension = settings.max_dimension
         if len(group) == 1:
             char_text = group[0]['text']
             if char_text.isdigit():
                 num_value = int(char_text)
-                if 1 <= num_value <= 3500:
+                if 1 <= num_value <= max_dimension:
                     return (num_value, 'Single', False)
             return None
 
@@ -1352,7 +1679,7 @@ def process_character_group_with_decimals(group, extracted_numbers, preferred_fo
         x_span = max(x_positions) - min(x_positions)
         y_span = max(y_positions) - min(y_positions)
 
-        is_vertical = y_span > x_span * 1.5
+        is_vertical = y_span > x_span * settings.orientation_ratio
 
         if is_vertical:
             vertical_sorted = sorted(group, key=lambda c: c['top'], reverse=True)
@@ -1365,7 +1692,7 @@ def process_character_group_with_decimals(group, extracted_numbers, preferred_fo
             try:
                 if v_text.count('.') == 1 and not v_text.startswith('.') and not v_text.endswith('.'):
                     num_value = float(v_text)
-                    if 0.1 <= num_value <= 3500.0:
+                    if settings.min_decimal_value <= num_value <= max_dimension:
                         orientation = 'Vertical' if is_vertical else 'Horizontal'
                         return (num_value, orientation, True)
             except:
@@ -1373,7 +1700,7 @@ def process_character_group_with_decimals(group, extracted_numbers, preferred_fo
         else:
             try:
                 num_value = int(v_text)
-                if 1 <= num_value <= 3500:
+                if 1 <= num_value <= max_dimension:
                     orientation = 'Vertical' if is_vertical else 'Horizontal'
                     return (num_value, orientation, False)
             except:
@@ -1384,16 +1711,39 @@ def process_character_group_with_decimals(group, extracted_numbers, preferred_fo
     except Exception:
         return None
 
-def extract_all_valid_numbers_from_page(page, filename):
+@dataclass(frozen=True, slots=True)
+class ExtractedNumber:
+    """*** MỚI: 1 số hợp lệ của BẢNG PHỤ - metrics đã xoay tại nguồn ***"""
+    number: float
+    fontname: str
+    font_weight: str
+    orientation: str
+    x_pos: float
+    y_pos: float
+    chars_count: int
+    font_size: float
+    char_width: float
+    char_height: float
+    density_score: float
+    distance_from_origin: float
+    aspect_ratio: float
+    char_spacing: float
+    text_angle: float
+
+def extract_all_valid_numbers_from_page(page, filename, font_registry=None, filename_exclusion=None,
+                                        settings=DEFAULT_SETTINGS):
     """
     *** CẬP NHẬT: BẢNG PHỤ - Trích xuất TẤT CẢ số hợp lệ - LỌC SỐ CÓ TRONG TÊN FILE ***
     
     Args:
         page: Page object từ pdfplumber
         filename (str): Tên file PDF
+        font_registry (dict): Bảng phân loại font của tài liệu (build_font_registry)
+        filename_exclusion (dict): Tên file đã chuẩn hoá (build_filename_exclusion)
+        settings (ExtractionSettings): Các ngưỡng trích xuất
     
     Returns:
-        list: Danh sách dictionary chứa thông tin số
+        list: Danh sách ExtractedNumber
     """
     all_valid_numbers = []
 
@@ -1404,104 +1754,110 @@ def extract_all_valid_numbers_from_page(page, filename):
         if not digit_and_dot_chars:
             return all_valid_numbers
 
-        char_groups = create_character_groups_for_all_numbers_with_decimals(digit_and_dot_chars)
+        if font_registry is None:
+            font_registry = build_font_registry(digit_and_dot_chars)
+
+        if filename_exclusion is None:
+            filename_exclusion = build_filename_exclusion(filename)
+
+        char_groups = create_character_groups_for_all_numbers_with_decimals(digit_and_dot_chars, settings)
+        excluded_font_size = settings.excluded_font_size
+        min_decimal_value = settings.min_decimal_value
+        max_dimension = settings.max_dimension
 
         for group_idx, group in enumerate(char_groups):
             if len(group) == 1 and group[0]['text'].isdigit():
                 try:
-                    if group[0].get('size', 0) == 20.6:
+                    if group[0].get('size', 0) == excluded_font_size:
                         continue
 
                     num_value = int(group[0]['text'])
                     
                     # *** KIỂM TRA SỐ CÓ TRONG TÊN FILE ***
-                    if is_number_in_filename(num_value, filename):
+                    if is_number_excluded(num_value, filename_exclusion):
                         continue
                     
                     fontname = group[0].get('fontname', 'Unknown')
-                    font_weight = get_font_weight(group[0])
+                    font_weight = lookup_font(font_registry, group[0].get('fontname', ''))['weight']
                     x_pos = group[0]['x0']
                     y_pos = group[0]['top']
 
-                    if 0 < num_value <= 3500:
-                        metrics = calculate_advanced_metrics_with_rotation(group, num_value, x_pos, y_pos, 'Single')
+                    if 0 < num_value <= max_dimension:
+                        metrics = calculate_advanced_metrics_with_rotation(group, num_value, x_pos, y_pos, 'Single', settings)
 
                         if metrics is None:
                             continue
 
-                        all_valid_numbers.append({
-                            'number': num_value,
-                            'fontname': fontname,
-                            'font_weight': font_weight,
-                            'orientation': 'Single',
-                            'x_pos': x_pos,
-                            'y_pos': y_pos,
-                            'chars_count': 1,
-                            'font_size': metrics['font_size'],
-                            'char_width': metrics['char_width'],
-                            'char_height': metrics['char_height'],
-                            'density_score': metrics['density_score'],
-                            'distance_from_origin': metrics['distance_from_origin'],
-                            'aspect_ratio': metrics['aspect_ratio'],
-                            'char_spacing': metrics['char_spacing'],
-                            'text_angle': metrics['text_angle']
-                        })
+                        all_valid_numbers.append(ExtractedNumber(
+                            number=num_value,
+                            fontname=fontname,
+                            font_weight=font_weight,
+                            orientation='Single',
+                            x_pos=x_pos,
+                            y_pos=y_pos,
+                            chars_count=1,
+                            font_size=metrics['font_size'],
+                            char_width=metrics['char_width'],
+                            char_height=metrics['char_height'],
+                            density_score=metrics['density_score'],
+                            distance_from_origin=metrics['distance_from_origin'],
+                            aspect_ratio=metrics['aspect_ratio'],
+                            char_spacing=metrics['char_spacing'],
+                            text_angle=metrics['text_angle']
+                        ))
                 except:
                     continue
             else:
-                result = process_character_group_for_all_numbers_with_decimals(group)
+                result = process_character_group_for_all_numbers_with_decimals(group, settings)
                 if result:
                     number, orientation, is_decimal = result
                     
                     # *** KIỂM TRA SỐ CÓ TRONG TÊN FILE ***
-                    if is_number_in_filename(number, filename):
+                    if is_number_excluded(number, filename_exclusion):
                         continue
                     
-                    if (is_decimal and 0.1 <= number <= 3500.0) or (not is_decimal and 0 < number <= 3500):
-                        fonts = [ch.get("fontname", "Unknown") for ch in group]
-                        fontname = Counter(fonts).most_common(1)[0][0] if fonts else "Unknown"
-
-                        weights = [get_font_weight(ch) for ch in group]
-                        weight_counter = Counter(weights)
-                        common_weight = weight_counter.most_common(1)[0][0] if weights else "Unknown"
+                    if (is_decimal and min_decimal_value <= number <= max_dimension) or (not is_decimal and 0 < number <= max_dimension):
+                        fontname, common_weight = most_common_font_and_weight(group, font_registry)
 
                         avg_x = sum(c['x0'] for c in group) / len(group)
                         avg_y = sum(c['top'] for c in group) / len(group)
 
-                        metrics = calculate_advanced_metrics_with_rotation(group, number, avg_x, avg_y, orientation)
+                        metrics = calculate_advanced_metrics_with_rotation(group, number, avg_x, avg_y, orientation, settings)
 
                         if metrics is None:
                             continue
 
-                        all_valid_numbers.append({
-                            'number': number,
-                            'fontname': fontname,
-                            'font_weight': common_weight,
-                            'orientation': orientation,
-                            'x_pos': avg_x,
-                            'y_pos': avg_y,
-                            'chars_count': len(group),
-                            'font_size': metrics['font_size'],
-                            'char_width': metrics['char_width'],
-                            'char_height': metrics['char_height'],
-                            'density_score': metrics['density_score'],
-                            'distance_from_origin': metrics['distance_from_origin'],
-                            'aspect_ratio': metrics['aspect_ratio'],
-                            'char_spacing': metrics['char_spacing'],
-                            'text_angle': metrics['text_angle']
-                        })
+                        all_valid_numbers.append(ExtractedNumber(
+                            number=number,
+                            fontname=fontname,
+                            font_weight=common_weight,
+                            orientation=orientation,
+                            x_pos=avg_x,
+                            y_pos=avg_y,
+                            chars_count=len(group),
+                            font_size=metrics['font_size'],
+                            char_width=metrics['char_width'],
+                            char_height=metrics['char_height'],
+                            density_score=metrics['density_score'],
+                            distance_from_origin=metrics['distance_from_origin'],
+                            aspect_ratio=metrics['aspect_ratio'],
+                            char_spacing=metrics['char_spacing'],
+                            text_angle=metrics['text_angle']
+                        ))
 
         return all_valid_numbers
 
     except Exception as e:
         return all_valid_numbers
 
-def create_character_groups_for_all_numbers_with_decimals(digit_and_dot_chars):
+def create_character_groups_for_all_numbers_with_decimals(digit_and_dot_chars, settings=DEFAULT_SETTINGS):
     """Tạo các nhóm ký tự cho TẤT CẢ số bao gồm số thập phân"""
     char_groups = []
     used_chars = set()
 
-    valid_chars = [c for c in digit_and_dot_chars if c.get('size', 0) != 20.6]
+    limits = grouping_limits(settings)
+    excluded_font_size = limits[0]
+    valid_chars = [c for c in digit_and_dot_chars if c.get('size', 0) != excluded_font_size]
 
     sorted_chars = sorted(valid_chars, key=lambda c: (c['top'], c['x0']))
 
@@ -1516,7 +1872,7 @@ def create_character_groups_for_all_numbers_with_decimals(digit_and_dot_chars):
             if i == j or id(other_char) in used_chars:
                 continue
 
-            if should_group_characters_for_all_numbers_with_decimals(base_char, other_char, current_group):
+            if should_group_characters_for_all_numbers_with_decimals(base_char, other_char, current_group, settings, limits):
                 current_group.append(other_char)
                 used_chars.add(id(other_char))
 
@@ -1525,10 +1881,17 @@ def create_character_groups_for_all_numbers_with_decimals(digit_and_dot_chars):
 
     return char_groups
 
-def should_group_characters_for_all_numbers_with_decimals(base_char, other_char, current_group):
-    """Xác định xem 2 ký tự có nên được nhóm lại không - BAO GỒM DẤU CHẤM - ĐÃ SỬA LỖI"""
+def should_group_characters_for_all_numbers_with_decimals(base_char, other_char, current_group, settings=DEFAULT_SETTINGS,
+                                                          limits=None):
+    """
+    Xác định xem 2 ký tự có nên được nhóm lại không - BAO GỒM DẤU CHẤM - ĐÃ SỬA LỖI
+    *** CẬP NHẬT: limits = grouping_limits(settings) do vòng lặp gọi truyền vào ***
+    """
     try:
-        if base_char.get('size', 0) == 20.6 or other_char.get('size', 0) == 20.6:
+        (excluded_font_size, char_distance, mixed_font_char_distance,
+         orientation_ratio, vertical_alignment, horizontal_alignment) = limits or grouping_limits(settings)
+
+        if base_char.get('size', 0) == excluded_font_size or other_char.get('size', 0) == excluded_font_size:
             return False
 
         distance = math.sqrt(
@@ -1536,28 +1899,28 @@ def should_group_characters_for_all_numbers_with_decimals(base_char, other_char,
             (base_char['top'] - other_char['top'])**2
         )
 
-        if distance > 30:
+        if distance > char_distance:
             return False
 
         base_font = base_char.get('fontname', 'Unknown')
         other_font = other_char.get('fontname', 'Unknown')
         if base_font != other_font:
-            if distance > 20:
+            if distance > mixed_font_char_distance:
                 return False
 
         if len(current_group) > 1:
             group_x_span = max(c['x0'] for c in current_group) - min(c['x0'] for c in current_group)
             group_y_span = max(c['top'] for c in current_group) - min(c['top'] for c in current_group)
 
-            is_group_vertical = group_y_span > group_x_span * 1.5
+            is_group_vertical = group_y_span > group_x_span * orientation_ratio
 
             if is_group_vertical:
                 group_x_center = sum(c['x0'] for c in current_group) / len(current_group)
-                if abs(other_char['x0'] - group_x_center) > 10:
+                if abs(other_char['x0'] - group_x_center) > vertical_alignment:
                     return False
             else:
                 group_y_center = sum(c['top'] for c in current_group) / len(current_group)
-                if abs(other_char['top'] - group_y_center) > 8:
+                if abs(other_char['top'] - group_y_center) > horizontal_alignment:
                     return False
 
         return True
@@ -1565,22 +1928,24 @@ def should_group_characters_for_all_numbers_with_decimals(base_char, other_char,
     except Exception:
         return False
 
-def process_character_group_for_all_numbers_with_decimals(group):
+def process_character_group_for_all_numbers_with_decimals(group, settings=DEFAULT_SETTINGS):
     """Xử lý nhóm ký tự cho TẤT CẢ số bao gồm số thập phân"""
     try:
         if len(group) < 2:
             return None
 
-        if any(ch.get('size', 0) == 20.6 for ch in group):
+        excluded_font_size = settings.excluded_font_size
+        if any(ch.get('size', 0) == excluded_font_size for ch in group):
             return None
 
+        max_dimension = settings.max_dimension
         x_positions = [c['x0'] for c in group]
         y_positions = [c['top'] for c in group]
 
         x_span = max(x_positions) - min(x_positions)
         y_span = max(y_positions) - min(y_positions)
 
-        is_vertical = y_span > x_span * 1.5
+        is_vertical = y_span > x_span * settings.orientation_ratio
 
         if is_vertical:
             vertical_sorted = sorted(group, key=lambda c: c['top'], reverse=True)
@@ -1593,7 +1958,7 @@ def process_character_group_for_all_numbers_with_decimals(group):
             try:
                 if v_text.count('.') == 1 and not v_text.startswith('.') and not v_text.endswith('.'):
                     num_value = float(v_text)
-                    if 0.1 <= num_value <= 3500.0:
+                    if settings.min_decimal_value <= num_value <= max_dimension:
                         orientation = 'Vertical' if is_vertical else 'Horizontal'
                         return (num_value, orientation, True)
             except:
@@ -1601,7 +1966,7 @@ def process_character_group_for_all_numbers_with_decimals(group):
         else:
             try:
                 num_value = int(v_text)
-                if 0 < num_value <= 3500:
+                if 0 < num_value <= max_dimension:
                     orientation = 'Vertical' if is_vertical else 'Horizontal'
                     return (num_value, orientation, False)
             except:
@@ -1612,50 +1977,100 @@ def process_character_group_for_all_numbers_with_decimals(group):
     except Exception:
         return None
 
-def create_dimension_summary_with_score_priority(df, df_all_numbers):
+# =============================================================================
+# DIMENSION SUMMARY - SUY LUẬN KÍCH THƯỚC TRÊN RECORD THUẦN (KHÔNG CẦN PANDAS)
+# =============================================================================
+
+SUMMARY_COLUMNS = ["Drawing#", "Length (mm)", "Width (mm)", "Height (mm)",
+                   "Laminate", "FOIL", "EDGEBAND", "Profile", "Profile 2", "Profile 3"]
+
+class GroupedNumber(NamedTuple):
+    """1 số của bảng phụ sau khi phân nhóm, tính SCORE và tìm GRAIN"""
+    valid_number: float
+    group: str
+    score: int
+    grain_orientation: str = ""
+
+@dataclass(frozen=True, slots=True)
+class FileSummary:
+    """1 dòng của bảng kết quả (dimension_summary.xlsx)"""
+    drawing: str
+    length: str = ""
+    width: str = ""
+    height: str = ""
+    laminate: str = ""
+    foil: str = ""
+    edgeband: str = ""
+    profile: str = ""
+    profile_2: str = ""
+    profile_3: str = ""
+
+    def to_row(self):
+        """Giá trị theo thứ tự SUMMARY_COLUMNS"""
+        return (self.drawing, self.length, self.width, self.height, self.laminate,
+                self.foil, self.edgeband, self.profile, self.profile_2, self.profile_3)
+
+def grouped_numbers_from_frame(df_numbers):
+    """Chuyển bảng phụ (đã có Group/SCORE) thành danh sách GroupedNumber"""
+    if df_numbers is None or 'SCORE' not in df_numbers.columns or len(df_numbers) == 0:
+        return []
+
+    grains = df_numbers['GRAIN_Orientation'].tolist() if 'GRAIN_Orientation' in df_numbers.columns else [""] * len(df_numbers)
+    return [GroupedNumber(*values) for values in zip(df_numbers['Valid Number'].tolist(),
+                                                     df_numbers['Group'].tolist(),
+                                                     df_numbers['SCORE'].tolist(),
+                                                     grains)]
+
+def select_winning_group(grouped_numbers):
+    """Tên nhóm dùng để suy ra kích thước (≥3 số, SCORE cao nhất), None nếu không có nhóm hợp lệ"""
+    if not grouped_numbers:
+        return None
+
+    group_sizes = Counter(record.group for record in grouped_numbers)
+    group_scores = {}
+    for record in grouped_numbers:
+        if group_sizes[record.group] >= 3 and record.group not in group_scores:
+            group_scores[record.group] = record.score
+
+    if not group_scores:
+        return None
+
+    # Chọn giống groupby('Group')['SCORE'].first().sort_values(ascending=False).index[0]:
+    # tên nhóm sắp xếp tăng dần, khi bằng điểm thứ tự do argsort (quicksort) của numpy quyết định
+    group_names = sorted(group_scores)
+    reversed_scores = np.array([group_scores[group_name] for group_name in reversed(group_names)])
+    return group_names[len(group_names) - 1 - reversed_scores.argsort(kind='quicksort')[-1]]
+
+def select_dimension_numbers(main_numbers, grouped_numbers):
+    """
+    Chọn các số dùng để suy ra kích thước:
+    - Nhóm có ≥3 số và SCORE cao nhất
+    - Không có nhóm hợp lệ → tất cả số của bảng chính
+
+    Returns:
+        tuple: (selected_numbers, grain_orientation)
+    """
+    highest_score_group = select_winning_group(grouped_numbers)
+    if highest_score_group is None:
+        return list(main_numbers), ""
+
+    group_records = [record for record in grouped_numbers if record.group == highest_score_group]
+    selected_numbers = [record.valid_number for record in group_records]
+
+    grain_orientation = ""
+    valid_grains = [record.grain_orientation for record in group_records if record.grain_orientation]
+    if valid_grains:
+        grain_orientation = Counter(valid_grains).most_common(1)[0][0]
+
+    return selected_numbers, grain_orientation
+
+def assign_length_width_height(selected_numbers):
     """
     *** CẬP NHẬT: Logic mới cho nhóm ≥3 số ***
     - Số lớn nhất → Length
     - Số nhỏ nhất → Height
     - Số gần nhỏ nhất (thứ 2 từ dưới lên) → Width
     """
-    if len(df) == 0:
-        return pd.DataFrame(columns=["Drawing#", "Length (mm)", "Width (mm)", "Height (mm)", 
-                                    "Laminate", "FOIL", "EDGEBAND", "Profile", "Profile 2", "Profile 3"])
-
-    grain_orientation = ""
-    selected_numbers = []
-    
-    if 'SCORE' in df_all_numbers.columns and len(df_all_numbers) > 0:
-        group_sizes = df_all_numbers.groupby('Group').size()
-        valid_groups = group_sizes[group_sizes >= 3].index.tolist()
-
-        if valid_groups:
-            group_scores = df_all_numbers[df_all_numbers['Group'].isin(valid_groups)].groupby('Group')['SCORE'].first().sort_values(ascending=False)
-
-            if len(group_scores) > 0:
-                highest_score_group = group_scores.index[0]
-                highest_score = group_scores.iloc[0]
-
-                high_score_group_data = df_all_numbers[df_all_numbers['Group'] == highest_score_group]
-                selected_numbers = high_score_group_data['Valid Number'].tolist()
-
-                if 'GRAIN_Orientation' in high_score_group_data.columns:
-                    grain_orientations = high_score_group_data['GRAIN_Orientation'].tolist()
-                    valid_grains = [g for g in grain_orientations if g]
-                    if valid_grains:
-                        grain_counts = Counter(valid_grains)
-                        grain_orientation = grain_counts.most_common(1)[0][0]
-            else:
-                all_numbers = df['Number_Int'].tolist()
-                selected_numbers = all_numbers
-        else:
-            all_numbers = df['Number_Int'].tolist()
-            selected_numbers = all_numbers
-    else:
-        all_numbers = df['Number_Int'].tolist()
-        selected_numbers = all_numbers
-
     length_number = ""
     width_number = ""
     height_number = ""
@@ -1692,276 +2107,3386 @@ def create_dimension_summary_with_score_priority(df, df_all_numbers):
 
     # CASE 3: Có 3 số trở lên
     elif len(unique_numbers) >= 3:
-        # *** LOGIC MỚI ***
         # unique_numbers đã được sắp xếp giảm dần: [lớn nhất, ..., nhỏ nhất]
         length_number = str(unique_numbers[0])      # Số lớn nhất
         height_number = str(unique_numbers[-1])     # Số nhỏ nhất
         width_number = str(unique_numbers[-2])      # Số gần nhỏ nhất (thứ 2 từ dưới lên)
 
-    # Trích xuất metadata
-    filename = df.iloc[0]['File']
-    drawing_name = filename.replace('.pdf', '') if filename.endswith('.pdf') else filename
-
-    profile_info = df.iloc[0]['Profile'] if 'Profile' in df.columns else ""
-    profile_2_info = df.iloc[0]['Profile 2'] if 'Profile 2' in df.columns else ""
-    profile_3_info = df.iloc[0]['Profile 3'] if 'Profile 3' in df.columns else ""
-    foil_info = df.iloc[0]['FOIL'] if 'FOIL' in df.columns else ""
-    edgeband_info = df.iloc[0]['EDGEBAND'] if 'EDGEBAND' in df.columns else ""
-    laminate_info = df.iloc[0]['Laminate'] if 'Laminate' in df.columns else ""
-
-    result_df = pd.DataFrame({
-        "Drawing#": [drawing_name],
-        "Length (mm)": [length_number],
-        "Width (mm)": [width_number],
-        "Height (mm)": [height_number],
-        "Laminate": [laminate_info],
-        "FOIL": [foil_info],
-        "EDGEBAND": [edgeband_info],
-        "Profile": [profile_info],
-        "Profile 2": [profile_2_info],
-        "Profile 3": [profile_3_info]
-    })
-
-    return result_df
+    return length_number, width_number, height_number
+
+def drawing_name_from_filename(filename):
+    """Drawing# = tên file bỏ .pdf"""
+    return filename.replace('.pdf', '') if filename.endswith('.pdf') else filename
+
+def infer_dimension_summary(filename, main_numbers, grouped_numbers, metadata=None):
+    """
+    *** MỚI: Suy ra Length/Width/Height cho 1 file từ record thuần ***
+
+    Args:
+        filename (str): Tên file PDF
+        main_numbers (list): Các số của bảng chính (Number_Int)
+        grouped_numbers (list): Các GroupedNumber của bảng phụ (theo thứ tự dòng)
+        metadata (dict): Laminate, FOIL, EDGEBAND, Profile, Profile 2, Profile 3
+
+    Returns:
+        FileSummary
+    """
+    metadata = metadata or {}
+    selected_numbers, grain_orientation = select_dimension_numbers(main_numbers, grouped_numbers)
+    length_number, width_number, height_number = assign_length_width_height(selected_numbers)
+
+    return FileSummary(
+        drawing=drawing_name_from_filename(filename),
+        length=length_number,
+        width=width_number,
+        height=height_number,
+        laminate=metadata.get('Laminate', ""),
+        foil=metadata.get('FOIL', ""),
+        edgeband=metadata.get('EDGEBAND', ""),
+        profile=metadata.get('Profile', ""),
+        profile_2=metadata.get('Profile 2', ""),
+        profile_3=metadata.get('Profile 3', "")
+    )
+
+def build_dimension_summaries(file_results):
+    """
+    Tạo FileSummary cho từng file có số ở bảng chính.
+    Thứ tự theo tên file (giống groupby("File")); các file trùng tên được gộp chung.
+    """
+    file_grouped_numbers = [grouped_numbers_from_frame(result.secondary) for result in file_results]
+
+    # Giữ cách pandas gộp cột: có 1 số thập phân thì cả cột thành float ("1200" → "1200.0")
+    main_as_float = any(isinstance(number, float) for result in file_results for number in result.main_numbers)
+    secondary_as_float = any(isinstance(record.valid_number, float) for records in file_grouped_numbers for record in records)
+
+    files = {}
+    for result, grouped_numbers in zip(file_results, file_grouped_numbers):
+        if not result.main_numbers:
+            continue
+
+        entry = files.setdefault(result.filename, {'metadata': result.metadata, 'main_numbers': [], 'grouped_numbers': []})
+        entry['main_numbers'].extend(float(number) if main_as_float else number for number in result.main_numbers)
+        entry['grouped_numbers'].extend(record._replace(valid_number=float(record.valid_number)) if secondary_as_float else record
+                                        for record in grouped_numbers)
+
+    return [infer_dimension_summary(filename, entry['main_numbers'], entry['grouped_numbers'], entry['metadata'])
+            for filename, entry in sorted(files.items())]
+
+def summaries_to_frame(summaries):
+    """Tạo bảng kết quả 1 lần từ danh sách FileSummary"""
+    return pd.DataFrame([summary.to_row() for summary in summaries], columns=SUMMARY_COLUMNS)
+
+def create_dimension_summary_with_score_priority(df, df_all_numbers):
+    """
+    Tóm tắt kích thước cho 1 file từ DataFrame bảng chính/bảng phụ
+    *** CẬP NHẬT: Chỉ chuyển DataFrame thành record rồi gọi infer_dimension_summary ***
+    """
+    if len(df) == 0:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+
+    grouped_numbers = grouped_numbers_from_frame(df_all_numbers)
+
+    metadata = {column: df.iloc[0][column] for column in ['Laminate', 'FOIL', 'EDGEBAND', 'Profile', 'Profile 2', 'Profile 3']
+                if column in df.columns}
+
+    summary = infer_dimension_summary(df.iloc[0]['File'], df['Number_Int'].tolist(), grouped_numbers, metadata)
+    return summaries_to_frame([summary])
 
 # =============================================================================
-# STREAMLIT APP MAIN - SIMPLIFIED VERSION WITH OPENPYXL - MỞ RỘNG KHU VỰC HIỂN THỊ
+# TRIAGE - LOẠI NHANH TRANG KHÔNG CÓ KÍCH THƯỚC (BÌA, BOM, BẢNG REVISION...)
 # =============================================================================
 
-def main():
-    # *** MỞ RỘNG KHU VỰC HIỂN THỊ ***
-    st.set_page_config(
-        page_title="PDF Number Extraction Tool",
-        page_icon="🔍",
-        layout="wide",  # Sử dụng wide layout
-        initial_sidebar_state="collapsed"
-    )
-    
-    st.title("🔍 PDF Number Extraction Tool")
-    st.markdown("---")
+SKIPPED_COLUMNS = ["Drawing#", "Reason"]
+
+class TriageResult(NamedTuple):
+    """Kết quả triage 1 trang"""
+    has_main_font: bool  # Bảng chính có thể chọn được font ưu tiên
+    can_group: bool      # Có thể tạo nhóm ≥3 số ở bảng phụ
+    reason: str = ""
+
+def triage_page(digit_and_dot_chars, font_registry, settings=DEFAULT_SETTINGS):
+    """
+    *** MỚI: Đánh giá nhanh trang có thể tạo nhóm kích thước ≥3 số không ***
+    Chỉ dùng số ký tự số theo font, có font F2/F3 hay không (get_font_priority) và
+    phân bố size - không phân nhóm, không tính metrics.
+
+    - Không có font F2/F3 và không font nào có ≥3 ký tự số → bảng chính không chọn được
+      font ưu tiên → file không có kết quả → bỏ qua toàn bộ
+    - Không font nào có ≥3 ký tự số → mọi điều kiện phân nhóm đều cần cùng Font Name nên
+      không thể có nhóm ≥3 số → bỏ qua phân nhóm, SCORE và tìm GRAIN
+    """
+    if not digit_and_dot_chars:
+        return TriageResult(False, False, "No digits on page")
+
+    size_histogram = Counter(c.get('size', 0) for c in digit_and_dot_chars)
+    if size_histogram.get(settings.excluded_font_size, 0) == len(digit_and_dot_chars):
+        return TriageResult(False, False, f"Only excluded {settings.excluded_font_size:g}pt digits on page")
+
+    font_summary = summarize_digit_fonts(digit_and_dot_chars, font_registry, settings)
+    max_font_count = max((entry['count'] for entry in font_summary.values()), default=0)
+
+    # Giống determine_preferred_font_with_frequency_3: F2/F3 tính cả ký tự size 20.6
+    has_f2_f3 = any(lookup_font(font_registry, c.get('fontname', 'Unknown'))['priority'] > 0
+                    for c in digit_and_dot_chars)
+
+    if not has_f2_f3 and max_font_count < 3:
+        return TriageResult(False, False, "No dimension font: no F2/F3 font and no font with ≥3 digits")
+
+    if max_font_count < 3:
+        return TriageResult(True, False, "No font with ≥3 digits: cannot form a dimension group")
+
+    return TriageResult(True, True)
+
+def build_skipped_table(file_results):
+    """Bảng các file đã bỏ qua (toàn bộ hoặc bước phân nhóm) trong chế độ triage"""
+    rows = [(drawing_name_from_filename(result.filename), result.skipped_reason)
+            for result in file_results if result.skipped_reason]
+    return pd.DataFrame(rows, columns=SKIPPED_COLUMNS)
+
+# =============================================================================
+# PDF BACKEND - ĐỌC KÝ TỰ VÀ TEXT TRANG ĐẦU (pdfplumber MẶC ĐỊNH, PyMuPDF TÙY CHỌN)
+# =============================================================================
+
+PDF_BACKEND = os.environ.get('OKE_DRAWING_PDF_BACKEND', 'pdfplumber')
+CHAR_FIELDS = ('text', 'fontname', 'size', 'x0', 'x1', 'top', 'bottom')  # Các trường ký tự pipeline đọc
+PARITY_TOLERANCE = 0.05  # Chênh lệch toạ độ/cỡ chữ (pt) tối đa vẫn coi là khớp
+PARITY_COLUMNS = ["File", "Field", "Mismatches", "Example"]
+
+@contextlib.contextmanager
+def open_first_page_pdfplumber(pdf_bytes):
+    """
+    Trang đầu bằng pdfplumber (pdfminer), None nếu PDF không có trang
+    *** CẬP NHẬT: Mở lười - chỉ duyệt cây trang tới trang đầu, không đếm/tạo Page cho các trang còn lại ***
+    pdf.pages (và pdf.close(), vốn gọi pdf.pages) tạo Page cho toàn bộ tài liệu → không dùng ở đây
+    """
+    pdf = pdfplumber.PDF(io.BytesIO(pdf_bytes))
+    try:
+        page_obj = next(PDFPage.create_pages(pdf.doc), None)
+    except Exception as e:
+        raise PdfminerException(e)
+    page = PdfplumberPage(pdf, page_obj, page_number=1, initial_doctop=0) if page_obj is not None else None
+    try:
+        yield page
+    finally:
+        if page is not None:
+            page.close()
+        pdf.flush_cache()
+
+def _import_pymupdf():
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf  # PyMuPDF < 1.24
+        except ImportError as e:
+            raise RuntimeError("The pymupdf backend needs: pip install pymupdf") from e
+    return pymupdf
+
+def mupdf_page_chars(page):
+    """
+    *** MỚI: Ký tự của trang PyMuPDF dưới dạng dict giống page.chars của pdfplumber ***
+    - bbox tính như pdfminer: [0, advance] theo baseline × [descent, descent + size] theo hướng "lên" của chữ
+    - fontname lấy lại tên đầy đủ (có tiền tố subset ABCDEF+) từ danh sách font của trang
+    """
+    basefonts = {}
+    for font in page.get_fonts():
+        basefont = font[3]
+        basefonts.setdefault(basefont.split('+', 1)[-1], basefont)
+
+    pymupdf = _import_pymupdf()
+    chars = []
+    flags = pymupdf.TEXT_PRESERVE_LIGATURES | pymupdf.TEXT_PRESERVE_WHITESPACE
+    for block in page.get_text('rawdict', flags=flags)['blocks']:
+        for line in block.get('lines', ()):
+            dx, dy = line['dir']
+            ux, uy = dy, -dx  # Hướng "lên" của chữ (trục y hướng xuống)
+            for span in line['spans']:
+                size = span['size']
+                fontname = basefonts.get(span['font'], span['font'])
+                descent = span['descender'] * size
+                for char in span['chars']:
+                    ox, oy = char['origin']
+                    bx0, by0, bx1, by1 = char['bbox']
+                    advance = (bx1 - bx0) if abs(dx) >= abs(dy) else (by1 - by0)
+                    xs = [ox + a * dx + h * ux for a in (0, advance) for h in (descent, descent + size)]
+                    ys = [oy + a * dy + h * uy for a in (0, advance) for h in (descent, descent + size)]
+                    top, bottom = min(ys), max(ys)
+                    chars.append({'text': char['c'], 'fontname': fontname, 'size': bottom - top,
+                                  'x0': min(xs), 'x1': max(xs), 'top': top, 'bottom': bottom, 'doctop': top,
+                                  'upright': dx > 0 and dy == 0})
+    return chars
+
+class MuPdfPage:
+    """Trang PyMuPDF có .chars và extract_text() như page của pdfplumber (tính khi cần, 1 lần)"""
+
+    def __init__(self, page):
+        self._page = page
+        self.width = page.rect.width
+        self.height = page.rect.height
+        self.bbox = (0, 0, self.width, self.height)
+        self._chars = None
+        self._text = None
+
+    @property
+    def chars(self):
+        if self._chars is None:
+            self._chars = mupdf_page_chars(self._page)
+        return self._chars
+
+    def extract_text(self):
+        # Cùng thuật toán ghép dòng của pdfplumber → text so sánh được giữa 2 backend
+        if self._text is None:
+            self._text = pdfplumber.utils.extract_text(self.chars, layout_bbox=self.bbox,
+                                                       layout_width=self.width, layout_height=self.height)
+        return self._text
+
+@contextlib.contextmanager
+def open_first_page_pymupdf(pdf_bytes):
+    """Trang đầu bằng PyMuPDF (MuPDF, native) - nhanh hơn ~3 lần, xem lệnh parity trước khi dùng"""
+    pymupdf = _import_pymupdf()
+    with pymupdf.open(stream=pdf_bytes, filetype='pdf') as document:
+        yield MuPdfPage(document[0]) if document.page_count else None
+
+# Tên backend → context manager mở trang đầu (thêm backend mới tại đây, ví dụ pypdfium2)
+PDF_BACKENDS = {
+    'pdfplumber': open_first_page_pdfplumber,
+    'pymupdf': open_first_page_pymupdf,
+}
+
+def resolve_pdf_backend(backend=None):
+    """Tên backend hợp lệ (None → PDF_BACKEND), báo lỗi ngay nếu thiếu thư viện"""
+    backend = backend or PDF_BACKEND
+    if backend not in PDF_BACKENDS:
+        raise ValueError(f"Unknown PDF backend: {backend} (available: {', '.join(PDF_BACKENDS)})")
+    if backend == 'pymupdf':
+        _import_pymupdf()
+    return backend
+
+def open_first_page(pdf_bytes, backend=None):
+    """Context manager → trang đầu (có .chars, extract_text()) hoặc None nếu PDF không có trang"""
+    return PDF_BACKENDS[resolve_pdf_backend(backend)](pdf_bytes)
+
+def match_page_chars(reference, candidate):
+    """
+    Ghép ký tự của 2 backend theo vị trí gần nhất (ưu tiên cùng text) trong phạm vi ~1pt
+    Returns: (các cặp khớp, ký tự chỉ có ở reference, ký tự chỉ có ở candidate)
+    """
+    buckets = collections.defaultdict(list)
+    for index, char in enumerate(candidate):
+        buckets[(round(char['x0']), round(char['top']))].append(index)
+
+    used = set()
+    pairs, missing = [], []
+    for char in reference:
+        bx, by = round(char['x0']), round(char['top'])
+        best, best_distance = None, None
+        for kx in (bx - 1, bx, bx + 1):
+            for ky in (by - 1, by, by + 1):
+                for index in buckets.get((kx, ky), ()):
+                    if index in used:
+                        continue
+                    other = candidate[index]
+                    distance = (abs(other['x0'] - char['x0']) + abs(other['top'] - char['top'])
+                                + (0 if other['text'] == char['text'] else 0.5))
+                    if best_distance is None or distance < best_distance:
+                        best, best_distance = index, distance
+        if best is None:
+            missing.append(char)
+        else:
+            used.add(best)
+            pairs.append((char, candidate[best]))
+    extra = [char for index, char in enumerate(candidate) if index not in used]
+    return pairs, missing, extra
+
+def _describe_char(char):
+    return f"'{char['text']}' at ({char['x0']:.1f}, {char['top']:.1f})"
+
+def compare_page_chars(reference, candidate, tolerance=PARITY_TOLERANCE):
+    """{trường: (số chỗ khác, ví dụ)} giữa ký tự của 2 backend"""
+    pairs, missing, extra = match_page_chars(reference, candidate)
+    differences = {}
+
+    def record(field_name, example):
+        count, first = differences.get(field_name, (0, example))
+        differences[field_name] = (count + 1, first)
+
+    for char in missing:
+        record('missing chars', _describe_char(char))
+    for char in extra:
+        record('extra chars', _describe_char(char))
+    for char, other in pairs:
+        for field_name in CHAR_FIELDS:
+            value, other_value = char.get(field_name), other.get(field_name)
+            if isinstance(value, (int, float)) and isinstance(other_value, (int, float)):
+                if abs(value - other_value) > tolerance:
+                    record(field_name, f"{_describe_char(char)}: {value:.3f} vs {other_value:.3f}")
+            elif value != other_value:
+                record(field_name, f"{_describe_char(char)}: {value!r} vs {other_value!r}")
+    return differences
+
+def compare_pdf_backends(tasks, backends=('pdfplumber', 'pymupdf'), tolerance=PARITY_TOLERANCE, settings=None):
+    """
+    *** MỚI: Kiểm tra 2 backend cho kết quả như nhau trên bộ PDF mẫu ***
+    So sánh ký tự (CHAR_FIELDS), text trang đầu và kết quả cuối (số BẢNG CHÍNH, metadata, số BẢNG PHỤ)
+
+    Args:
+        tasks: iterable (filename, pdf_bytes)
+
+    Returns:
+        DataFrame PARITY_COLUMNS - mỗi dòng là 1 trường khác nhau của 1 file (rỗng = khớp hoàn toàn)
+    """
+    reference_backend, candidate_backend = (resolve_pdf_backend(backend) for backend in backends)
+    rows = []
+    for filename, pdf_bytes in tasks:
+        try:
+            with open_first_page(pdf_bytes, reference_backend) as page:
+                reference = (list(page.chars), page.extract_text()) if page is not None else ([], "")
+            with open_first_page(pdf_bytes, candidate_backend) as page:
+                candidate = (list(page.chars), page.extract_text()) if page is not None else ([], "")
+            results = [process_pdf_file(pdf_bytes, filename, settings=settings, backend=backend)
+                       for backend in (reference_backend, candidate_backend)]
+        except Exception as e:
+            rows.append((filename, "error", 1, f"{type(e).__name__}: {e}"))
+            continue
+
+        differences = compare_page_chars(reference[0], candidate[0], tolerance)
+        if reference[1] != candidate[1]:
+            lines = list(itertools.zip_longest(reference[1].splitlines(), candidate[1].splitlines(), fillvalue=""))
+            changed = [(a, b) for a, b in lines if a != b]
+            differences['page text'] = (len(changed), f"{changed[0][0]!r} vs {changed[0][1]!r}")
+
+        # Kết quả cuối - điều người dùng thực sự thấy trong bảng tổng hợp
+        outputs = []
+        for result in results:
+            if result is None:
+                outputs.append({})
+                continue
+            secondary = result.secondary
+            output = {'main numbers': sorted(result.main_numbers),
+                      'secondary numbers': sorted(secondary['Valid Number']) if secondary is not None else []}
+            output.update((f"metadata {key}", value) for key, value in result.metadata.items())
+            outputs.append(output)
+        for key in sorted(set(outputs[0]) | set(outputs[1])):
+            value, other_value = outputs[0].get(key), outputs[1].get(key)
+            if value == other_value:
+                continue
+            if isinstance(value, list) and isinstance(other_value, list):
+                # Danh sách số → chỉ báo các số có ở 1 bên
+                only_reference = sorted((Counter(value) - Counter(other_value)).elements())
+                only_candidate = sorted((Counter(other_value) - Counter(value)).elements())
+                differences[key] = (len(only_reference) + len(only_candidate),
+                                    f"only {reference_backend}: {only_reference}, only {candidate_backend}: {only_candidate}")
+            else:
+                differences[key] = (1, f"{value!r} vs {other_value!r}")
+
+        rows.extend((filename, field_name, count, example) for field_name, (count, example) in differences.items())
+    return pd.DataFrame(rows, columns=PARITY_COLUMNS)
+
+# =============================================================================
+# METRICS - SỐ LIỆU VẬN HÀNH (PROMETHEUS TEXT FORMAT, KHÔNG CẦN prometheus_client)
+# =============================================================================
+
+METRICS_TEXTFILE = os.environ.get('OKE_DRAWING_METRICS_TEXTFILE')  # None → không ghi textfile
+METRICS_TEXTFILE_INTERVAL = 15.0  # Chu kỳ ghi textfile (giây) ~ chu kỳ scrape của Prometheus
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _metric_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _metric_labels(pairs):
+    """{name="value",...} - escape \\, " và xuống dòng theo text format"""
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Metric:
+    """1 metric với các nhãn cố định; giá trị lưu theo bộ giá trị nhãn (an toàn khi gọi từ nhiều thread)"""
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(tên sample, [(nhãn, giá trị nhãn)], giá trị)"""
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, list(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{_metric_labels(pairs)} {_metric_value(value)}" for name, pairs, value in self.samples())
+        return "\n".join(lines)
+
+class MetricCounter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class MetricHistogram(Metric):
+    """Histogram với bucket cố định: đếm theo bucket (không cộng dồn), cộng dồn khi xuất"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            pairs = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets + (math.inf,), itertools.accumulate(counts)):
+                yield f"{self.name}_bucket", pairs + [('le', _metric_value(float(bound)))], count
+            yield f"{self.name}_sum", pairs, total
+            yield f"{self.name}_count", pairs, sum(counts)
+
+class MetricGauge(Metric):
+    """Gauge đọc tại thời điểm xuất: callback() → iterable (bộ giá trị nhãn, giá trị)"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        for key, value in self.callback():
+            yield self.name, list(zip(self.labelnames, key)), value
+
+class MetricsRegistry:
+    """Các metric của process, xuất theo Prometheus text format (endpoint /metrics hoặc textfile node_exporter)"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+    def write_textfile(self, path):
+        """Ghi cho textfile collector của node_exporter: file tạm rồi đổi tên → không bao giờ đọc phải file ghi dở"""
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False, encoding='utf-8') as f:
+            f.write(self.render())
+        os.chmod(f.name, 0o644)  # node_exporter thường chạy bằng user khác
+        os.replace(f.name, path)
+
+class MetricsTextfileWriter:
+    """Thread ghi METRICS ra textfile mỗi `interval` giây và 1 lần cuối khi dừng (dùng với `with`)"""
+
+    def __init__(self, path, interval=METRICS_TEXTFILE_INTERVAL, registry=None):
+        self.path = path
+        self.interval = interval
+        self.registry = registry if registry is not None else METRICS
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='metrics-textfile', daemon=True)
+
+    def _write(self):
+        try:
+            self.registry.write_textfile(self.path)
+        except OSError as e:
+            print(f"Cannot write metrics to {self.path}: {e}", file=sys.stderr)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def __enter__(self):
+        self._write()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._write()
+        return False
+
+def metrics_textfile(path, interval=METRICS_TEXTFILE_INTERVAL):
+    """MetricsTextfileWriter tại path, context rỗng nếu không cấu hình"""
+    return MetricsTextfileWriter(path, interval) if path else contextlib.nullcontext()
+
+# *** Ghi nhận từng bước trong pipeline: thread-local → worker gửi về process chính cùng kết quả ***
+_stage_records = threading.local()
+
+@contextlib.contextmanager
+def record_stages():
+    """Thu thời gian từng bước và lượt hit/miss StageCache/TemplateCache của thread hiện tại trong khối lệnh → dict"""
+    stages = {'seconds': {}, 'cache': {}, 'nested': []}
+    previous = getattr(_stage_records, 'stages', None)
+    _stage_records.stages = stages
+    try:
+        yield stages
+    finally:
+        _stage_records.stages = previous
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """
+    Cộng thời gian riêng của khối lệnh vào bước `stage` (không làm gì nếu ngoài record_stages)
+    Thời gian của các timed_stage lồng bên trong được trừ ra → tổng các bước không bị tính trùng
+    """
+    stages = getattr(_stage_records, 'stages', None)
+    if stages is None:
+        yield
+        return
+    nested = stages['nested']
+    nested.append(0.0)  # Thời gian của các bước con
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        seconds = stages['seconds']
+        seconds[stage] = seconds.get(stage, 0.0) + elapsed - nested.pop()
+        if nested:
+            nested[-1] += elapsed
+
+def record_cache_lookup(stage, hit):
+    stages = getattr(_stage_records, 'stages', None)
+    if stages is not None:
+        key = (stage, 'hit' if hit else 'miss')
+        stages['cache'][key] = stages['cache'].get(key, 0) + 1
+
+METRICS = MetricsRegistry()
+FILES_PROCESSED = METRICS.register(MetricCounter(
+    'oke_drawing_files_total', "Files processed, by outcome (processed, duplicate, skipped, empty)", ('outcome',)))
+PAGES_SKIPPED = METRICS.register(MetricCounter(
+    'oke_drawing_pages_skipped_total', "Pages skipped by triage, whole page or only the grouping stage",
+    ('scope', 'reason')))
+FILE_FAILURES = METRICS.register(MetricCounter(
+    'oke_drawing_file_failures_total', "Files that failed, by reason (error, timeout, memory, crash)", ('reason',)))
+FILE_SECONDS = METRICS.register(MetricHistogram(
+    'oke_drawing_file_seconds', "Time to process one file on a worker, excluding the wait for a free worker"))
+STAGE_SECONDS = METRICS.register(MetricHistogram(
+    'oke_drawing_stage_seconds', "Time spent in each pipeline stage per file", ('stage',)))
+STAGE_CACHE_LOOKUPS = METRICS.register(MetricCounter(
+    'oke_drawing_stage_cache_lookups_total', "Stage and template cache lookups, by stage and result (hit, miss)",
+    ('stage', 'result')))
+DEDUP_LOOKUPS = METRICS.register(MetricCounter(
+    'oke_drawing_dedup_lookups_total', "Re-exported drawing lookups, by result (hit, miss)", ('result',)))
+
+def record_file_metrics(result, seconds, stages=None):
+    """Ghi nhận 1 file đã xử lý xong (FileResult hoặc None), thời gian và các bước (record_stages)"""
+    if result is None:
+        outcome = 'empty'
+    elif result.duplicate_of:
+        outcome = 'duplicate'
+    elif result.skipped_reason and not result.metadata:
+        outcome = 'skipped'
+    else:
+        outcome = 'processed'
+    FILES_PROCESSED.inc(outcome=outcome)
+    if result is not None and result.skipped_reason:
+        PAGES_SKIPPED.inc(scope='grouping' if result.metadata else 'page', reason=result.skipped_reason)
+    FILE_SECONDS.observe(seconds)
+    if stages:
+        for stage, stage_seconds in stages['seconds'].items():
+            STAGE_SECONDS.observe(stage_seconds, stage=stage)
+        for (stage, lookup_result), count in stages['cache'].items():
+            STAGE_CACHE_LOOKUPS.inc(count, stage=stage, result=lookup_result)
+
+# Pool đang mở trong process → gauge hàng đợi/worker (đọc lúc xuất metrics)
+_LIVE_POOLS = weakref.WeakSet()
+
+def _pool_gauge(read):
+    def callback():
+        total = Counter()
+        for pool in list(_LIVE_POOLS):
+            for key, value in read(pool):
+                total[key] += value
+        return sorted(total.items())
+    return callback
+
+METRICS.register(MetricGauge(
+    'oke_drawing_workers', "Worker processes, by state (idle, busy)",
+    _pool_gauge(lambda pool: pool.worker_counts().items()), ('state',)))
+METRICS.register(MetricGauge(
+    'oke_drawing_queue_depth', "Files waiting for a free worker",
+    _pool_gauge(lambda pool: [((), pool.queue_depth())])))
+METRICS.register(MetricGauge(
+    'oke_drawing_batches_active', "Batches currently running on the pool",
+    _pool_gauge(lambda pool: [((), len(pool.backlog()))])))
+METRICS.register(MetricGauge(
+    'oke_drawing_backlog_seconds', "Estimated processing time left in the running batches",
+    _pool_gauge(lambda pool: [((), sum(remaining for _, remaining in pool.backlog()))])))
+
+# =============================================================================
+# PER-FILE PIPELINE - XỬ LÝ 1 FILE PDF (TÁCH TỪ main())
+# =============================================================================
+
+@dataclass(slots=True)
+class FileResult:
+    """*** MỚI: Kết quả xử lý 1 file PDF (trang đầu tiên) ***"""
+    filename: str
+    main_numbers: list = field(default_factory=list)  # Số của BẢNG CHÍNH (Number_Int)
+    secondary: object = None  # BẢNG PHỤ đã phân nhóm, có SCORE và GRAIN_Orientation (DataFrame)
+    metadata: dict = field(default_factory=dict)  # Profile, Profile 2, Profile 3, FOIL, EDGEBAND, Laminate
+    skipped_reason: str = ""  # Lý do bỏ qua khi chạy chế độ triage
+    duplicate_of: str = ""  # File đã xử lý có cùng nội dung trang đầu → kết quả được dùng lại (DrawingIndex)
+
+# Cột của BẢNG PHỤ ← thuộc tính của ExtractedNumber
+SECONDARY_NUMBER_COLUMNS = [
+    ("Valid Number", 'number'),
+    ("Font Name", 'fontname'),
+    ("Font Weight", 'font_weight'),
+    ("Orientation", 'orientation'),
+    ("Position_X", 'x_pos'),
+    ("Position_Y", 'y_pos'),
+    ("Chars_Count", 'chars_count'),
+    # 8 CHỈ SỐ KHÁC BIỆT (ĐÃ XOAY TẠI NGUỒN)
+    ("Font_Size", 'font_size'),
+    ("Char_Width", 'char_width'),
+    ("Char_Height", 'char_height'),
+    ("Density_Score", 'density_score'),
+    ("Distance_Origin", 'distance_from_origin'),
+    ("Aspect_Ratio", 'aspect_ratio'),
+    ("Char_Spacing", 'char_spacing'),
+    ("Text_Angle", 'text_angle')
+]
+
+def numbers_to_frame(filename, numbers):
+    """Chuyển danh sách ExtractedNumber thành BẢNG PHỤ dạng cột (chỉ tạo DataFrame tại đây)"""
+    columns = {"File": [filename] * len(numbers)}
+    for column, attribute in SECONDARY_NUMBER_COLUMNS:
+        values = [getattr(number, attribute) for number in numbers]
+        if attribute in ('x_pos', 'y_pos'):
+            values = [round(value, 1) for value in values]
+        columns[column] = values
+    columns["Index"] = list(range(1, len(numbers) + 1))
+    return pd.DataFrame(columns)
+
+def score_secondary_groups(df_file_secondary, settings=DEFAULT_SETTINGS):
+    """Tính SCORE cho từng GROUP của BẢNG PHỤ đã phân nhóm"""
+    df_file_secondary['SCORE'] = 0
+    for group_name in df_file_secondary['Group'].unique():
+        if group_name not in ['UNGROUPED', 'INSUFFICIENT_DATA', 'ERROR']:
+            group_data = df_file_secondary[df_file_secondary['Group'] == group_name]
+            score = calculate_score_for_group(group_data, settings)
+            df_file_secondary.loc[df_file_secondary['Group'] == group_name, 'SCORE'] = score
+    return df_file_secondary
+
+def find_grain_for_best_group(df_file_secondary, glyph_index, settings=DEFAULT_SETTINGS):
+    """Tìm GRAIN (trên PageGlyphIndex) cho group có SCORE cao nhất của BẢNG PHỤ đã chấm điểm"""
+    df_file_secondary['GRAIN_Orientation'] = ""
     
-    # Upload files
-    uploaded_files = st.file_uploader(
-        "Upload PDF files", 
-        type=['pdf'], 
-        accept_multiple_files=True,
-        help="Select one or more PDF files to process"
-    )
+    # *** MỚI: Tìm group có score cao nhất VÀ có ít nhất 3 thành viên ***
+    group_sizes = df_file_secondary.groupby('Group').size()
+    valid_groups = group_sizes[group_sizes >= 3].index.tolist()
     
-    if uploaded_files:
-        st.success(f"Uploaded {len(uploaded_files)} file(s)")
+    if valid_groups:
+        group_scores = df_file_secondary[df_file_secondary['Group'].isin(valid_groups)].groupby('Group')['SCORE'].first().sort_values(ascending=False)
         
-        if st.button("🚀 Process Files", type="primary"):
-            # Initialize result arrays
-            main_table_results = []  # Cho bảng chính
-            secondary_table_results = []  # Cho bảng phụ
+        if len(group_scores) > 0:
+            highest_score_group = group_scores.index[0]
             
-            # Progress bar
-            progress_bar = st.progress(0)
-            status_text = st.empty()
+            group_data = df_file_secondary[df_file_secondary['Group'] == highest_score_group]
             
-            # XỬ LÝ TỪNG FILE RIÊNG BIỆT
-            for file_idx, uploaded_file in enumerate(uploaded_files):
-                filename = uploaded_file.name
-                progress = (file_idx + 1) / len(uploaded_files)
-                progress_bar.progress(progress)
-                status_text.text(f"Processing {filename}...")
+            if len(group_data) > 0:
+                # Tìm GRAIN cho nhóm
+                found_idx, grain_orientation = search_grain_text_for_group_by_priority(
+                    glyph_index, group_data, settings.grain_search_distance, settings.grain_axis_tolerance,
+                    settings.orientation_ratio)
                 
-                # Read PDF from uploaded file
-                pdf_bytes = uploaded_file.read()
-                
-                with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-                    total_pages = len(pdf.pages)
-                    
-                    if total_pages == 0:
-                        continue
-                    
-                    # *** CHỈ XỬ LÝ TRANG ĐẦU TIÊN ***
-                    page = pdf.pages[0]
-                    
-                    # *** CẬP NHẬT: Trích xuất 3 profile ***
-                    profile_info, profile_2_info, profile_3_info = extract_profile_from_page(page)
-                    
-                    # Trích xuất thông tin FOIL classification và detail
-                    foil_classification, foil_detail = extract_foil_classification_with_detail(page)
-                    
-                    # Trích xuất thông tin EDGEBAND classification và detail
-                    edgeband_classification, edgeband_detail = extract_edgeband_classification_with_detail(page)
-                    
-                    # *** CẬP NHẬT: Trích xuất thông tin LAMINATE classification với logic mới - ĐỂ TRỐNG NẾU CHỈ CÓ 1 KEYWORD ***
-                    laminate_classification, laminate_detail = extract_laminate_classification_with_detail(page)
-                    
-                    # *** TRUYỀN FILENAME VÀO HÀM TRÍCH XUẤT ***
-                    char_numbers, char_orientations, font_info = extract_numbers_and_decimals_from_chars(page, filename)
-                    
-                    # *** TRUYỀN FILENAME VÀO HÀM TRÍCH XUẤT TẤT CẢ SỐ ***
-                    all_valid_numbers = extract_all_valid_numbers_from_page(page, filename)
-                    
-                    # Xử lý kết quả cho BẢNG CHÍNH
-                    file_main_results = []
-                    for i, number in enumerate(char_numbers):
-                        key = f"{number}_{i+1}"
-                        orientation = char_orientations.get(key, 'Horizontal')
-                        fontname = font_info.get(key, {}).get('fontname', 'Unknown')
-                        font_weight = font_info.get(key, {}).get('font_weight', 'Unknown')
-                        
-                        file_main_results.append({
-                            "File": filename,
-                            "Number": str(number),
-                            "Font Name": fontname,
-                            "Font Weight": font_weight,
-                            "Orientation": orientation,
-                            "Number_Int": number,
-                            "Profile": profile_info,
-                            "Profile 2": profile_2_info,
-                            "Profile 3": profile_3_info,  # *** NEW COLUMN ***
-                            "FOIL": foil_classification,
-                            "EDGEBAND": edgeband_classification,
-                            "Laminate": laminate_classification,  # *** SỬ DỤNG LOGIC MỚI - ĐỂ TRỐNG NẾU CHỈ CÓ 1 KEYWORD ***
-                            "Index": i+1
-                        })
-                    
-                    # Xử lý kết quả cho BẢNG PHỤ (tất cả số hợp lệ) - METRICS ĐÃ XOAY TẠI NGUỒN
-                    file_secondary_results = []
-                    for i, number_info in enumerate(all_valid_numbers):
-                        file_secondary_results.append({
-                            "File": filename,
-                            "Valid Number": number_info['number'],
-                            "Font Name": number_info['fontname'],
-                            "Font Weight": number_info['font_weight'],
-                            "Orientation": number_info['orientation'],
-                            "Position_X": round(number_info['x_pos'], 1),
-                            "Position_Y": round(number_info['y_pos'], 1),
-                            "Chars_Count": number_info['chars_count'],
-                            # 8 CHỈ SỐ KHÁC BIỆT (ĐÃ XOAY TẠI NGUỒN)
-                            "Font_Size": number_info['font_size'],
-                            "Char_Width": number_info['char_width'],
-                            "Char_Height": number_info['char_height'],
-                            "Density_Score": number_info['density_score'],
-                            "Distance_Origin": number_info['distance_from_origin'],
-                            "Aspect_Ratio": number_info['aspect_ratio'],
-                            "Char_Spacing": number_info['char_spacing'],
-                            "Text_Angle": number_info['text_angle'],
-                            "Index": i+1,
-                            "Page": page  # Lưu page để tìm GRAIN
-                        })
-                    
-                    # XỬ LÝ BẢNG PHỤ CHO FILE NÀY
-                    if file_secondary_results:
-                        df_file_secondary = pd.DataFrame(file_secondary_results)
-                        
-                        # Phân nhóm và tính score
-                        df_file_secondary = group_numbers_by_font_characteristics(df_file_secondary)
-                        
-                        # Tính SCORE cho từng GROUP
-                        df_file_secondary['SCORE'] = 0
-                        for group_name in df_file_secondary['Group'].unique():
-                            if group_name not in ['UNGROUPED', 'INSUFFICIENT_DATA', 'ERROR']:
-                                group_data = df_file_secondary[df_file_secondary['Group'] == group_name]
-                                score = calculate_score_for_group(group_data)
-                                df_file_secondary.loc[df_file_secondary['Group'] == group_name, 'SCORE'] = score
-                        
-                        # Tìm GRAIN cho group có score cao nhất
-                        df_file_secondary['GRAIN_Orientation'] = ""
-                        
-                        # *** MỚI: Tìm group có score cao nhất VÀ có ít nhất 3 thành viên ***
-                        group_sizes = df_file_secondary.groupby('Group').size()
-                        valid_groups = group_sizes[group_sizes >= 3].index.tolist()
-                        
-                        if valid_groups:
-                            group_scores = df_file_secondary[df_file_secondary['Group'].isin(valid_groups)].groupby('Group')['SCORE'].first().sort_values(ascending=False)
-                            
-                            if len(group_scores) > 0:
-                                highest_score_group = group_scores.index[0]
-                                
-                                group_data = df_file_secondary[df_file_secondary['Group'] == highest_score_group]
-                                
-                                if len(group_data) > 0:
-                                    # Lấy page object từ record đầu tiên
-                                    page = group_data['Page'].iloc[0]
-                                    
-                                    # Tìm GRAIN cho nhóm
-                                    found_idx, grain_orientation = search_grain_text_for_group_by_priority(page, group_data)
-                                    
-                                    if found_idx is not None and grain_orientation:
-                                        df_file_secondary.loc[found_idx, 'GRAIN_Orientation'] = grain_orientation
-                        
-                        # Dọn dẹp cột Page
-                        df_file_secondary = df_file_secondary.drop(columns=['Page'])
-                        
-                        # Thêm vào kết quả tổng
-                        secondary_table_results.extend(df_file_secondary.to_dict('records'))
-                    
-                    # Thêm kết quả bảng chính vào tổng
-                    main_table_results.extend(file_main_results)
+                if found_idx is not None and grain_orientation:
+                    df_file_secondary.loc[found_idx, 'GRAIN_Orientation'] = grain_orientation
+    
+    return df_file_secondary
+
+def group_and_score_secondary_table(df_file_secondary, glyph_index, settings=DEFAULT_SETTINGS):
+    """Phân nhóm, tính SCORE và tìm GRAIN (trên PageGlyphIndex) cho BẢNG PHỤ của 1 file"""
+    df_file_secondary = group_numbers_by_font_characteristics(df_file_secondary, settings)
+    df_file_secondary = score_secondary_groups(df_file_secondary, settings)
+    return find_grain_for_best_group(df_file_secondary, glyph_index, settings)
+
+# *** MỚI: Kết quả trung gian của từng bước - dữ liệu thuần, lưu được vào StageCache ***
+
+@dataclass(slots=True)
+class CharTable:
+    """Ký tự số/dấu chấm của trang đầu + bảng phân loại font; có thuộc tính .chars như page object"""
+    chars: list
+    font_registry: dict
+
+@dataclass(slots=True)
+class PageStage:
+    """Thông tin không phụ thuộc ngưỡng của trang đầu: Profile/FOIL/EDGEBAND/Laminate và chỉ mục GRAIN"""
+    metadata: dict
+    glyph_index: PageGlyphIndex = None
+    fingerprint: str = ""  # glyph_fingerprint của trang (chỉ tính khi đọc qua StageCache)
+
+@dataclass(slots=True)
+class NumberStage:
+    """Số của BẢNG CHÍNH và các số hợp lệ (đã có metrics) của BẢNG PHỤ"""
+    main_numbers: list = field(default_factory=list)
+    secondary: list = field(default_factory=list)  # ExtractedNumber
+    skipped_reason: str = ""
+    skipped: bool = False  # Triage: trang không có font kích thước → bỏ qua cả file
+    checked_numbers: frozenset = frozenset()  # Các số đã kiểm tra với tên file (is_number_excluded)
+
+def build_char_table(page):
+    """Bảng ký tự số/dấu chấm của trang; font được phân loại trên toàn bộ ký tự của trang"""
+    chars = page.chars
+    return CharTable(chars=[c for c in chars if c['text'].isdigit() or c['text'] == '.'],
+                     font_registry=build_font_registry(chars))
+
+def build_page_stage(page, glyph_index=True, notes_band=None):
+    """
+    Trích text 1 lần rồi đọc Profile/FOIL/EDGEBAND/Laminate (và chỉ mục GRAIN nếu cần) từ page
+    *** MỚI: notes_band (TemplateCache) → khi không cần chỉ mục GRAIN chỉ trích text của dải ghi chú ***
+    """
+    page_text = None
+    if notes_band is not None and not glyph_index:
+        page_text = extract_notes_text(page, notes_band)
+    if page_text is None:
+        try:
+            page_text = page.extract_text()
+        except Exception:
+            page_text = None
+    
+    # *** CẬP NHẬT: Trích xuất 3 profile ***
+    profile_info, profile_2_info, profile_3_info = extract_profile_from_page(page, page_text)
+    
+    # Trích xuất thông tin FOIL classification và detail
+    foil_classification, foil_detail = extract_foil_classification_with_detail(page, page_text)
+    
+    # Trích xuất thông tin EDGEBAND classification và detail
+    edgeband_classification, edgeband_detail = extract_edgeband_classification_with_detail(page, page_text)
+    
+    # *** CẬP NHẬT: Trích xuất thông tin LAMINATE classification với logic mới - ĐỂ TRỐNG NẾU CHỈ CÓ 1 KEYWORD ***
+    laminate_classification, laminate_detail = extract_laminate_classification_with_detail(page, page_text)
+    
+    metadata = {
+        "Profile": profile_info,
+        "Profile 2": profile_2_info,
+        "Profile 3": profile_3_info,
+        "FOIL": foil_classification,
+        "EDGEBAND": edgeband_classification,
+        "Laminate": laminate_classification  # *** ĐỂ TRỐNG NẾU CHỈ CÓ 1 KEYWORD ***
+    }
+    return PageStage(metadata=metadata, glyph_index=build_page_glyph_index(page, page_text) if glyph_index else None)
+
+def extract_number_stage(char_table, filename, triage=False, settings=DEFAULT_SETTINGS, preferred_font=None):
+    """
+    Triage (nếu bật) rồi trích xuất số cho BẢNG CHÍNH và BẢNG PHỤ từ CharTable
+    preferred_font: font kích thước của template (TemplateCache), None → chọn từ trang
+    """
+    # *** MỚI: Chuẩn hoá tên file 1 lần, dùng chung cho cả 2 lượt trích xuất ***
+    filename_exclusion = build_filename_exclusion(filename)
+    filename_exclusion['checked_numbers'] = set()
+    font_registry = char_table.font_registry
+    
+    # *** MỚI: TRIAGE - trang không có font kích thước thì bỏ qua toàn bộ ***
+    verdict = None
+    if triage:
+        verdict = triage_page(char_table.chars, font_registry, settings)
+        if not verdict.has_main_font:
+            return NumberStage(skipped_reason=verdict.reason, skipped=True)
+    
+    # *** TRUYỀN FILENAME VÀO HÀM TRÍCH XUẤT ***
+    char_numbers, char_orientations, font_info = extract_numbers_and_decimals_from_chars(char_table, filename, font_registry, filename_exclusion, settings,
+                                                                                         preferred_font)
+    
+    # *** TRUYỀN FILENAME VÀO HÀM TRÍCH XUẤT TẤT CẢ SỐ ***
+    # *** TRIAGE: không thể có nhóm ≥3 số thì bỏ qua bảng phụ (phân nhóm, SCORE, GRAIN) ***
+    if verdict is None or verdict.can_group:
+        all_valid_numbers = extract_all_valid_numbers_from_page(char_table, filename, font_registry, filename_exclusion, settings)
+    else:
+        all_valid_numbers = []
+    
+    return NumberStage(main_numbers=list(char_numbers), secondary=all_valid_numbers,
+                       skipped_reason=verdict.reason if verdict is not None else "",
+                       checked_numbers=frozenset(filename_exclusion['checked_numbers']))
+
+def build_file_result(filename, page_stage, number_stage):
+    """FileResult (chưa có BẢNG PHỤ) từ kết quả các bước"""
+    if number_stage.skipped:
+        return FileResult(filename=filename, skipped_reason=number_stage.skipped_reason)
+    return FileResult(filename=filename, main_numbers=list(number_stage.main_numbers),
+                      metadata=dict(page_stage.metadata), skipped_reason=number_stage.skipped_reason)
+
+def process_pdf_file(pdf_bytes, filename, triage=False, settings=None, stage_cache=None, drawing_index=None,
+                     backend=None, template_cache=None):
+    """
+    *** MỚI: Xử lý 1 file PDF - CHỈ TRANG ĐẦU TIÊN ***
+
+    Args:
+        pdf_bytes (bytes): Nội dung file PDF
+        filename (str): Tên file PDF
+        triage (bool): Bỏ qua sớm trang không thể tạo nhóm kích thước (triage_page)
+        settings (ExtractionSettings): Các ngưỡng trích xuất (None → DEFAULT_SETTINGS)
+        stage_cache (StageCache): Cache kết quả từng bước (None → chạy toàn bộ pipeline)
+        drawing_index (DrawingIndex): Bản vẽ đã xử lý có cùng glyph_fingerprint → dùng lại kết quả
+        backend (str): Thư viện đọc PDF trong PDF_BACKENDS (None → PDF_BACKEND)
+        template_cache (TemplateCache): Font/vùng đã học của template CAD → đường tắt (không dùng khi có stage_cache)
+
+    Returns:
+        FileResult, hoặc None nếu file không có trang nào
+    """
+    if settings is None:
+        settings = DEFAULT_SETTINGS
+    if stage_cache is not None:
+        return process_pdf_file_staged(pdf_bytes, filename, triage, settings, stage_cache, drawing_index, backend)
+
+    # *** CẬP NHẬT: Chỉ giữ PDF mở trong lúc trích xuất, sau đó chỉ dùng dữ liệu thuần ***
+    # *** CHỈ XỬ LÝ TRANG ĐẦU TIÊN *** (qua backend đọc PDF đã chọn)
+    with open_first_page(pdf_bytes, backend) as page:
+        if page is None:
+            return None
+        
+        # Backend phân tích ký tự ở lần đọc page.chars đầu tiên
+        with timed_stage('parse'):
+            chars = page.chars
+        
+        # *** MỚI: Bản xuất lại của bản vẽ đã xử lý (cùng glyph) → dùng lại kết quả, không chạy pipeline ***
+        fingerprint = glyph_fingerprint(chars) if drawing_index is not None else ""
+        if fingerprint:
+            duplicate = drawing_index.lookup(fingerprint, filename, triage, settings)
+            if duplicate is not None:
+                return duplicate
+        
+        # *** MỚI: Phân loại font 1 lần cho cả 2 lượt trích xuất ***
+        notes_band = None
+        with timed_stage('numbers'):
+            char_table = build_char_table(page)
+            if template_cache is not None:
+                number_stage, notes_band = extract_number_stage_with_template(page, char_table, filename, triage,
+                                                                              settings, template_cache)
+            else:
+                number_stage = extract_number_stage(char_table, filename, triage, settings)
+        if number_stage.skipped:
+            return build_file_result(filename, None, number_stage)
+        
+        # *** MỚI: Chỉ mục ký tự GRAIN thay cho page object ***
+        with timed_stage('page'):
+            page_stage = build_page_stage(page, glyph_index=bool(number_stage.secondary), notes_band=notes_band)
+    
+    file_result = build_file_result(filename, page_stage, number_stage)
+    
+    # XỬ LÝ BẢNG PHỤ CHO FILE NÀY (tất cả số hợp lệ) - METRICS ĐÃ XOAY TẠI NGUỒN
+    if number_stage.secondary:
+        with timed_stage('secondary'):
+            file_result.secondary = group_and_score_secondary_table(numbers_to_frame(filename, number_stage.secondary),
+                                                                    page_stage.glyph_index, settings)
+    
+    if fingerprint:
+        drawing_index.add(fingerprint, triage, settings, file_result, number_stage.checked_numbers)
+    return file_result
+
+# =============================================================================
+# STAGE CACHE - LƯU KẾT QUẢ TỪNG BƯỚC, ĐỔI NGƯỠNG CHỈ CHẠY LẠI CÁC BƯỚC SAU
+# =============================================================================
+
+STAGE_CACHE_DIR = os.environ.get('OKE_DRAWING_STAGE_CACHE')  # None → không dùng cache
+STAGE_CACHE_VERSION = 2  # Tăng khi thay đổi thuật toán của 1 bước → bỏ toàn bộ cache cũ
+
+# Ngưỡng mà mỗi bước đọc → khóa của bước chỉ đổi khi các ngưỡng này (hoặc bước trước) đổi
+STAGE_SETTINGS = {
+    'page': (),
+    'chars': (),
+    'numbers': ('excluded_font_size', 'char_distance', 'mixed_font_char_distance', 'vertical_alignment',
+                'horizontal_alignment', 'orientation_ratio', 'min_decimal_value', 'max_dimension'),
+    'groups': ('excluded_font_size', 'height_tolerance'),
+    'scores': ('score_three_numbers', 'score_five_numbers', 'score_uniform_spacing', 'spacing_tolerance',
+               'score_hv_mix'),
+    'grain': ('grain_search_distance', 'grain_axis_tolerance'),
+}
+
+_MISSING = object()
+
+class StageCache:
+    """
+    *** MỚI: Cache trên đĩa cho kết quả từng bước của process_pdf_file ***
+    Chuỗi bước: page/chars (theo nội dung PDF) → numbers (trích số + metrics) → groups (nhóm font)
+    → scores (SCORE) → grain (GRAIN_Orientation). Khóa của 1 bước = khóa bước trước + các ngưỡng
+    bước đó đọc → đổi trọng số SCORE chỉ chạy lại scores và grain trên groups đã lưu, không mở lại PDF.
+    Mỗi kết quả là 1 file pickle, ghi qua file tạm + os.replace → nhiều worker dùng chung an toàn.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def stage_key(stage, upstream_key, settings=None):
+        digest = hashlib.sha256(f"{STAGE_CACHE_VERSION}\0{stage}\0{upstream_key}\0".encode('utf-8'))
+        if settings is not None:
+            for name in STAGE_SETTINGS[stage]:
+                digest.update(f"{name}={getattr(settings, name)!r}\0".encode('utf-8'))
+        return digest.hexdigest()
+
+    def _artifact_path(self, stage, key):
+        return os.path.join(self.path, stage, key[:2], key + '.pkl')
+
+    def load(self, stage, key):
+        """Kết quả đã lưu, hoặc _MISSING (chưa có hoặc file hỏng)"""
+        try:
+            with open(self._artifact_path(stage, key), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # Chưa có, hoặc file hỏng (ghi dở/khác phiên bản) → tính lại
+            return _MISSING
+
+    def store(self, stage, key, value):
+        path = self._artifact_path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+        return value
+
+    def fetch(self, stage, key, compute):
+        """
+        Kết quả đã lưu của bước, nếu chưa có thì compute() rồi lưu lại
+        Thời gian của bước không gồm các bước trước nó phải tính lại (fetch lồng nhau có timed_stage riêng)
+        """
+        value = self.load(stage, key)
+        record_cache_lookup(stage, value is not _MISSING)
+        if value is _MISSING:
+            with timed_stage(stage):
+                value = self.store(stage, key, compute())
+        return value
+
+def open_stage_cache(path=STAGE_CACHE_DIR):
+    """StageCache tại path, None nếu không cấu hình"""
+    return StageCache(path) if path else None
+
+def read_page_stages(pdf_bytes, backend=None):
+    """Mở PDF 1 lần → (PageStage, CharTable) của trang đầu, (None, None) nếu không có trang"""
+    with open_first_page(pdf_bytes, backend) as page:
+        if page is None:
+            return None, None
+        page_stage = build_page_stage(page)
+        page_stage.fingerprint = glyph_fingerprint(page.chars)
+        return page_stage, build_char_table(page)
+
+def process_pdf_file_staged(pdf_bytes, filename, triage, settings, stage_cache, drawing_index=None, backend=None):
+    """process_pdf_file qua StageCache - chỉ chạy các bước có khóa chưa có trong cache"""
+    # Ký tự phụ thuộc backend → backend là một phần của khóa bước đầu
+    page_key = hashlib.sha256(resolve_pdf_backend(backend).encode('utf-8') + b'\0' + pdf_bytes).hexdigest()
+    
+    def read_pdf():
+        page_stage, char_table = read_page_stages(pdf_bytes, backend)
+        if char_table is not None:
+            stage_cache.store('chars', page_key, char_table)
+        return page_stage
+    
+    page_stage = stage_cache.fetch('page', page_key, read_pdf)
+    if page_stage is None:
+        return None
+    
+    fingerprint = page_stage.fingerprint if drawing_index is not None else ""
+    if fingerprint:
+        duplicate = drawing_index.lookup(fingerprint, filename, triage, settings)
+        if duplicate is not None:
+            return duplicate
+    
+    numbers_key = StageCache.stage_key('numbers', f"{page_key}\0{filename}\0{int(bool(triage))}", settings)
+    
+    def extract_numbers():
+        char_table = stage_cache.fetch('chars', page_key, lambda: read_page_stages(pdf_bytes, backend)[1])
+        return extract_number_stage(char_table, filename, triage, settings)
+    
+    number_stage = stage_cache.fetch('numbers', numbers_key, extract_numbers)
+    file_result = build_file_result(filename, page_stage, number_stage)
+    if number_stage.skipped:
+        return file_result
+    if number_stage.secondary:
+        file_result.secondary = run_secondary_stages(filename, number_stage, page_stage, numbers_key, settings,
+                                                     stage_cache)
+    
+    if fingerprint:
+        drawing_index.add(fingerprint, triage, settings, file_result, number_stage.checked_numbers)
+    return file_result
+
+def run_secondary_stages(filename, number_stage, page_stage, numbers_key, settings, stage_cache):
+    """groups → scores → grain của BẢNG PHỤ, mỗi bước dùng lại kết quả đã lưu nếu khóa không đổi"""
+    groups_key = StageCache.stage_key('groups', numbers_key, settings)
+    scores_key = StageCache.stage_key('scores', groups_key, settings)
+    grain_key = StageCache.stage_key('grain', scores_key, settings)
+    
+    def group():
+        return group_numbers_by_font_characteristics(numbers_to_frame(filename, number_stage.secondary), settings)
+    
+    def score():
+        return score_secondary_groups(stage_cache.fetch('groups', groups_key, group), settings)
+    
+    def grain():
+        return find_grain_for_best_group(stage_cache.fetch('scores', scores_key, score), page_stage.glyph_index, settings)
+    
+    return stage_cache.fetch('grain', grain_key, grain)
+
+# =============================================================================
+# DRAWING DEDUP - BẢN XUẤT LẠI CỦA CÙNG BẢN VẼ DÙNG LẠI KẾT QUẢ
+# =============================================================================
+
+FINGERPRINT_PRECISION = 2  # Số chữ số thập phân của tọa độ/size (pt) khi tính dấu vân tay
+DRAWING_INDEX_SIZE = 1000  # Số bản vẽ gần nhất giữ trong DrawingIndex
+
+def glyph_fingerprint(chars):
+    """
+    *** MỚI: Dấu vân tay nội dung trang từ danh sách ký tự ***
+    SHA-256 của các bộ (text, font, size, x0, top, x1, bottom) đã làm tròn và sắp xếp → xuất lại PDF
+    (timestamp, producer, thứ tự object khác) vẫn cho cùng dấu vân tay. Trang không có ký tự → "".
+    """
+    digits = FINGERPRINT_PRECISION
+    glyphs = sorted(
+        (c.get('text', ''), c.get('fontname', ''), round(c.get('size', 0), digits),
+         round(c.get('x0', 0), digits), round(c.get('top', 0), digits),
+         round(c.get('x1', 0), digits), round(c.get('bottom', 0), digits))
+        for c in chars
+    )
+    if not glyphs:
+        return ""
+    digest = hashlib.sha256()
+    for glyph in glyphs:
+        digest.update(repr(glyph).encode('utf-8'))
+    return digest.hexdigest()
+
+def copy_file_result(result, filename):
+    """Bản sao FileResult của bản vẽ đã xử lý, đổi sang tên file mới"""
+    secondary = None
+    if result.secondary is not None:
+        secondary = result.secondary.copy()
+        secondary['File'] = filename
+    return FileResult(filename=filename, main_numbers=list(result.main_numbers), secondary=secondary,
+                      metadata=dict(result.metadata), skipped_reason=result.skipped_reason,
+                      duplicate_of=result.filename)
+
+class DrawingIndex:
+    """
+    *** MỚI: Kết quả của các bản vẽ đã xử lý, tra theo glyph_fingerprint (+ triage, bộ ngưỡng) ***
+    Kết quả phụ thuộc tên file qua bộ lọc số có trong tên file → chỉ dùng lại khi tên file mới
+    cho cùng kết quả lọc với mọi số đã kiểm tra (bản R16/R17 của cùng bản vẽ vẫn dùng lại được).
+    Giữ DRAWING_INDEX_SIZE bản vẽ gần nhất; an toàn khi gọi từ nhiều thread.
+    """
+
+    def __init__(self, max_size=DRAWING_INDEX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self._entries = collections.OrderedDict()  # khóa → [(FileResult, số đã kiểm tra, số bị lọc)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(fingerprint, triage, settings):
+        return fingerprint, bool(triage), (settings or DEFAULT_SETTINGS).fingerprint()
+
+    def lookup(self, fingerprint, filename, triage=False, settings=None):
+        """Bản sao kết quả đã có cho filename, hoặc None"""
+        filename_exclusion = build_filename_exclusion(filename)
+        with self._lock:
+            entries = self._entries.get(self._key(fingerprint, triage, settings))
+            if not entries:
+                DEDUP_LOOKUPS.inc(result='miss')
+                return None
+            self._entries.move_to_end(self._key(fingerprint, triage, settings))
+            for result, checked_numbers, excluded_numbers in entries:
+                if all((number in excluded_numbers) == is_number_excluded(number, filename_exclusion)
+                       for number in checked_numbers):
+                    self.hits += 1
+                    break
+            else:
+                DEDUP_LOOKUPS.inc(result='miss')
+                return None
+        DEDUP_LOOKUPS.inc(result='hit')
+        return copy_file_result(result, filename)
+
+    def add(self, fingerprint, triage, settings, result, checked_numbers):
+        filename_exclusion = build_filename_exclusion(result.filename)
+        excluded_numbers = frozenset(number for number in checked_numbers
+                                     if is_number_excluded(number, filename_exclusion))
+        key = self._key(fingerprint, triage, settings)
+        with self._lock:
+            self._entries.setdefault(key, []).append((result, frozenset(checked_numbers), excluded_numbers))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+class _PipeDrawingIndex:
+    """DrawingIndex của process chính, dùng từ worker qua pipe của worker (xem DrawingWorkerPool.run)"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def lookup(self, fingerprint, filename, triage=False, settings=None):
+        self._conn.send(('lookup', fingerprint))
+        record = self._conn.recv()
+        return file_result_from_record(record) if record is not None else None
+
+    def add(self, fingerprint, triage, settings, result, checked_numbers):
+        self._conn.send(('add', fingerprint, checked_numbers))
+
+# =============================================================================
+# TEMPLATE CACHE - BẢN VẼ CÙNG TEMPLATE CAD DÙNG LẠI FONT VÀ VÙNG ĐÃ HỌC
+# =============================================================================
+
+TEMPLATE_CACHE_SIZE = 256  # Số template gần nhất giữ trong TemplateCache
+TEMPLATE_LEARN_FILES = 2  # Số file cùng template (cùng font kích thước) phải học trước khi đi đường tắt
+TEMPLATE_REGION_MARGIN = 20.0  # Nới vùng kích thước/dải ghi chú đã học khi kiểm tra file mới (pt)
+TEMPLATE_MAX_FALLBACKS = 3  # Số lần đường tắt bị bác bỏ trước khi bỏ template và học lại
+FONT_SUBSET_PATTERN = re.compile(r'^[A-Z]{6}\+')  # Tiền tố subset (ABCDEF+) khác nhau giữa các file
+# Từ khóa Profile/FOIL/EDGEBAND/Laminate đọc từ text → dải ghi chú phải chứa mọi lần xuất hiện
+# So khớp nguyên từ: RAW/LAM là ghi chú laminate, không phải 1 phần của DRAWING/CLAMP
+NOTE_KEYWORDS = ('PROFILE', 'FOIL', 'LIOF', 'LONG', 'SHORT', 'EDGEBAND', 'DNABEGDE', 'LAM', 'RAW', 'FLEX')
+NOTE_WORD_TOLERANCE = 3.0  # Khoảng cách tối đa giữa 2 chữ liền nhau của 1 từ (x_tolerance/y_tolerance của pdfplumber)
+
+def normalize_fontname(fontname):
+    """Tên font bỏ tiền tố subset → cùng 1 font ở các file khác nhau có cùng tên"""
+    return FONT_SUBSET_PATTERN.sub('', fontname or '')
+
+def template_key(page):
+    """
+    *** MỚI: Khóa template CAD của trang: tập font (đã bỏ tiền tố subset) + kích thước trang ***
+    Trang không có ký tự → "" (không nhận diện)
+    """
+    fonts = sorted({normalize_fontname(fontname) for fontname in {c.get('fontname', '') for c in page.chars}})
+    if not fonts:
+        return ""
+    digest = hashlib.sha256(f"{round(page.width)}x{round(page.height)}\0".encode('utf-8'))
+    for fontname in fonts:
+        digest.update(fontname.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+def union_box(box, other):
+    """Hộp bao của 2 hộp (x0, top, x1, bottom) hoặc 2 dải (top, bottom); None = rỗng"""
+    if box is None:
+        return other
+    if other is None:
+        return box
+    half = len(box) // 2
+    return (tuple(min(a, b) for a, b in zip(box[:half], other[:half])) +
+            tuple(max(a, b) for a, b in zip(box[half:], other[half:])))
+
+def note_keyword_words(chars):
+    """
+    Các từ là NOTE_KEYWORDS trong danh sách ký tự (theo thứ tự trong PDF)
+    Từ = các chữ cái liền nhau trên cùng dòng; dấu câu, số, khoảng trắng hoặc khoảng hở > NOTE_WORD_TOLERANCE ngắt từ
+
+    Returns:
+        list: [(keyword, top, bottom)]
+    """
+    keywords = set(NOTE_KEYWORDS)
+    tolerance = NOTE_WORD_TOLERANCE
+    found = []
+    word = []
+
+    def end_word():
+        text = ''.join(c['text'] for c in word).upper()
+        if text in keywords:
+            found.append((text, min(c['top'] for c in word), max(c['bottom'] for c in word)))
+        word.clear()
+
+    for c in chars:
+        if not c.get('text', '').isalpha():
+            if word:
+                end_word()
+            continue
+        if word:
+            previous = word[-1]
+            if (abs(c['top'] - previous['top']) > tolerance or
+                    max(c['x0'] - previous['x1'], previous['x0'] - c['x1']) > tolerance):
+                end_word()
+        word.append(c)
+    if word:
+        end_word()
+    return found
+
+def note_keyword_counts(chars):
+    """Số lần xuất hiện (nguyên từ) của từng NOTE_KEYWORDS trong danh sách ký tự"""
+    return Counter(keyword for keyword, _, _ in note_keyword_words(chars))
+
+def extract_notes_text(page, notes_band):
+    """
+    Text của dải ghi chú (top, bottom) đã học, None nếu có từ khóa nằm ngoài dải → trích text cả trang
+    """
+    try:
+        top = notes_band[0] - TEMPLATE_REGION_MARGIN
+        bottom = notes_band[1] + TEMPLATE_REGION_MARGIN
+        chars = page.chars
+        band_chars = [c for c in chars if c['top'] >= top and c['bottom'] <= bottom]
+        if note_keyword_counts(band_chars) != note_keyword_counts(chars):
+            return None
+        return pdfplumber.utils.extract_text(band_chars, layout_bbox=page.bbox,
+                                             layout_width=page.width, layout_height=page.height)
+    except Exception:
+        return None
+
+@dataclass(slots=True)
+class TemplateProfile:
+    """Những gì đã học của 1 template (tên font đã bỏ tiền tố subset)"""
+    preferred_font: str = None  # Font kích thước (determine_preferred_font_with_frequency_3)
+    dimension_fonts: frozenset = frozenset()  # Các font F2/F3 có ký tự số
+    dimension_region: tuple = None  # (x0, top, x1, bottom) chứa mọi ký tự số/dấu chấm của preferred_font
+    notes_band: tuple = None  # (top, bottom) chứa mọi từ NOTE_KEYWORDS (note_keyword_words)
+    files: int = 1  # Số file đã học
+    fallbacks: int = 0  # Số lần đường tắt bị bác bỏ
+
+    @property
+    def ready(self):
+        """Đủ file để đi đường tắt; template không có font F2/F3 thì luôn chạy pipeline đầy đủ"""
+        return (self.files >= TEMPLATE_LEARN_FILES and self.preferred_font is not None and bool(self.dimension_fonts)
+                and self.dimension_region is not None)
+
+def learn_template_profile(page, char_table, settings=DEFAULT_SETTINGS):
+    """TemplateProfile từ 1 trang đã chạy pipeline đầy đủ"""
+    digit_chars = char_table.chars
+    font_registry = char_table.font_registry
+    all_fonts = list(set([c.get('fontname', 'Unknown') for c in digit_chars]))
+    preferred_font = determine_preferred_font_with_frequency_3(all_fonts, digit_chars, font_registry,
+                                                               settings=settings) if digit_chars else None
+
+    dimension_region = None
+    if preferred_font:
+        excluded_font_size = settings.excluded_font_size
+        for c in digit_chars:
+            if c.get('fontname', 'Unknown') == preferred_font and c.get('size', 0) != excluded_font_size:
+                dimension_region = union_box(dimension_region, (c['x0'], c['top'], c['x1'], c['bottom']))
+
+    notes_band = None
+    for _, word_top, word_bottom in note_keyword_words(page.chars):
+        notes_band = union_box(notes_band, (word_top, word_bottom))
+
+    return TemplateProfile(
+        preferred_font=normalize_fontname(preferred_font) if preferred_font else None,
+        dimension_fonts=frozenset(normalize_fontname(fontname) for fontname in all_fonts
+                                  if lookup_font(font_registry, fontname)['priority'] > 0),
+        dimension_region=dimension_region,
+        notes_band=notes_band
+    )
+
+class TemplateMatch(NamedTuple):
+    """Template đã nhận diện trên 1 trang"""
+    key: str
+    preferred_font: str  # Tên font đầy đủ (có tiền tố subset) trên trang này
+    notes_band: tuple = None
+
+class TemplateCache:
+    """
+    *** MỚI: Font kích thước, vùng kích thước và dải ghi chú đã học theo template CAD (template_key) ***
+    TEMPLATE_LEARN_FILES file đầu của template chạy pipeline đầy đủ để học; file sau đi đường tắt:
+    chỉ trích text dải ghi chú khi không cần tìm GRAIN.
+    Trang mâu thuẫn với template (font F2/F3 khác, font chọn trên trang khác font đã học,
+    ký tự số ngoài vùng đã học, font đã học không cho số nào)
+    → chạy pipeline đầy đủ; bị bác bỏ TEMPLATE_MAX_FALLBACKS lần thì học lại template.
+    Giữ TEMPLATE_CACHE_SIZE template gần nhất; an toàn khi gọi từ nhiều thread.
+    """
+
+    def __init__(self, max_size=TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.fallbacks = 0
+        self._profiles = collections.OrderedDict()  # template_key → TemplateProfile
+        self._lock = threading.Lock()
+
+    def recognise(self, key, char_table, settings=DEFAULT_SETTINGS):
+        """TemplateMatch nếu template đã học xong và trang khớp với template, ngược lại None"""
+        with self._lock:
+            profile = self._profiles.get(key) if key else None
+            if profile is None or not profile.ready:
+                record_cache_lookup('template', False)
+                return None
+            self._profiles.move_to_end(key)
+            preferred_font = profile.preferred_font
+            dimension_fonts = profile.dimension_fonts
+            x0, top, x1, bottom = profile.dimension_region
+            notes_band = profile.notes_band
+
+        font_registry = char_table.font_registry
+        all_fonts = list(set([c.get('fontname', 'Unknown') for c in char_table.chars]))
+        page_dimension_fonts = frozenset(normalize_fontname(fontname) for fontname in all_fonts
+                                         if lookup_font(font_registry, fontname)['priority'] > 0)
+        if page_dimension_fonts != dimension_fonts:
+            self.reject(key)
+            return None
+
+        # Chọn lại font trên trang như pipeline đầy đủ: ≥2 font F2/F3 có số → font thấp nhất có thể đổi theo trang
+        fontname = determine_preferred_font_with_frequency_3(all_fonts, char_table.chars, font_registry,
+                                                             settings=settings)
+        if fontname is None or normalize_fontname(fontname) != preferred_font:
+            self.reject(key)
+            return None
+
+        margin = TEMPLATE_REGION_MARGIN
+        x0, top, x1, bottom = x0 - margin, top - margin, x1 + margin, bottom + margin
+        excluded_font_size = settings.excluded_font_size
+        matched = False
+        for c in char_table.chars:
+            if c.get('fontname', 'Unknown') != fontname or c.get('size', 0) == excluded_font_size:
+                continue
+            if not (x0 <= c['x0'] and c['x1'] <= x1 and top <= c['top'] and c['bottom'] <= bottom):
+                self.reject(key)
+                return None
+            matched = True
+        if not matched:
+            self.reject(key)
+            return None
+
+        with self._lock:
+            self.hits += 1
+        record_cache_lookup('template', True)
+        return TemplateMatch(key=key, preferred_font=fontname, notes_band=notes_band)
+
+    def reject(self, key):
+        """Trang mâu thuẫn với template → caller chạy pipeline đầy đủ"""
+        record_cache_lookup('template', False)
+        with self._lock:
+            self.fallbacks += 1
+            profile = self._profiles.get(key)
+            if profile is not None:
+                profile.fallbacks += 1
+                if profile.fallbacks >= TEMPLATE_MAX_FALLBACKS:
+                    del self._profiles[key]
+
+    def learn(self, key, page, char_table, settings=DEFAULT_SETTINGS):
+        """Học từ trang vừa chạy pipeline đầy đủ (bỏ qua nếu template đã học đủ file)"""
+        if not key:
+            return
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is not None and profile.files >= TEMPLATE_LEARN_FILES:
+                return
+
+        learned = learn_template_profile(page, char_table, settings)
+
+        with self._lock:
+            profile = self._profiles.get(key)
+            if (profile is None or profile.preferred_font != learned.preferred_font or
+                    profile.dimension_fonts != learned.dimension_fonts):
+                # File đầu của template, hoặc khác font với file trước → học lại từ file này
+                self._profiles[key] = learned
+            elif profile.files < TEMPLATE_LEARN_FILES:
+                profile.dimension_region = union_box(profile.dimension_region, learned.dimension_region)
+                profile.notes_band = union_box(profile.notes_band, learned.notes_band)
+                profile.files += 1
+            self._profiles.move_to_end(key)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+def extract_number_stage_with_template(page, char_table, filename, triage, settings, template_cache):
+    """
+    extract_number_stage qua TemplateCache: đường tắt nếu trang khớp template đã học,
+    ngược lại (hoặc font của template không cho số nào) chạy đầy đủ rồi học từ trang
+
+    Returns:
+        tuple: (NumberStage, dải ghi chú của template hoặc None)
+    """
+    with timed_stage('template'):
+        key = template_key(page)
+        match = template_cache.recognise(key, char_table, settings)
+    if match is not None:
+        number_stage = extract_number_stage(char_table, filename, triage, settings, match.preferred_font)
+        if number_stage.skipped or number_stage.main_numbers:
+            return number_stage, match.notes_band
+        template_cache.reject(key)
+
+    number_stage = extract_number_stage(char_table, filename, triage, settings)
+    if not number_stage.skipped:
+        with timed_stage('template'):
+            template_cache.learn(key, page, char_table, settings)
+    return number_stage, None
+
+# =============================================================================
+# ARCHIVE INGESTION - ZIP/TAR, GIẢI NÉN LẦN LƯỢT TỪNG FILE
+# =============================================================================
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+UPLOAD_TYPES = ['pdf', 'zip', 'tar', 'gz', 'tgz', 'bz2', 'tbz2', 'xz', 'txz']
+
+def is_archive_name(name):
+    """File zip/tar (theo đuôi file)"""
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+def is_archive_pdf_member(member_name):
+    """File PDF trong archive, bỏ qua file rác của macOS (__MACOSX/, ._*)"""
+    basename = member_name.rsplit('/', 1)[-1]
+    return (member_name.lower().endswith('.pdf')
+            and not member_name.startswith('__MACOSX/')
+            and not basename.startswith('._'))
+
+def iter_archive_pdfs(fileobj, archive_name):
+    """
+    *** MỚI: Giải nén lần lượt từng file PDF trong archive ***
+    Mỗi lần chỉ giữ 1 file PDF đã giải nén trong bộ nhớ; tar được đọc tuần tự (không cần seek).
+
+    Yields:
+        tuple: ("<archive>/<đường dẫn trong archive>", pdf_bytes)
+    """
+    if archive_name.lower().endswith('.zip'):
+        with zipfile.ZipFile(fileobj) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and is_archive_pdf_member(member.filename):
+                    yield f"{archive_name}/{member.filename}", archive.read(member)
+    else:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and is_archive_pdf_member(member.name):
+                    yield f"{archive_name}/{member.name}", archive.extractfile(member).read()
+
+def count_archive_pdfs(fileobj, archive_name):
+    """Số file PDF trong archive (zip: đọc mục lục; tar: quét header), đưa fileobj về đầu"""
+    try:
+        if archive_name.lower().endswith('.zip'):
+            with zipfile.ZipFile(fileobj) as archive:
+                return sum(1 for member in archive.infolist()
+                           if not member.is_dir() and is_archive_pdf_member(member.filename))
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            return sum(1 for member in archive if member.isfile() and is_archive_pdf_member(member.name))
+    except (zipfile.BadZipFile, tarfile.TarError):
+        return 0
+    finally:
+        fileobj.seek(0)
+
+def iter_upload_tasks(uploads):
+    """
+    Các task (filename, pdf_bytes) từ danh sách (name, fileobj): PDF giữ nguyên, archive → từng file PDF bên trong
+    """
+    for name, fileobj in uploads:
+        if is_archive_name(name):
+            yield from iter_archive_pdfs(fileobj, name)
+        else:
+            yield name, fileobj.read()
+
+def iter_input_paths(paths):
+    """File PDF/archive từ danh sách đường dẫn (thư mục → quét đệ quy)"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.pdf') or is_archive_name(name):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def iter_path_tasks(paths):
+    """Các task (filename, pdf_bytes) từ đường dẫn trên đĩa, mở từng file khi cần"""
+    for path in iter_input_paths(paths):
+        name = os.path.basename(path)
+        with open(path, 'rb') as fileobj:
+            yield from iter_upload_tasks([(name, fileobj)])
+
+# =============================================================================
+# PREFETCH - ĐỌC TRƯỚC FILE (Ổ MẠNG/NFS) TRONG LÚC WORKER ĐANG PHÂN TÍCH
+# =============================================================================
+
+PREFETCH_FILES = int(os.environ.get('OKE_DRAWING_PREFETCH', 16))  # Số file đọc trước tối đa (bộ đệm)
+PREFETCH_READERS = 8  # Số thread đọc song song - che độ trễ của ổ mạng
+
+def prefetch_reads(items, read, depth=PREFETCH_FILES, readers=PREFETCH_READERS):
+    """
+    *** MỚI: Gọi read(item) trước cho tối đa `depth` phần tử kế tiếp, trên `readers` thread ***
+    - items được lấy trong thread gọi (không cần thread-safe, ví dụ có truy vấn SQLite); chỉ read() chạy nền
+    - Bộ đệm có giới hạn: worker xử lý chậm → không đọc thêm (backpressure)
+    - Giữ nguyên thứ tự đầu vào
+
+    Yields:
+        tuple: (item, Future của read(item)) - lỗi đọc được báo khi gọi future.result()
+    """
+    depth = max(1, depth)
+    items = iter(items)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(readers, depth)),
+                                               thread_name_prefix='prefetch') as executor:
+        try:
+            while True:
+                while len(pending) < depth:
+                    item = next(items, _MISSING)
+                    if item is _MISSING:
+                        break
+                    pending.append((item, executor.submit(read, item)))
+                if not pending:
+                    return
+                item, future = pending.popleft()
+                concurrent.futures.wait([future])
+                yield item, future
+        finally:
+            # Dừng giữa chừng → bỏ các lần đọc chưa bắt đầu
+            for _, future in pending:
+                future.cancel()
+
+def prefetch_iter(iterable, depth=PREFETCH_FILES):
+    """
+    *** MỚI: Lấy trước tối đa `depth` phần tử của iterable trong 1 thread nền (ví dụ giải nén archive) ***
+    Lỗi của iterable được báo lại ở thread gọi; dừng giữa chừng → thread nền dừng theo.
+    """
+    buffer = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def offer(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=WORKER_CHECK_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not offer((True, item)):
+                    return
+        except Exception as e:
+            offer((False, e))
+            return
+        offer((False, None))
+
+    threading.Thread(target=produce, name='prefetch-iter', daemon=True).start()
+    try:
+        while True:
+            has_item, item = buffer.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+def _read_input_file(path):
+    """Nội dung file PDF, None nếu là archive (giải nén lần lượt ở prefetch_path_tasks)"""
+    if is_archive_name(os.path.basename(path)):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def prefetch_path_tasks(paths, depth=PREFETCH_FILES, readers=PREFETCH_READERS):
+    """
+    *** MỚI: iter_path_tasks có đọc trước - file PDF đọc song song, archive giải nén trong thread nền ***
+    Cùng thứ tự task với iter_path_tasks; bộ nhớ giữ tối đa ~2 × depth file.
+    """
+    for path, future in prefetch_reads(iter_input_paths(paths), _read_input_file, depth, readers):
+        name = os.path.basename(path)
+        pdf_bytes = future.result()
+        if pdf_bytes is not None:
+            yield name, pdf_bytes
+            continue
+        with open(path, 'rb') as fileobj:
+            yield from prefetch_iter(iter_archive_pdfs(fileobj, name), depth)
+
+# =============================================================================
+# BATCH JOURNAL - LƯU TIẾN ĐỘ TỪNG FILE, CHẠY LẠI THÌ TIẾP TỤC
+# =============================================================================
+
+JOURNAL_DIR = os.environ.get('OKE_DRAWING_JOURNAL_DIR',
+                             os.path.join(os.path.expanduser('~'), '.cache', 'oke_drawing', 'journals'))
+
+def _json_default(value):
+    """Số numpy → số Python khi ghi JSON"""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+def file_result_to_record(result):
+    """FileResult → dict JSON (*** CẬP NHẬT: lưu đủ BẢNG PHỤ - File, font, vị trí, 8 chỉ số, Group, SCORE ***)"""
+    secondary = None
+    if result.secondary is not None:
+        secondary = result.secondary.to_dict(orient='split', index=False)
+    return {
+        'filename': result.filename,
+        'main_numbers': list(result.main_numbers),
+        'secondary': secondary,
+        'metadata': result.metadata,
+        'skipped_reason': result.skipped_reason,
+        'duplicate_of': result.duplicate_of
+    }
+
+def file_result_from_record(record):
+    """dict JSON → FileResult, BẢNG PHỤ giữ nguyên các cột như lúc xử lý"""
+    secondary = None
+    if record['secondary'] is not None:
+        secondary = pd.DataFrame(record['secondary']['data'], columns=record['secondary']['columns'])
+    return FileResult(filename=record['filename'], main_numbers=record['main_numbers'], secondary=secondary,
+                      metadata=record['metadata'], skipped_reason=record['skipped_reason'],
+                      duplicate_of=record.get('duplicate_of', ""))
+
+class BatchJournal:
+    """
+    *** MỚI: Nhật ký JSONL (chỉ ghi thêm) của các file đã xử lý xong ***
+    Khóa = SHA-256 của (tên file, chế độ triage, bộ ngưỡng, backend, đường tắt template, nội dung)
+    → chạy lại cùng đầu vào sẽ bỏ qua file đã xong.
+    File lỗi không được ghi → lần chạy sau sẽ thử lại.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if entry['result'] is not None and 'secondary' not in entry['result']:
+                            continue  # Bản ghi dạng cũ (BẢNG PHỤ thiếu cột) → xử lý lại
+                        self.completed[entry['key']] = entry['result']
+                    except (ValueError, KeyError):
+                        continue  # Dòng cuối bị ghi dở khi tiến trình bị dừng
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def task_key(filename, pdf_bytes, triage=False, settings=None, backend=None, templates=False):
+        settings_key = (settings or DEFAULT_SETTINGS).fingerprint()
+        backend = resolve_pdf_backend(backend)
+        digest = hashlib.sha256(f"{filename}\0{int(bool(triage))}\0{settings_key}\0{backend}\0".encode('utf-8'))
+        if templates:
+            digest.update(b"templates\0")
+        digest.update(pdf_bytes)
+        return digest.hexdigest()
+
+    def __contains__(self, key):
+        return key in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def load(self, key):
+        """FileResult đã lưu (None nếu file không có trang)"""
+        record = self.completed[key]
+        return file_result_from_record(record) if record is not None else None
+
+    def record(self, key, result):
+        record = file_result_to_record(result) if result is not None else None
+        self._file.write(json.dumps({'key': key, 'result': record}, ensure_ascii=False, default=_json_default) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.completed[key] = record
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """Xóa nhật ký sau khi cả lô chạy xong không lỗi"""
+        self.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+def journal_path_for_uploads(uploaded_files):
+    """Nhật ký cho 1 lô upload, đặt tên theo danh sách (tên file, kích thước) → upload lại cùng lô sẽ dùng lại"""
+    digest = hashlib.sha256()
+    for uploaded_file in uploaded_files:
+        digest.update(f"{uploaded_file.name}\0{uploaded_file.size}\0".encode('utf-8'))
+    return os.path.join(JOURNAL_DIR, f"batch-{digest.hexdigest()[:16]}.jsonl")
+
+# =============================================================================
+# SCHEDULING - ƯỚC LƯỢNG CHI PHÍ TỪNG FILE, FILE NẶNG CHẠY TRƯỚC
+# =============================================================================
+
+SCHEDULE_LOOKAHEAD = 8  # Số file đọc trước cho mỗi worker để chọn file nặng nhất
+SCHEDULE_WINDOW_MB = 256  # Tổng dung lượng tối đa của các file trong cửa sổ đọc trước (ít nhất 1 file)
+
+class CostFeatures(NamedTuple):
+    size_mb: float  # Dung lượng file
+    content_mb: float  # Dung lượng stream (chưa giải nén) trung bình mỗi trang
+    page_area: float  # Diện tích MediaBox đầu tiên (m²)
+
+# Mẫu tìm trên byte thô của file PDF (/Length trực tiếp, không theo tham chiếu "n 0 R")
+PDF_PAGE_PATTERN = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+PDF_LENGTH_PATTERN = re.compile(rb'/Length\s+(\d+)(?!\d)(?!\s+\d+\s+R)')
+PDF_MEDIABOX_PATTERN = re.compile(rb'/MediaBox\s*\[\s*([-+\d.]+)\s+([-+\d.]+)\s+([-+\d.]+)\s+([-+\d.]+)\s*\]')
+
+def estimate_file_features(pdf_bytes):
+    """
+    *** CẬP NHẬT: Đặc trưng chi phí của 1 file - chỉ đếm trên byte thô, không phân tích PDF ***
+    Chạy ở thread điều phối, ngoài giới hạn thời gian/bộ nhớ của worker → không dùng pdfminer
+    (xref hỏng khiến pdfminer quét lại toàn bộ file và chặn việc chia file cho mọi phiên).
+    Trang nằm trong object stream nén không đếm được → tính là 1 trang.
+    """
+    size_mb = len(pdf_bytes) / (1024 * 1024)
+    pages = max(1, len(PDF_PAGE_PATTERN.findall(pdf_bytes)))
+    stream_bytes = sum(int(length) for length in PDF_LENGTH_PATTERN.findall(pdf_bytes))
+    content_mb = stream_bytes / (1024 * 1024) / pages if stream_bytes else size_mb / pages
+
+    page_area = 0.0
+    mediabox = PDF_MEDIABOX_PATTERN.search(pdf_bytes)
+    if mediabox is not None:
+        try:
+            x0, y0, x1, y1 = (float(value) for value in mediabox.groups())
+            page_area = abs((x1 - x0) * (y1 - y0)) * (0.0254 / 72) ** 2
+        except ValueError:
+            pass
+    return CostFeatures(size_mb, content_mb, page_area)
+
+class CostModel:
+    """
+    *** MỚI: Ước lượng thời gian xử lý (giây) = hệ số · [1, size_mb, content_mb, page_area] ***
+    Hệ số bắt đầu từ PRIOR và được hiệu chỉnh (ridge regression về PRIOR) theo thời gian thực tế của từng file.
+    """
+    PRIOR = (0.2, 0.2, 3.0, 0.05)
+    PRIOR_WEIGHT = 1.0
+    HISTORY_SIZE = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._xtx = np.eye(len(self.PRIOR)) * self.PRIOR_WEIGHT
+        self._xty = np.array(self.PRIOR) * self.PRIOR_WEIGHT
+        self.coefficients = np.array(self.PRIOR)
+        self.history = collections.deque(maxlen=self.HISTORY_SIZE)  # (estimated, actual)
+
+    def estimate(self, features):
+        """Thời gian ước lượng (giây) cho 1 file"""
+        return max(0.01, float(self.coefficients @ np.array((1.0, *features))))
+
+    def record(self, features, estimated, actual):
+        """Ghi thời gian thực tế và cập nhật hệ số"""
+        x = np.array((1.0, *features))
+        with self._lock:
+            self.history.append((estimated, actual))
+            self._xtx += np.outer(x, x)
+            self._xty += x * actual
+            self.coefficients = np.linalg.solve(self._xtx, self._xty)
+
+    def mean_absolute_error(self):
+        """Sai số trung bình |thực tế - ước lượng| (giây) của các file gần đây"""
+        with self._lock:
+            if not self.history:
+                return None
+            return sum(abs(actual - estimated) for estimated, actual in self.history) / len(self.history)
+
+# =============================================================================
+# WORKER POOL - PROCESS PRE-FORK, GIỮ SẴN pdfplumber/pandas ĐÃ IMPORT
+# =============================================================================
+
+FILE_TIMEOUT_SECONDS = 120  # Thời gian tối đa cho 1 file
+FILE_MEMORY_LIMIT_MB = 2048  # Bộ nhớ thực (RSS) tối đa của 1 worker khi xử lý 1 file
+WORKER_CHECK_INTERVAL = 0.25  # Chu kỳ kiểm tra bộ nhớ worker (giây)
+QUEUE_STATUS_INTERVAL = 1.0  # Chu kỳ báo vị trí chờ/ETA khi chưa có file nào xong (giây)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+ERROR_COLUMNS = ["File", "Error"]
+
+class DrawingProcessingError(Exception):
+    """Lỗi khi xử lý 1 file PDF trong worker; reason: 'error', 'timeout', 'memory' hoặc 'crash' (metrics)"""
+
+    def __init__(self, message, reason='error'):
+        super().__init__(message)
+        self.reason = reason
+
+def process_memory_mb(pid):
+    """Bộ nhớ thực (RSS) của 1 process theo MB, None nếu không đọc được (không có /proc)"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def build_error_table(errors):
+    """Bảng các file lỗi/bị dừng và lý do"""
+    return pd.DataFrame(errors, columns=ERROR_COLUMNS)
+
+# Thư viện forkserver nạp sẵn → worker tạo từ forkserver chỉ phải chạy lại phần thân script
+WORKER_PRELOAD_MODULES = ['__main__', 'numpy', 'pandas', 'pdfplumber', 'sklearn.cluster', 'streamlit']
+
+def _fork_context():
+    """Context 'fork' nếu hệ điều hành hỗ trợ, None nếu không (Windows → chạy trực tiếp)"""
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+def _forkserver_context():
+    """
+    *** MỚI: Context 'forkserver' cho worker tạo khi process đã có thread khác, None nếu không hỗ trợ ***
+    Process con của fork chỉ còn thread đã gọi fork: lock mà các thread KHÁC đang giữ đúng lúc fork (pdfminer,
+    logging, stream của uvicorn/Streamlit...) không bao giờ được nhả → worker bị treo, dù fork từ thread nào.
+    Forkserver là process riêng chỉ có 1 thread (khởi động bằng exec) → worker fork từ đó không mang lock nào.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+    return context
+
+def _pool_worker_main(conn, stage_cache_path=None, dedup=False, backend=None, templates=False):
+    """
+    Vòng lặp của 1 worker: nhận (pdf_bytes, filename, triage, settings), trả ('ok', FileResult) hoặc ('error', message).
+    Hết bộ nhớ → trả ('restart', message) rồi thoát để pool tạo worker mới.
+    Trước kết quả gửi ('stages', dict của record_stages) → process chính ghi vào METRICS.
+    Worker fork dùng thẳng hàm này; worker từ forkserver nạp lại script rồi nhận hàm qua pickle (theo tên) →
+    tham số chỉ là dữ liệu thuần (stage_cache_path thay vì StageCache).
+    dedup → hỏi DrawingIndex của process chính qua pipe trước khi chạy pipeline.
+    templates → TemplateCache riêng của worker, học từ các file worker đã xử lý.
+    """
+    stage_cache = StageCache(stage_cache_path) if stage_cache_path else None
+    drawing_index = _PipeDrawingIndex(conn) if dedup else None
+    template_cache = TemplateCache() if templates else None
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+
+        if task is None:
+            break
+
+        pdf_bytes, filename, triage, settings = task
+        try:
+            with record_stages() as stages:
+                result = process_pdf_file(pdf_bytes, filename, triage=triage, settings=settings,
+                                          stage_cache=stage_cache, drawing_index=drawing_index, backend=backend,
+                                          template_cache=template_cache)
+            conn.send(('stages', stages))
+            conn.send(('ok', result))
+        except MemoryError:
+            conn.send(('restart', "Out of memory"))
+            break
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+
+class QueueStatus(NamedTuple):
+    """Vị trí của 1 lô trong pool dùng chung"""
+    position: int  # Thứ tự chờ worker của phiên (0 = đang có worker chạy)
+    sessions: int  # Số phiên đang dùng hoặc chờ pool
+    workers: int
+    eta: float  # Thời gian còn lại ước lượng (giây) khi worker được chia đều giữa các phiên
+
+class FairWorkerQueue:
+    """
+    *** MỚI: Hàng đợi worker rảnh, chia lần lượt (round-robin) cho các phiên đang chờ ***
+    Mỗi phiên (session Streamlit; None cho CLI/HTTP) có hàng chờ riêng. Worker vừa rảnh được trao cho phiên
+    kế tiếp trong vòng → lô 3.000 file của 1 người không chặn lô nhỏ của người khác.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+        self._waiting = collections.OrderedDict()  # phiên → deque slot chờ, theo thứ tự vòng
+        self._running = Counter()  # phiên → số worker đang dùng
+        self._closed = False
+
+    def get(self, session=None):
+        """Mượn 1 worker cho phiên (chặn đến lượt), None nếu pool đã đóng"""
+        with self._lock:
+            if self._closed:
+                return None
+            if self._idle:
+                self._running[session] += 1
+                return self._idle.popleft()
+            slot = queue.SimpleQueue()
+            self._waiting.setdefault(session, collections.deque()).append(slot)
+        return slot.get()
+
+    def put(self, worker, session=_MISSING):
+        """Trả worker (session: phiên vừa mượn) → trao ngay cho phiên kế tiếp đang chờ"""
+        with self._lock:
+            if session is not _MISSING:
+                self._running[session] -= 1
+                if self._running[session] <= 0:
+                    del self._running[session]
+            if not self._waiting:
+                self._idle.append(worker)
+                return
+            # Phiên đầu vòng nhận worker rồi xuống cuối vòng nếu còn slot chờ
+            next_session, slots = self._waiting.popitem(last=False)
+            slot = slots.popleft()
+            if slots:
+                self._waiting[next_session] = slots
+            self._running[next_session] += 1
+        slot.put(worker)
+
+    def counts(self):
+        """(số worker rảnh, số worker đang chạy, số lượt chờ worker)"""
+        with self._lock:
+            return (len(self._idle), sum(self._running.values()),
+                    sum(len(slots) for slots in self._waiting.values()))
+
+    def status(self, session=None):
+        """(thứ tự chờ của phiên - 0 nếu phiên đang có worker hoặc không chờ, số phiên đang dùng/chờ worker)"""
+        with self._lock:
+            sessions = len(set(self._running) | set(self._waiting))
+            if self._running.get(session) or session not in self._waiting:
+                return 0, sessions
+            return list(self._waiting).index(session) + 1, sessions
+
+    def close(self):
+        """Đánh thức mọi phiên đang chờ (nhận None)"""
+        with self._lock:
+            self._closed = True
+            slots = [slot for session_slots in self._waiting.values() for slot in session_slots]
+            self._waiting.clear()
+        for slot in slots:
+            slot.put(None)
+
+class DrawingWorkerPool:
+    """
+    *** MỚI: Pool worker pre-fork cho xử lý hàng loạt ***
+    - Worker được tạo 1 lần khi tạo pool → không tốn thời gian import/khởi động cho mỗi request
+    - *** CẬP NHẬT: fork chỉ khi process chưa có thread nào khác; ngược lại (worker thay thế, server
+      uvicorn/Streamlit) tạo worker từ forkserver (_forkserver_context) ***
+    - run() an toàn khi gọi từ nhiều thread (mỗi lần gọi mượn 1 worker rảnh)
+    - Mỗi file chạy trong worker riêng: quá `timeout` giây hoặc vượt `memory_limit_mb` → dừng worker,
+      báo lỗi cho file đó và tạo worker mới, các file khác chạy tiếp
+    - workers=0 (hoặc không có fork) → xử lý trực tiếp trong thread gọi (không giới hạn thời gian/bộ nhớ)
+    - stage_cache (StageCache) → worker lưu/dùng lại kết quả từng bước
+    - dedup → bản xuất lại của bản vẽ đã xử lý trong pool dùng lại kết quả (DrawingIndex)
+    - backend → thư viện đọc PDF (PDF_BACKENDS), kiểm tra ngay khi tạo pool
+    - templates → mỗi worker học font/vùng của từng template CAD (TemplateCache) và đi đường tắt cho file sau
+    - Dùng chung giữa nhiều phiên: worker chia round-robin theo `session` (FairWorkerQueue),
+      queue_status() cho biết thứ tự chờ và ETA của từng lô
+    - Mỗi file xử lý xong/lỗi và số worker, hàng đợi của pool được ghi vào METRICS
+    """
+
+    def __init__(self, workers=None, timeout=None, memory_limit_mb=None, stage_cache=None, dedup=True,
+                 backend=None, templates=False):
+        self._context = _fork_context()
+        self._server_context = _forkserver_context() if self._context is not None else None
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.size = max(0, int(workers)) if self._context is not None else 0
+        self.timeout = timeout or None
+        self.memory_limit_mb = memory_limit_mb or None
+        self.cost_model = CostModel()
+        self.stage_cache = stage_cache
+        self.drawing_index = DrawingIndex() if dedup else None
+        self.backend = resolve_pdf_backend(backend)
+        self.template_cache = TemplateCache() if templates else None  # workers=0; worker có cache riêng
+        self._idle = FairWorkerQueue()
+        self._backlog = {}  # lô đang chạy → (phiên, chi phí ước lượng còn lại)
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(self.size):
+            self._idle.put(self._spawn_worker())
+        _LIVE_POOLS.add(self)
+
+    def _worker_context(self):
+        """
+        (context, hàm worker) cho worker sắp tạo: fork khi process chỉ có 1 thread, ngược lại forkserver
+        Forkserver cần nạp lại được script → chỉ dùng khi script là __main__ (CLI, Streamlit); nạp như module → fork.
+        Streamlit tạo __main__ mới mỗi lần chạy lại script → lấy hàm worker và gán __mp_main__ (tên module
+        của kết quả worker gửi về) theo __main__ hiện tại.
+        """
+        if threading.active_count() == 1 or self._server_context is None or _pool_worker_main.__module__ != '__main__':
+            return self._context, _pool_worker_main
+        main_module = sys.modules['__main__']
+        sys.modules['__mp_main__'] = main_module
+        return self._server_context, getattr(main_module, '_pool_worker_main', _pool_worker_main)
+
+    def _spawn_worker(self):
+        """Tạo 1 worker mới; pool đã đóng → RuntimeError (worker vừa tạo bị dừng ngay)"""
+        if self._closed:
+            raise RuntimeError("DrawingWorkerPool is closed")
+        context, target = self._worker_context()
+        parent_conn, child_conn = context.Pipe()
+        stage_cache_path = self.stage_cache.path if self.stage_cache is not None else None
+        process = context.Process(target=target,
+                                  args=(child_conn, stage_cache_path, self.drawing_index is not None,
+                                        self.backend, self.template_cache is not None),
+                                  daemon=True)
+        process.start()
+        child_conn.close()
+        worker = (process, parent_conn)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._workers.append(worker)
+        if closed:
+            # close() đã lấy danh sách worker trước khi worker này có trong đó
+            self._discard_worker(worker)
+            raise RuntimeError("DrawingWorkerPool is closed")
+        return worker
+
+    def _discard_worker(self, worker):
+        process, conn = worker
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+        try:
+            conn.close()
+        except OSError:
+            pass
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=1)
+
+    def _replace_worker(self, worker):
+        """Dừng worker hỏng/quá hạn, trả về worker mới và lý do worker cũ dừng"""
+        self._discard_worker(worker)
+        exitcode = worker[0].exitcode
+        if exitcode is not None and exitcode < 0:
+            reason = f"Worker crashed ({signal.Signals(-exitcode).name})"
+        else:
+            reason = f"Worker stopped unexpectedly (exit code {exitcode})"
+        return self._spawn_worker(), reason
+
+    def _wait_for_reply(self, worker, deadline=None):
+        """
+        Chờ worker trả lời (đến deadline theo time.monotonic()), kiểm tra thời gian và bộ nhớ (RSS) trong lúc chờ
+
+        Returns:
+            str: "" nếu đã có kết quả, ngược lại là lý do phải dừng worker
+        """
+        process, conn = worker
+        while True:
+            wait = WORKER_CHECK_INTERVAL if self.memory_limit_mb else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return f"Timed out after {self.timeout:g}s"
+                wait = remaining if wait is None else min(wait, remaining)
+
+            if conn.poll(wait):
+                return ""
+
+            if self.memory_limit_mb:
+                memory_mb = process_memory_mb(process.pid)
+                if memory_mb is not None and memory_mb > self.memory_limit_mb:
+                    return f"Memory limit exceeded ({memory_mb:.0f} MB > {self.memory_limit_mb} MB)"
+
+    def run(self, pdf_bytes, filename, triage=False, settings=None, session=None):
+        """
+        Xử lý 1 file trên 1 worker rảnh (chặn đến khi xong)
+        session: phiên gửi file - worker được chia lần lượt giữa các phiên
+
+        Returns:
+            FileResult hoặc None (file không có trang)
+
+        Raises:
+            DrawingProcessingError: file lỗi hoặc worker bị dừng đột ngột
+        """
+        return self.run_timed(pdf_bytes, filename, triage, settings, session)[0]
+
+    def run_timed(self, pdf_bytes, filename, triage=False, settings=None, session=None):
+        """
+        Như run(), trả (FileResult hoặc None, thời gian xử lý trên worker)
+        Thời gian tính từ lúc có worker → không gồm lúc chờ các phiên khác trả worker
+        """
+        if self._closed:
+            raise RuntimeError("DrawingWorkerPool is closed")
+        # *** MỚI: Ghi nhận kết quả/lỗi và thời gian của file vào METRICS ***
+        stats = {}
+        try:
+            result = self._run(pdf_bytes, filename, triage, settings, session, stats)
+        except DrawingProcessingError as e:
+            FILE_FAILURES.inc(reason=e.reason)
+            raise
+        seconds = time.perf_counter() - stats['started']
+        record_file_metrics(result, seconds, stats.get('stages'))
+        return result, seconds
+
+    def _run(self, pdf_bytes, filename, triage, settings, session, stats):
+        """run() không ghi metrics; stats nhận 'started' (lúc có worker) và 'stages' (record_stages)"""
+        if self.size == 0:
+            stats['started'] = time.perf_counter()
+            try:
+                with record_stages() as stats['stages']:
+                    return process_pdf_file(pdf_bytes, filename, triage=triage, settings=settings,
+                                            stage_cache=self.stage_cache, drawing_index=self.drawing_index,
+                                            backend=self.backend, template_cache=self.template_cache)
+            except Exception as e:
+                raise DrawingProcessingError(f"{type(e).__name__}: {e}") from e
+
+        worker = self._idle.get(session)
+        if worker is None:
+            raise RuntimeError("DrawingWorkerPool is closed")
+        stats['started'] = time.perf_counter()
+        try:
+            process, conn = worker
+            conn.send((pdf_bytes, filename, triage, settings))
+            deadline = time.monotonic() + self.timeout if self.timeout else None
+            indexed = None
+            while True:
+                stop_reason = self._wait_for_reply(worker, deadline)
+                if stop_reason:
+                    # File bị treo/quá bộ nhớ → dừng worker, các file khác vẫn chạy tiếp
+                    worker, _ = self._replace_worker(worker)
+                    reason = 'timeout' if stop_reason.startswith("Timed out") else 'memory'
+                    raise DrawingProcessingError(stop_reason, reason)
+                message = conn.recv()
+                # *** MỚI: Worker hỏi/ghi DrawingIndex giữa chừng (_PipeDrawingIndex) ***
+                if message[0] == 'lookup':
+                    # Gửi dạng dict: FileResult của lần chạy script đã tạo pool không pickle được
+                    # sau khi Streamlit chạy lại script (__main__ mới)
+                    duplicate = self.drawing_index.lookup(message[1], filename, triage, settings)
+                    conn.send(file_result_to_record(duplicate) if duplicate is not None else None)
+                elif message[0] == 'add':
+                    indexed = message[1:]
+                elif message[0] == 'stages':
+                    stats['stages'] = message[1]
+                else:
+                    break
+            status, payload = message
+            if status == 'restart':
+                worker, _ = self._replace_worker(worker)
+        except (EOFError, OSError) as e:
+            # Worker chết giữa chừng (segfault, bị OOM killer...) → thay bằng worker mới
+            worker, reason = self._replace_worker(worker)
+            raise DrawingProcessingError(reason, 'crash') from e
+        finally:
+            self._idle.put(worker, session)
+
+        if status in ('error', 'restart'):
+            raise DrawingProcessingError(payload, 'memory' if status == 'restart' else 'error')
+        if indexed is not None and payload is not None:
+            fingerprint, checked_numbers = indexed
+            self.drawing_index.add(fingerprint, triage, settings, payload, checked_numbers)
+        return payload
+
+    def imap_unordered(self, tasks, triage=False, on_estimate=None, settings=None, session=None, on_wait=None):
+        """
+        Xử lý song song các task (filename, pdf_bytes), đọc task dần dần (không giữ cả lô trong bộ nhớ)
+        *** CẬP NHẬT: Trong cửa sổ đọc trước, file có chi phí ước lượng lớn nhất được chạy trước (longest job first) ***
+        Cửa sổ giữ tối đa SCHEDULE_LOOKAHEAD file mỗi worker và SCHEDULE_WINDOW_MB tổng dung lượng.
+
+        Args:
+            on_estimate (callable): Gọi on_estimate(chi phí ước lượng) khi 1 task được đọc vào cửa sổ
+            session: Phiên gửi lô (chia worker với các phiên khác)
+            on_wait (callable): Gọi on_wait() mỗi QUEUE_STATUS_INTERVAL giây không có file nào xong
+
+        Yields:
+            tuple: (index, filename, FileResult hoặc None, error_message, chi phí ước lượng) theo thứ tự hoàn thành
+        """
+        def run_task(index, filename, pdf_bytes, features, estimated):
+            try:
+                result, seconds = self.run_timed(pdf_bytes, filename, triage=triage, settings=settings,
+                                                 session=session)
+            except DrawingProcessingError as e:
+                return index, filename, None, str(e), estimated
+            # Kết quả dùng lại (DrawingIndex) không phản ánh chi phí thật → không đưa vào mô hình
+            if result is None or not result.duplicate_of:
+                self.cost_model.record(features, estimated, seconds)
+            return index, filename, result, "", estimated
+
+        workers = max(1, self.size)
+        lookahead = workers * SCHEDULE_LOOKAHEAD
+        task_iter = enumerate(tasks)
+        window = []  # heap (-chi phí, index, filename, pdf_bytes, features)
+        window_bytes = 0
+        window_limit = SCHEDULE_WINDOW_MB * 1024 * 1024
+        exhausted = False
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            while True:
+                while not exhausted and len(window) < lookahead and window_bytes < window_limit:
+                    try:
+                        index, (filename, pdf_bytes) = next(task_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    features = estimate_file_features(pdf_bytes)
+                    estimated = self.cost_model.estimate(features)
+                    if on_estimate is not None:
+                        on_estimate(estimated)
+                    heapq.heappush(window, (-estimated, index, filename, pdf_bytes, features))
+                    window_bytes += len(pdf_bytes)
+
+                while window and len(pending) < workers:
+                    neg_estimated, index, filename, pdf_bytes, features = heapq.heappop(window)
+                    window_bytes -= len(pdf_bytes)
+                    pending.add(executor.submit(run_task, index, filename, pdf_bytes, features, -neg_estimated))
+
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, timeout=QUEUE_STATUS_INTERVAL if on_wait else None,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    on_wait()
+                for future in done:
+                    yield future.result()
+
+    def process_batch(self, tasks, triage=False, progress=None, journal=None, total=None, settings=None, session=None,
+                      status=None):
+        """
+        Xử lý cả lô, trả kết quả theo thứ tự đầu vào
+
+        Args:
+            progress (callable): Gọi progress(số file xong, filename, error_message, tỉ lệ hoàn thành) sau mỗi file;
+                tỉ lệ hoàn thành tính theo chi phí ước lượng, không theo số file
+            journal (BatchJournal): File đã có trong nhật ký được lấy lại, file mới xong được ghi thêm
+            total (int): Tổng số file (nếu biết) để ước lượng chi phí của các file chưa đọc tới
+            settings (ExtractionSettings): Các ngưỡng trích xuất (None → DEFAULT_SETTINGS)
+            session: Phiên gửi lô - các phiên dùng chung pool được chia worker lần lượt
+            status (callable): Gọi status(QueueStatus) sau mỗi file và định kỳ khi đang chờ worker
+
+        Returns:
+            tuple: (file_results, errors) - errors là list dict theo ERROR_COLUMNS
+        """
+        completed = []
+        submitted = []  # (thứ tự đầu vào, khóa nhật ký) theo thứ tự gửi vào pool
+        cost = {'estimated': 0.0, 'estimated_files': 0, 'done': 0.0, 'restored_files': 0}
+        batch = object()  # Khóa của lô trong bảng chi phí còn lại của pool (queue_status)
+
+        def expected_cost():
+            average = cost['estimated'] / cost['estimated_files'] if cost['estimated_files'] else 1.0
+            unseen_files = max(0, (total or 0) - cost['restored_files'] - cost['estimated_files'])
+            return cost['estimated'] + average * unseen_files
+
+        def update_backlog():
+            with self._lock:
+                self._backlog[batch] = (session, max(0.0, expected_cost() - cost['done']))
+
+        def report_status():
+            if status is not None:
+                status(self.queue_status(batch))
+
+        def add_estimate(estimated):
+            cost['estimated'] += estimated
+            cost['estimated_files'] += 1
+            update_backlog()
+
+        def completed_fraction():
+            expected = expected_cost()
+            if expected <= 0:
+                return len(completed) / total if total else 1.0
+            return min(1.0, cost['done'] / expected)
+
+        def finish(index, filename, result, error, estimated=0.0):
+            completed.append((index, filename, result, error))
+            cost['done'] += estimated
+            update_backlog()
+            if progress is not None:
+                progress(len(completed), filename, error, completed_fraction())
+            report_status()
+
+        def pending_tasks():
+            for index, (filename, pdf_bytes) in enumerate(tasks):
+                key = BatchJournal.task_key(filename, pdf_bytes, triage, settings, self.backend,
+                                            self.template_cache is not None) if journal is not None else None
+                if key is not None and key in journal:
+                    cost['restored_files'] += 1
+                    finish(index, filename, journal.load(key), "")
+                    continue
+                submitted.append((index, key))
+                yield filename, pdf_bytes
+
+        update_backlog()
+        try:
+            for pool_index, filename, result, error, estimated in self.imap_unordered(
+                    pending_tasks(), triage=triage, on_estimate=add_estimate, settings=settings, session=session,
+                    on_wait=report_status if status is not None else None):
+                index, key = submitted[pool_index]
+                if key is not None and not error:
+                    journal.record(key, result)
+                finish(index, filename, result, error, estimated)
+        finally:
+            with self._lock:
+                self._backlog.pop(batch, None)
+
+        completed.sort(key=lambda item: item[0])
+        file_results = [result for _, _, result, error in completed if result is not None]
+        errors = [dict(zip(ERROR_COLUMNS, (filename, error))) for _, filename, _, error in completed if error]
+        return file_results, errors
+
+    def queue_status(self, batch):
+        """
+        QueueStatus của 1 lô đang chạy (khóa nội bộ của process_batch)
+        ETA theo chia sẻ công bằng: phiên còn chi phí c chờ thêm phần của mỗi phiên khác tối đa c,
+        ETA = Σ min(c_phiên, c) / số worker
+        """
+        with self._lock:
+            backlog = list(self._backlog.items())
+        session_cost = Counter()
+        own_session = None
+        for key, (session, remaining) in backlog:
+            session_cost[session] += remaining
+            if key is batch:
+                own_session = session
+        own_cost = session_cost[own_session]
+        workers = max(1, self.size)
+        eta = sum(min(remaining, own_cost) for remaining in session_cost.values()) / workers
+        position, sessions = self._idle.status(own_session)
+        return QueueStatus(position, max(sessions, len(session_cost)), workers, eta)
+
+    def worker_counts(self):
+        """Số worker theo trạng thái (gauge oke_drawing_workers)"""
+        idle, busy, _ = self._idle.counts()
+        return {('idle',): idle, ('busy',): busy}
+
+    def queue_depth(self):
+        """Số file đang chờ worker rảnh"""
+        return self._idle.counts()[2]
+
+    def backlog(self):
+        """(phiên, chi phí ước lượng còn lại) của các lô đang chạy"""
+        with self._lock:
+            return list(self._backlog.values())
+
+    def close(self):
+        """Dừng tất cả worker"""
+        if self._closed:
+            return
+        self._closed = True
+        _LIVE_POOLS.discard(self)
+        self._idle.close()
+        with self._lock:
+            workers = list(self._workers)
+        for process, conn in workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker[0].join(timeout=2)
+            self._discard_worker(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+# =============================================================================
+# HTTP SERVICE - FASTAPI (KHÔNG CẦN STREAMLIT)
+# =============================================================================
+
+def summary_rows(summaries):
+    """FileSummary → list dict theo đúng các cột của dimension_summary.xlsx"""
+    return [dict(zip(SUMMARY_COLUMNS, summary.to_row())) for summary in summaries]
+
+def build_batch_response(file_results, errors=None):
+    """JSON trả về của service: bảng Results, danh sách Skipped và các file lỗi"""
+    return {
+        "results": summary_rows(build_dimension_summaries(file_results)),
+        "skipped": build_skipped_table(file_results).to_dict('records'),
+        "errors": errors or []
+    }
+
+def create_app(pool=None, workers=None, triage=False, timeout=FILE_TIMEOUT_SECONDS,
+               memory_limit_mb=FILE_MEMORY_LIMIT_MB, profiles=None, default_profile="default"):
+    """
+    *** MỚI: Service HTTP cho tích hợp MES ***
+    - POST /extract: 1 file PDF
+    - POST /batch: nhiều file PDF và/hoặc archive (.zip/.tar/.tar.gz...)
+    - GET /metrics: METRICS theo Prometheus text format
+    Test trong process (không cần mạng): fastapi.testclient.TestClient(create_app(workers=0))
+
+    Args:
+        pool (DrawingWorkerPool): Pool dùng chung; None → tạo pool mới với `workers` process,
+            `timeout` giây và `memory_limit_mb` MB cho mỗi file
+        triage (bool): Giá trị mặc định của tham số ?triage=
+        profiles (dict): Các profile ngưỡng chọn bằng tham số ?profile= (None → load_settings_profiles(SETTINGS_FILE))
+    """
+    try:
+        from fastapi import FastAPI, File, HTTPException, Response, UploadFile
+    except ImportError as e:
+        raise RuntimeError("The HTTP service needs: pip install fastapi uvicorn python-multipart") from e
+
+    if profiles is None:
+        profiles = load_settings_profiles(SETTINGS_FILE)
+    if default_profile not in profiles:
+        raise ValueError(f"Unknown settings profile: {default_profile}")
+
+    if pool is None:
+        pool = DrawingWorkerPool(workers, timeout=timeout, memory_limit_mb=memory_limit_mb)
+
+    def resolve_profile(profile):
+        if profile not in profiles:
+            raise HTTPException(status_code=400, detail=f"Unknown settings profile: {profile}")
+        return profiles[profile]
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        pool.close()
+
+    app = FastAPI(title="PDF Number Extraction Service", lifespan=lifespan)
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "workers": pool.size, "profiles": list(profiles)}
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
+
+    @app.post("/extract")
+    def extract(file: UploadFile = File(...), triage: bool = triage, profile: str = default_profile):
+        settings = resolve_profile(profile)
+        try:
+            result = pool.run(file.file.read(), file.filename, triage=triage, settings=settings)
+        except DrawingProcessingError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        return build_batch_response([result] if result is not None else [])
+
+    @app.post("/batch")
+    def batch(files: list[UploadFile] = File(...), triage: bool = triage, profile: str = default_profile):
+        settings = resolve_profile(profile)
+        try:
+            tasks = iter_upload_tasks((upload.filename, upload.file) for upload in files)
+            file_results, errors = pool.process_batch(tasks, triage=triage, settings=settings)
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid archive: {e}")
+        return build_batch_response(file_results, errors)
+
+    return app
+
+def build_excel_payload(final_summary, skipped_table, error_table=None):
+    """File dimension_summary.xlsx: sheet Results (+ Skipped, Errors nếu có)"""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        final_summary.to_excel(writer, sheet_name='Results', index=False)
+        if not skipped_table.empty:
+            skipped_table.to_excel(writer, sheet_name='Skipped', index=False)
+        if error_table is not None and not error_table.empty:
+            error_table.to_excel(writer, sheet_name='Errors', index=False)
+    return output.getvalue()
+
+def serve_http(host, port, workers=None, triage=False, timeout=FILE_TIMEOUT_SECONDS,
+               memory_limit_mb=FILE_MEMORY_LIMIT_MB, profiles=None, default_profile="default", stage_cache=None,
+               dedup=True, backend=None, templates=False):
+    """Chạy service HTTP bằng uvicorn"""
+    try:
+        import uvicorn
+    except ImportError:
+        print("The HTTP service needs: pip install fastapi uvicorn python-multipart", file=sys.stderr)
+        return 1
+
+    # Fork worker trước khi uvicorn tạo thread
+    pool = DrawingWorkerPool(workers, timeout=timeout, memory_limit_mb=memory_limit_mb, stage_cache=stage_cache,
+                             dedup=dedup, backend=backend, templates=templates)
+    app = create_app(pool=pool, triage=triage, profiles=profiles, default_profile=default_profile)
+    uvicorn.run(app, host=host, port=port)
+    return 0
+
+# =============================================================================
+# WATCH FOLDER - DAEMON XỬ LÝ FILE MỚI/THAY ĐỔI, LƯU VÀO SQLITE
+# =============================================================================
+
+WATCH_SETTLE_SECONDS = 1.0  # Chờ file ngừng thay đổi (đang copy) trước khi xử lý
+
+class FileState(NamedTuple):
+    sha256: str
+    mtime_ns: int
+    size: int
+
+class SummaryStore:
+    """
+    *** MỚI: Kho tóm tắt cuốn chiếu (SQLite) ***
+    - files: trạng thái mới nhất của từng file (hash, mtime, size, status)
+    - summaries: mỗi lần xử lý 1 phiên bản file thêm 1 dòng (cùng cột với dimension_summary.xlsx)
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        summary_columns = ", ".join(f'"{column}" TEXT' for column in SUMMARY_COLUMNS)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, sha256 TEXT, mtime_ns INTEGER, size INTEGER, "
+                "status TEXT, detail TEXT, processed_at TEXT)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                f"id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, sha256 TEXT, processed_at TEXT, {summary_columns})"
+            )
+
+    def get_file_state(self, path):
+        row = self.connection.execute(
+            "SELECT sha256, mtime_ns, size FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        return FileState(*row) if row else None
+
+    def update_file_stat(self, path, mtime_ns, size):
+        """Nội dung không đổi (chỉ đổi mtime) → chỉ cập nhật stat"""
+        with self.connection:
+            self.connection.execute(
+                "UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?", (mtime_ns, size, path)
+            )
+
+    def record_result(self, path, state, summaries, skipped_reason="", error=""):
+        """Lưu kết quả 1 file: status = failed / skipped / no_dimensions / ok"""
+        processed_at = datetime.datetime.now().isoformat(timespec='seconds')
+        if error:
+            status, detail = 'failed', error
+        elif skipped_reason:
+            status, detail = 'skipped', skipped_reason
+        elif not summaries:
+            status, detail = 'no_dimensions', ""
+        else:
+            status, detail = 'ok', ""
+
+        placeholders = ", ".join("?" * (3 + len(SUMMARY_COLUMNS)))
+        column_names = ", ".join(f'"{column}"' for column in SUMMARY_COLUMNS)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (path, sha256, mtime_ns, size, status, detail, processed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, state.sha256, state.mtime_ns, state.size, status, detail, processed_at)
+            )
+            self.connection.executemany(
+                f"INSERT INTO summaries (path, sha256, processed_at, {column_names}) VALUES ({placeholders})",
+                [(path, state.sha256, processed_at, *summary.to_row()) for summary in summaries]
+            )
+        return status
+
+    def close(self):
+        self.connection.close()
+
+def scan_pdf_files(folder):
+    """Tất cả file PDF trong thư mục (đệ quy) → {path: (mtime_ns, size)}"""
+    snapshot = {}
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if name.lower().endswith('.pdf'):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def start_folder_observer(folder, changed_paths):
+    """
+    Theo dõi thư mục bằng watchdog (inotify trên Linux), đẩy đường dẫn PDF thay đổi vào queue
+
+    Returns:
+        Observer đang chạy, hoặc None nếu chưa cài watchdog (→ dùng polling)
+    """
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class PdfChangeHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            for path in (event.src_path, getattr(event, 'dest_path', '')):
+                if path and path.lower().endswith('.pdf'):
+                    changed_paths.put(path)
+
+    observer = Observer()
+    observer.schedule(PdfChangeHandler(), folder, recursive=True)
+    observer.start()
+    return observer
+
+def iter_changed_file_tasks(paths, store, task_states, prefetch=PREFETCH_FILES):
+    """
+    Các task (filename, pdf_bytes) cho file mới/thay đổi; bỏ qua file cùng nội dung (SHA-256) với lần xử lý trước.
+    task_states nhận (path, FileState) theo đúng thứ tự task.
+    *** CẬP NHẬT: Đọc và băm trước `prefetch` file trên thread nền (prefetch_reads), store chỉ dùng ở thread gọi ***
+    """
+    def changed_paths():
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # File đã bị xóa/di chuyển
+
+            previous = store.get_file_state(path)
+            if previous is not None and (previous.mtime_ns, previous.size) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            yield path, stat, previous
+
+    def read_and_hash(item):
+        with open(item[0], 'rb') as f:
+            pdf_bytes = f.read()
+        return pdf_bytes, hashlib.sha256(pdf_bytes).hexdigest()
+
+    for (path, stat, previous), future in prefetch_reads(changed_paths(), read_and_hash, prefetch):
+        try:
+            pdf_bytes, digest = future.result()
+        except OSError:
+            continue
+
+        if previous is not None and previous.sha256 == digest:
+            store.update_file_stat(path, stat.st_mtime_ns, stat.st_size)
+            continue
+
+        task_states.append((path, FileState(digest, stat.st_mtime_ns, stat.st_size)))
+        yield os.path.basename(path), pdf_bytes
+
+def process_changed_files(paths, store, pool, triage=False, settings=None, prefetch=PREFETCH_FILES):
+    """Xử lý các file thay đổi trên worker pool và lưu kết quả từng file vào store, trả về các FileResult"""
+    task_states = []
+    file_results = []
+    tasks = iter_changed_file_tasks(paths, store, task_states, prefetch)
+    for index, filename, result, error, _ in pool.imap_unordered(tasks, triage=triage, settings=settings):
+        if result is not None:
+            file_results.append(result)
+        path, state = task_states[index]
+        summaries = build_dimension_summaries([result]) if result is not None else []
+        skipped_reason = result.skipped_reason if result is not None else ""
+        status = store.record_result(path, state, summaries, skipped_reason=skipped_reason, error=error)
+        print(f"{datetime.datetime.now():%H:%M:%S} {status:<13} {path}" + (f" - {error}" if error else ""),
+              file=sys.stderr)
+    return file_results
+
+def watch_folder(folder, store_path, workers=None, triage=False, interval=2.0, polling=False, once=False,
+                 timeout=FILE_TIMEOUT_SECONDS, memory_limit_mb=FILE_MEMORY_LIMIT_MB, settings=None, stage_cache=None,
+                 dedup=True, backend=None, prefetch=PREFETCH_FILES, analytics=None, template="default",
+                 metrics_path=None, templates=False):
+    """
+    *** MỚI: Daemon theo dõi thư mục, xử lý PDF mới/thay đổi (không cần Streamlit) ***
+
+    Args:
+        interval (float): Chu kỳ quét khi polling / thời gian chờ sự kiện tối đa
+        polling (bool): Bắt buộc quét định kỳ (ví dụ thư mục mạng không hỗ trợ inotify)
+        once (bool): Xử lý các file hiện có rồi thoát
+        analytics (AnalyticsStore): Mỗi lượt xử lý ghi thêm BẢNG PHỤ vào dataset Parquet (partition template)
+        metrics_path (str): Textfile cho node_exporter, ghi lại METRICS mỗi METRICS_TEXTFILE_INTERVAL giây
+    """
+    store = SummaryStore(store_path)
+    pool = DrawingWorkerPool(workers, timeout=timeout, memory_limit_mb=memory_limit_mb, stage_cache=stage_cache,
+                             dedup=dedup, backend=backend, templates=templates)
+    changed_paths = queue.Queue()
+    observer = None if (polling or once) else start_folder_observer(folder, changed_paths)
+    if not once:
+        mode = "inotify/watchdog" if observer is not None else f"polling every {interval:g}s"
+        print(f"Watching {folder} ({mode}), store: {store_path}", file=sys.stderr)
+
+    snapshot = scan_pdf_files(folder)
+    pending = dict.fromkeys(snapshot, 0.0)  # path → thời điểm thay đổi gần nhất
+    try:
+        with metrics_textfile(metrics_path):
+            while True:
+                ready = [path for path, changed_at in pending.items() if time.monotonic() - changed_at >= WATCH_SETTLE_SECONDS]
+                for path in ready:
+                    del pending[path]
+                if ready:
+                    file_results = process_changed_files(sorted(ready), store, pool, triage=triage, settings=settings,
+                                                         prefetch=prefetch)
+                    if analytics is not None:
+                        analytics.append_run(file_results, template)
+
+                if once:
+                    if not pending:
+                        break
+                    time.sleep(WATCH_SETTLE_SECONDS)
+                    continue
+
+                wait = WATCH_SETTLE_SECONDS if pending else interval
+                if observer is not None:
+                    try:
+                        path = changed_paths.get(timeout=wait)
+                        pending[path] = time.monotonic()
+                        while True:
+                            pending[changed_paths.get_nowait()] = time.monotonic()
+                    except queue.Empty:
+                        pass
+                else:
+                    time.sleep(wait)
+                    current = scan_pdf_files(folder)
+                    for path, stat in current.items():
+                        if snapshot.get(path) != stat:
+                            pending[path] = time.monotonic()
+                    snapshot = current
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        pool.close()
+        store.close()
+    return 0
+
+# =============================================================================
+# ANALYTICS STORE - BẢNG PHỤ CỦA MỌI LẦN CHẠY, PARQUET PARTITION + TRUY VẤN DUCKDB
+# =============================================================================
+
+ANALYTICS_DIR = os.environ.get('OKE_DRAWING_ANALYTICS', '')  # Thư mục dataset Parquet, rỗng = không lưu
+ANALYTICS_QUERY_LIMIT = 10000  # Số dòng tối đa trả về cho 1 truy vấn có sẵn
+WINNING_GROUP_COLUMNS = ["run_date", "template", "Run_ID", "File", "Group", "SCORE", "Numbers", "Has_HV_Mix",
+                         "GRAIN_Orientation"]
+
+def _import_analytics():
+    try:
+        import duckdb
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("The analytics store needs: pip install duckdb pyarrow") from e
+    return duckdb, pyarrow
+
+def concat_secondary_tables(file_results):
+    """BẢNG PHỤ của tất cả file trong 1 lần chạy (DataFrame rỗng nếu không có)"""
+    secondary_frames = [result.secondary for result in file_results if result.secondary is not None]
+    return pd.concat(secondary_frames, ignore_index=True) if secondary_frames else pd.DataFrame()
+
+def winning_group_flags(secondary):
+    """Số thuộc nhóm được chọn để suy ra kích thước (select_winning_group) trong BẢNG PHỤ của 1 file → True"""
+    winner = select_winning_group(grouped_numbers_from_frame(secondary))
+    if winner is None:
+        return pd.Series(False, index=secondary.index, dtype=bool)
+    return secondary['Group'].eq(winner)
+
+def analytics_secondary_table(file_results):
+    """
+    *** MỚI: BẢNG PHỤ của 1 lần chạy + cột Winning_Group ***
+    Winning_Group tính riêng trên BẢNG PHỤ của từng FileResult rồi mới ghép → không dựa vào giá trị cột File
+    """
+    frames = []
+    for result in file_results:
+        if result.secondary is None or result.secondary.empty:
+            continue
+        if 'File' not in result.secondary.columns:
+            raise ValueError(f"Secondary table of {result.filename} has no File column")
+        frame = result.secondary.copy()
+        frame['Winning_Group'] = winning_group_flags(result.secondary)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def partition_value(value):
+    """Giá trị dùng được trong tên thư mục partition (run_date=.../template=...)"""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(value)) or "_"
+
+class AnalyticsStore:
+    """
+    *** MỚI: Lưu BẢNG PHỤ (số, font, hướng, vị trí, 8 chỉ số, Group, SCORE, GRAIN) của mọi lần chạy ***
+    - Mỗi lần chạy ghi 1 file Parquet: <path>/run_date=YYYY-MM-DD/template=<profile>/<Run_ID>.parquet
+    - Truy vấn bằng DuckDB trực tiếp trên Parquet: lọc theo partition bỏ qua cả thư mục, chỉ đọc các cột cần,
+      chỉ kết quả được chuyển thành DataFrame
+    - Thêm cột Run_ID, Run_Time và Winning_Group (số thuộc nhóm dùng cho Length/Width/Height)
+    """
+
+    def __init__(self, path):
+        self.duckdb, self.pyarrow = _import_analytics()
+        self.path = path
+
+    def append_run(self, file_results, template="default", run_time=None):
+        """Ghi BẢNG PHỤ của các FileResult trong 1 lần chạy, trả về số dòng đã ghi"""
+        frame = analytics_secondary_table(file_results)
+        if frame.empty:
+            return 0
+        run_time = run_time or datetime.datetime.now()
+        run_id = f"{run_time:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        frame.insert(0, 'Run_ID', run_id)
+        frame.insert(1, 'Run_Time', pd.Timestamp(run_time))
+
+        directory = os.path.join(self.path, f"run_date={run_time:%Y-%m-%d}", f"template={partition_value(template)}")
+        os.makedirs(directory, exist_ok=True)
+        table = self.pyarrow.Table.from_pandas(frame, preserve_index=False)
+        # Ghi ra file tạm rồi đổi tên → truy vấn đang chạy không thấy file ghi dở
+        with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.tmp', delete=False) as f:
+            self.pyarrow.parquet.write_table(table, f, compression='zstd')
+        os.replace(f.name, os.path.join(directory, f"{run_id}.parquet"))
+        return len(frame)
+
+    def _pattern(self):
+        return os.path.join(self.path, '**', '*.parquet')
+
+    def has_runs(self):
+        return next(glob.iglob(self._pattern(), recursive=True), None) is not None
+
+    def query(self, sql, params=None):
+        """
+        Chạy SQL trên view `numbers` (mọi lần chạy; cột partition run_date, template), trả về DataFrame kết quả
+        """
+        if not self.has_runs():
+            return pd.DataFrame()
+        pattern = self._pattern().replace("'", "''")
+        with self.duckdb.connect() as connection:
+            connection.execute(
+                f"CREATE VIEW numbers AS SELECT * FROM read_parquet('{pattern}', hive_partitioning = true, "
+                f"union_by_name = true, hive_types = {{'run_date': DATE, 'template': VARCHAR}})")
+            return connection.execute(sql, params or []).df()
+
+    def templates(self):
+        """Các template (partition) đã có dữ liệu"""
+        if not self.has_runs():
+            return []
+        return self.query("SELECT DISTINCT template FROM numbers ORDER BY template")['template'].tolist()
+
+    def winning_groups(self, has_hv_mix=None, has_grain=None, template=None, since=None, until=None,
+                       limit=ANALYTICS_QUERY_LIMIT):
+        """
+        Nhóm thắng của từng file trong từng lần chạy, lọc theo đặc điểm của nhóm
+        Ví dụ: has_hv_mix=True, has_grain=False → các file có nhóm thắng trộn số ngang/dọc và không tìm thấy GRAIN
+
+        Args:
+            has_hv_mix, has_grain (bool): None = không lọc
+            template (str): Chỉ 1 template
+            since, until (datetime.date): Khoảng ngày chạy (partition run_date)
+        """
+        if not self.has_runs():
+            return pd.DataFrame(columns=WINNING_GROUP_COLUMNS)
+        conditions, params = ["Winning_Group"], []
+        if template:
+            conditions.append("template = ?")
+            params.append(partition_value(template))
+        if since:
+            conditions.append("run_date >= ?")
+            params.append(since)
+        if until:
+            conditions.append("run_date <= ?")
+            params.append(until)
+        having = []
+        if has_hv_mix is not None:
+            having.append("bool_or(Has_HV_Mix) = ?")
+            params.append(bool(has_hv_mix))
+        if has_grain is not None:
+            having.append("bool_or(coalesce(GRAIN_Orientation, '') <> '') = ?")
+            params.append(bool(has_grain))
+        sql = (
+            'SELECT run_date, template, Run_ID, File, "Group", max(SCORE) AS SCORE, count(*) AS Numbers, '
+            "bool_or(Has_HV_Mix) AS Has_HV_Mix, max(coalesce(GRAIN_Orientation, '')) AS GRAIN_Orientation "
+            f"FROM numbers WHERE {' AND '.join(conditions)} "
+            'GROUP BY run_date, template, Run_ID, File, "Group" '
+            + (f"HAVING {' AND '.join(having)} " if having else "")
+            + f"ORDER BY run_date DESC, Run_ID DESC, File LIMIT {int(limit)}"
+        )
+        return self.query(sql, params)
+
+    def file_numbers(self, run_id, filename):
+        """Toàn bộ BẢNG PHỤ của 1 file trong 1 lần chạy"""
+        return self.query("SELECT * EXCLUDE (Run_ID, Run_Time) FROM numbers WHERE Run_ID = ? AND File = ? "
+                          'ORDER BY "Index"', [run_id, filename])
+
+def open_analytics_store(path=ANALYTICS_DIR):
+    """AnalyticsStore tại path, None nếu không cấu hình"""
+    return AnalyticsStore(path) if path else None
+
+# =============================================================================
+# STREAMLIT APP MAIN - SIMPLIFIED VERSION WITH OPENPYXL - MỞ RỘNG KHU VỰC HIỂN THỊ
+# =============================================================================
+
+RESULTS_STATE_KEY = 'stored_results'  # Khóa trong st.session_state giữ kết quả lô gần nhất
+SESSION_ID_KEY = 'pool_session'  # Khóa trong st.session_state định danh phiên khi chia worker dùng chung
+UPLOAD_DIGESTS_KEY = 'upload_digests'  # Khóa trong st.session_state: file_id của file upload → SHA-256 nội dung
+
+@st.cache_resource
+def shared_worker_pool():
+    """
+    *** MỚI: Worker pool dùng chung cho mọi phiên của server Streamlit ***
+    Fork worker 1 lần cho cả server (không phải mỗi lần bấm nút); các phiên chia worker lần lượt (FairWorkerQueue)
+    """
+    return DrawingWorkerPool(timeout=FILE_TIMEOUT_SECONDS, memory_limit_mb=FILE_MEMORY_LIMIT_MB,
+                             stage_cache=open_stage_cache())
+
+def format_duration(seconds):
+    """Thời gian dạng ~1h 5m / ~3m 20s / ~45s"""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"~{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"~{seconds // 60}m {seconds % 60}s"
+    return f"~{seconds}s"
+
+def format_queue_status(status):
+    """Dòng trạng thái của lô trong pool dùng chung: thứ tự chờ, số phiên cùng chạy, ETA"""
+    eta = format_duration(status.eta)
+    if status.position:
+        return (f"Queued: position {status.position} among {status.sessions} batch(es) sharing "
+                f"{status.workers} worker(s) · ETA {eta}")
+    others = status.sessions - 1
+    shared = f", shared with {others} other batch(es)" if others > 0 else ""
+    return f"Running on {status.workers} worker(s){shared} · ETA {eta}"
+
+@dataclass
+class StoredResults:
+    """
+    *** MỚI: Kết quả 1 lần xử lý, giữ trong st.session_state để rerun (download, lọc, sắp xếp) không phải tính lại ***
+    """
+    key: str  # results_state_key() của lô upload đã xử lý
+    summary: pd.DataFrame  # Bảng chính (SUMMARY_COLUMNS), rỗng nếu không có dữ liệu
+    skipped: pd.DataFrame
+    errors: pd.DataFrame
+    secondary: pd.DataFrame  # BẢNG PHỤ của tất cả file, đã phân nhóm và chấm điểm
+    excel: bytes = None  # File Excel dựng sẵn, None khi không có dữ liệu
+
+def upload_digest(uploaded_file, digest_cache=None):
+    """SHA-256 nội dung 1 file upload; digest_cache (file_id → digest) → chỉ hash file mới upload"""
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if digest_cache is None or file_id is None:
+        return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    digest = digest_cache.get(file_id)
+    if digest is None:
+        digest = digest_cache[file_id] = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    return digest
+
+def results_state_key(uploaded_files, triage=False, settings=None, digest_cache=None):
+    """
+    Khóa của 1 lô upload = tập digest nội dung các file (không phụ thuộc thứ tự) + chế độ triage + bộ ngưỡng
+    digest_cache: digest đã tính ở các lần rerun trước (dict trong st.session_state) → mỗi rerun (lọc, tải file)
+    không phải hash lại cả lô; file đã bỏ khỏi lô được xoá khỏi cache
+    """
+    digests = sorted(upload_digest(uploaded_file, digest_cache) for uploaded_file in uploaded_files)
+    if digest_cache is not None:
+        current_ids = {getattr(uploaded_file, 'file_id', None) for uploaded_file in uploaded_files}
+        for file_id in [file_id for file_id in digest_cache if file_id not in current_ids]:
+            del digest_cache[file_id]
+    digest = hashlib.sha256(f"{int(bool(triage))}\0{(settings or DEFAULT_SETTINGS).fingerprint()}\0".encode('utf-8'))
+    for file_digest in digests:
+        digest.update(file_digest.encode('ascii'))
+    return digest.hexdigest()
+
+def build_stored_results(key, file_results, errors):
+    """Tóm tắt, bảng phụ và file Excel của 1 lô - chỉ chạy 1 lần sau khi xử lý xong"""
+    summary_results = build_dimension_summaries(file_results)
+    summary = summaries_to_frame(summary_results) if summary_results else pd.DataFrame(columns=SUMMARY_COLUMNS)
+    skipped_table = build_skipped_table(file_results)
+    error_table = build_error_table(errors)
+    secondary = concat_secondary_tables(file_results)
+    excel = build_excel_payload(summary, skipped_table, error_table) if summary_results else None
+    return StoredResults(key=key, summary=summary, skipped=skipped_table, errors=error_table,
+                         secondary=secondary, excel=excel)
+
+def filter_summary(summary, query="", sort_column=None, descending=False):
+    """
+    *** MỚI: Lọc (chuỗi con, không phân biệt hoa thường, trên mọi cột) và sắp xếp bảng kết quả ***
+    Cột kích thước là chuỗi số → sắp xếp theo giá trị số khi cả cột đọc được thành số.
+    """
+    view = summary
+    query = query.strip().lower()
+    if query:
+        mask = pd.Series(False, index=view.index)
+        for column in view.columns:
+            mask |= view[column].astype(str).str.lower().str.contains(query, regex=False)
+        view = view[mask]
+
+    if sort_column in view.columns:
+        if pd.to_numeric(view[sort_column], errors='coerce').notna().all():
+            sort_key = lambda column: pd.to_numeric(column, errors='coerce')
+        else:
+            sort_key = lambda column: column.astype(str)
+        view = view.sort_values(sort_column, ascending=not descending, kind='stable', key=sort_key)
+    return view
+
+def show_results(stored):
+    """
+    *** MỚI: Hiển thị kết quả đã lưu - chỉ lọc/sắp xếp DataFrame có sẵn, không chạy lại pipeline ***
+    """
+    if stored.summary.empty:
+        st.warning("No data to display")
+        
+        # Display empty table with expanded view
+        with st.container():
+            st.dataframe(
+                stored.summary, 
+                use_container_width=True,
+                height=400
+            )
+        
+        show_skipped_table(stored.skipped)
+        show_error_table(stored.errors)
+        return
+    
+    # *** CHỈ HIỂN THỊ BẢNG CHÍNH VỚI KHU VỰC MỞ RỘNG ***
+    st.markdown("---")
+    st.markdown("## 📊 Results")
+    
+    filter_col, sort_col, order_col = st.columns([3, 2, 1])
+    query = filter_col.text_input("Filter", placeholder="Drawing#, laminate, foil...", key="results_filter")
+    sort_column = sort_col.selectbox("Sort by", ["(none)"] + list(stored.summary.columns), key="results_sort")
+    descending = order_col.checkbox("Descending", key="results_descending")
+    view = filter_summary(stored.summary, query, sort_column, descending)
+    if len(view) != len(stored.summary):
+        st.caption(f"Showing {len(view)} of {len(stored.summary)} row(s)")
+    
+    # *** SỬ DỤNG CONTAINER ĐỂ MỞ RỘNG HIỂN THỊ ***
+    with st.container():
+        st.dataframe(
+            view, 
+            use_container_width=True,
+            height=400  # Thiết lập chiều cao cố định
+        )
+    
+    # *** MỚI: Danh sách file đã bỏ qua trong chế độ triage ***
+    show_skipped_table(stored.skipped)
+    show_error_table(stored.errors)
+    
+    if not stored.secondary.empty:
+        with st.expander(f"Secondary table ({len(stored.secondary)} numbers)"):
+            st.dataframe(stored.secondary, use_container_width=True)
+    
+    # *** DOWNLOAD BUTTON CHO EXCEL - FILE DỰNG SẴN, BẤM TẢI KHÔNG PHẢI TÍNH LẠI ***
+    st.markdown("---")
+    
+    st.download_button(
+        label="📋 Download Excel",
+        data=stored.excel,
+        file_name="dimension_summary.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+def show_skipped_table(skipped_table):
+    """Hiển thị các file bị bỏ qua và lý do"""
+    if skipped_table.empty:
+        return
+
+    st.markdown(f"### ⏭️ Skipped ({len(skipped_table)})")
+    st.dataframe(skipped_table, use_container_width=True)
+
+def show_error_table(error_table):
+    """Hiển thị các file lỗi/quá thời gian/vượt bộ nhớ và lý do"""
+    if error_table.empty:
+        return
+
+    st.markdown(f"### ❌ Errors ({len(error_table)})")
+    st.dataframe(error_table, use_container_width=True)
+
+TRISTATE_OPTIONS = {"Any": None, "Yes": True, "No": False}
+
+def show_analytics_page(store):
+    """
+    *** MỚI: Trang tra cứu BẢNG PHỤ của các lần chạy trước (AnalyticsStore) - điều tra file đọc sai ***
+    """
+    st.markdown("## 🔎 Number analytics")
+    if not store.has_runs():
+        st.info("No runs stored yet. Processed batches are added automatically.")
+        return
+
+    template_col, hv_col, grain_col, since_col = st.columns(4)
+    template = template_col.selectbox("Template", ["(all)"] + store.templates())
+    has_hv_mix = hv_col.selectbox("Winning group has H/V mix", list(TRISTATE_OPTIONS))
+    has_grain = grain_col.selectbox("Winning group has GRAIN", list(TRISTATE_OPTIONS))
+    since = since_col.date_input("Since", value=None)
+
+    started = time.perf_counter()
+    groups = store.winning_groups(has_hv_mix=TRISTATE_OPTIONS[has_hv_mix], has_grain=TRISTATE_OPTIONS[has_grain],
+                                  template=None if template == "(all)" else template, since=since)
+    st.caption(f"{len(groups)} file(s) · {time.perf_counter() - started:.2f}s"
+               + (f" (first {ANALYTICS_QUERY_LIMIT} shown)" if len(groups) >= ANALYTICS_QUERY_LIMIT else ""))
+    st.dataframe(groups, use_container_width=True, height=400)
+
+    if not groups.empty:
+        choices = list(zip(groups['Run_ID'], groups['File']))
+        run_id, filename = st.selectbox("Numbers of", choices, format_func=lambda choice: f"{choice[1]} ({choice[0]})")
+        st.dataframe(store.file_numbers(run_id, filename), use_container_width=True)
+
+def main():
+    # *** MỞ RỘNG KHU VỰC HIỂN THỊ ***
+    st.set_page_config(
+        page_title="PDF Number Extraction Tool",
+        page_icon="🔍",
+        layout="wide",  # Sử dụng wide layout
+        initial_sidebar_state="collapsed"
+    )
+    
+    st.title("🔍 PDF Number Extraction Tool")
+    st.markdown("---")
+    
+    # *** MỚI: Trang tra cứu các lần chạy trước khi có cấu hình OKE_DRAWING_ANALYTICS ***
+    analytics = None
+    if ANALYTICS_DIR:
+        try:
+            analytics = open_analytics_store()
+        except RuntimeError as e:
+            st.warning(f"Analytics store disabled: {e}")
+    if analytics is not None and st.sidebar.radio("Page", ["Extract", "Analytics"]) == "Analytics":
+        show_analytics_page(analytics)
+        return
+    
+    # Upload files
+    # *** CẬP NHẬT: Nhận thêm archive zip/tar chứa nhiều bản vẽ ***
+    uploaded_files = st.file_uploader(
+        "Upload PDF files or ZIP/TAR archives", 
+        type=UPLOAD_TYPES, 
+        accept_multiple_files=True,
+        help="Select PDF files, or archives (.zip, .tar, .tar.gz) containing PDF drawings"
+    )
+    
+    if uploaded_files:
+        st.success(f"Uploaded {len(uploaded_files)} file(s)")
+        
+        # *** MỚI: Chế độ triage - bỏ qua sớm trang bìa/BOM/revision không có kích thước ***
+        triage_mode = st.checkbox(
+            "⚡ Skip non-dimension pages",
+            value=False,
+            help="Quickly skip pages that cannot produce a dimension group of 3 or more numbers"
+        )
+        
+        # *** MỚI: Chọn profile ngưỡng theo mẫu bản vẽ (file OKE_DRAWING_SETTINGS) ***
+        try:
+            settings_profiles = load_settings_profiles(SETTINGS_FILE)
+        except (OSError, ValueError) as e:
+            st.error(f"Cannot load settings profiles: {e}")
+            settings_profiles = load_settings_profiles()
+        profile_name = "default"
+        if len(settings_profiles) > 1:
+            profile_name = st.selectbox("Settings profile", list(settings_profiles))
+        settings = settings_profiles[profile_name]
+        
+        # *** MỚI: Kết quả lưu trong session_state theo digest các file upload → rerun chỉ hiển thị lại ***
+        results_key = results_state_key(uploaded_files, triage_mode, settings,
+                                        st.session_state.setdefault(UPLOAD_DIGESTS_KEY, {}))
+        stored = st.session_state.get(RESULTS_STATE_KEY)
+        if stored is not None and stored.key != results_key:
+            stored = None
+        
+        if st.button("🚀 Process Files", type="primary") and stored is None:
+            # Progress bar
+            progress_bar = st.progress(0)
+            status_text = st.empty()
+            queue_text = st.empty()
             
-            # Clear progress
-            progress_bar.empty()
-            status_text.empty()
+            # *** CẬP NHẬT: XỬ LÝ SONG SONG TRÊN WORKER POOL, ARCHIVE ĐƯỢC GIẢI NÉN LẦN LƯỢT ***
+            total_files = sum(
+                count_archive_pdfs(uploaded_file, uploaded_file.name) if is_archive_name(uploaded_file.name) else 1
+                for uploaded_file in uploaded_files
+            )
             
-            # TẠO DATAFRAMES TỔNG HỢP
-            df_all = pd.DataFrame(main_table_results).reset_index(drop=True)
-            df_all_numbers = pd.DataFrame(secondary_table_results).reset_index(drop=True)
+            # *** CẬP NHẬT: Tiến độ theo chi phí ước lượng (file lớn chiếm nhiều hơn), không theo số file ***
+            def show_progress(done, filename, error, fraction):
+                progress_bar.progress(fraction)
+                status_text.text(f"Processed {done}/{total_files}: {filename}")
             
-            # XỬ LÝ VÀ HIỂN THỊ KẾT QUẢ
-            if not df_all.empty:
-                df_final = df_all.copy()
-                df_final = df_final.drop(columns=["Index"])
-                
-                # Tạo bảng tóm tắt cho từng file
-                summary_results = []
-                for file_group in df_final.groupby("File"):
-                    filename, file_data = file_group
-                    
-                    # Lấy df_all_numbers cho file này
-                    file_all_numbers = df_all_numbers[df_all_numbers['File'] == filename] if not df_all_numbers.empty else pd.DataFrame()
-                    
-                    summary = create_dimension_summary_with_score_priority(file_data, file_all_numbers)
-                    summary_results.append(summary)
-                
-                # Kết hợp tất cả kết quả
-                final_summary = pd.concat(summary_results, ignore_index=True) if summary_results else pd.DataFrame(columns=["Drawing#", "Length (mm)", "Width (mm)", "Height (mm)", "Laminate", "FOIL", "EDGEBAND", "Profile", "Profile 2", "Profile 3"])
-                
-                # *** CHỈ HIỂN THỊ BẢNG CHÍNH VỚI KHU VỰC MỞ RỘNG ***
-                st.markdown("---")
-                st.markdown("## 📊 Results")
-                
-                # *** SỬ DỤNG CONTAINER ĐỂ MỞ RỘNG HIỂN THỊ ***
-                with st.container():
-                    st.dataframe(
-                        final_summary, 
-                        use_container_width=True,
-                        height=400  # Thiết lập chiều cao cố định
-                    )
-                
-                # *** DOWNLOAD BUTTON CHO EXCEL - SỬ DỤNG OPENPYXL ***
-                st.markdown("---")
-                
-                # Create Excel file in memory using openpyxl
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    final_summary.to_excel(writer, sheet_name='Results', index=False)
-                    
-                excel_data = output.getvalue()
-                
-                st.download_button(
-                    label="📋 Download Excel",
-                    data=excel_data,
-                    file_name="dimension_summary.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            def show_queue_status(status):
+                queue_text.caption(format_queue_status(status))
+            
+            # *** MỚI: Nhật ký tiến độ - mất kết nối/khởi động lại thì chạy lại cùng lô sẽ tiếp tục ***
+            journal = BatchJournal(journal_path_for_uploads(uploaded_files))
+            if len(journal):
+                st.info(f"Resuming: {len(journal)} file(s) already processed in a previous run")
             
+            tasks = iter_upload_tasks((uploaded_file.name, uploaded_file) for uploaded_file in uploaded_files)
+            # *** MỚI: Mỗi file chạy trong worker riêng, có giới hạn thời gian và bộ nhớ ***
+            # *** CẬP NHẬT: Pool dùng chung cả server, worker chia lần lượt giữa các phiên ***
+            if SESSION_ID_KEY not in st.session_state:
+                st.session_state[SESSION_ID_KEY] = uuid.uuid4().hex
+            pool = shared_worker_pool()
+            file_results, errors = pool.process_batch(tasks, triage=triage_mode, progress=show_progress,
+                                                      journal=journal, total=total_files, settings=settings,
+                                                      session=st.session_state[SESSION_ID_KEY],
+                                                      status=show_queue_status)
+            if errors:
+                journal.close()
             else:
-                st.warning("No data to display")
-                
-                # Display empty table with expanded view
-                empty_main = pd.DataFrame(columns=["Drawing#", "Length (mm)", "Width (mm)", "Height (mm)", "Laminate", "FOIL", "EDGEBAND", "Profile", "Profile 2", "Profile 3"])
-                with st.container():
-                    st.dataframe(
-                        empty_main, 
-                        use_container_width=True,
-                        height=400
-                    )
+                journal.remove()
+            
+            # Clear progress
+            progress_bar.empty()
+            status_text.empty()
+            queue_text.empty()
+            
+            # XỬ LÝ KẾT QUẢ - CHỈ 1 LẦN CHO MỖI LÔ UPLOAD
+            # *** CẬP NHẬT: Tóm tắt từng file trên record thuần, chỉ tạo DataFrame 1 lần ở cuối ***
+            stored = build_stored_results(results_key, file_results, errors)
+            st.session_state[RESULTS_STATE_KEY] = stored
+            if analytics is not None:
+                analytics.append_run(file_results, profile_name)
+        
+        # HIỂN THỊ KẾT QUẢ
+        if stored is not None:
+            show_results(stored)
+
+# =============================================================================
+# CLI - CHẠY KHÔNG CẦN STREAMLIT: python "OKE Drawing.py" <command>
+# =============================================================================
+
+CLI_COMMANDS = ('serve', 'batch', 'watch', 'parity', 'analytics')
+
+def run_batch(paths, output, workers=None, triage=False, journal_path=None, timeout=FILE_TIMEOUT_SECONDS,
+              memory_limit_mb=FILE_MEMORY_LIMIT_MB, settings=None, stage_cache=None, dedup=True, backend=None,
+              prefetch=PREFETCH_FILES, analytics=None, template="default", metrics_path=None, templates=False):
+    """
+    Xử lý PDF/archive/thư mục → file Excel giống nút Download Excel trên giao diện
+    Tiến độ được ghi vào nhật ký (mặc định <output>.journal.jsonl); chạy lại lệnh sẽ tiếp tục từ chỗ dừng.
+    metrics_path → METRICS được ghi ra textfile cho node_exporter trong lúc chạy và khi xong.
+    """
+    journal = BatchJournal(journal_path or output + '.journal.jsonl')
+    if len(journal):
+        print(f"Resuming: {len(journal)} file(s) already in {journal.path}", file=sys.stderr)
+
+    def show_progress(done, filename, error, fraction):
+        print(f"[{done}] {filename}" + (f" - FAILED: {error}" if error else ""), file=sys.stderr)
+
+    with metrics_textfile(metrics_path), \
+            DrawingWorkerPool(workers, timeout=timeout, memory_limit_mb=memory_limit_mb, stage_cache=stage_cache,
+                              dedup=dedup, backend=backend, templates=templates) as pool:
+        file_results, errors = pool.process_batch(prefetch_path_tasks(paths, prefetch), triage=triage,
+                                                  progress=show_progress,
+                                                  journal=journal, settings=settings)
+        estimate_error = pool.cost_model.mean_absolute_error()
+    if estimate_error is not None:
+        print(f"Cost estimate error: {estimate_error:.2f}s per file on average", file=sys.stderr)
+
+    summary_results = build_dimension_summaries(file_results)
+    final_summary = summaries_to_frame(summary_results) if summary_results else pd.DataFrame(columns=SUMMARY_COLUMNS)
+    skipped_table = build_skipped_table(file_results)
+    with open(output, 'wb') as f:
+        f.write(build_excel_payload(final_summary, skipped_table, build_error_table(errors)))
+    if analytics is not None:
+        stored_rows = analytics.append_run(file_results, template)
+        print(f"Added {stored_rows} number(s) to the analytics store {analytics.path}", file=sys.stderr)
+
+    # Còn file lỗi → giữ nhật ký để lần chạy sau chỉ thử lại các file đó
+    if errors:
+        journal.close()
+    else:
+        journal.remove()
+
+    reused = sum(1 for result in file_results if result.duplicate_of)
+    print(f"Wrote {len(final_summary)} row(s) to {output} "
+          f"({len(skipped_table)} skipped, {len(errors)} failed, {reused} reused from re-exported drawings)",
+          file=sys.stderr)
+    return 1 if errors else 0
+
+def run_parity(paths, backends, tolerance=PARITY_TOLERANCE, settings=None):
+    """In các trường 2 backend cho kết quả khác nhau trên bộ PDF mẫu; có khác biệt → mã thoát 1"""
+    differences = compare_pdf_backends(iter_path_tasks(paths), backends, tolerance, settings)
+    if differences.empty:
+        print(f"{backends[0]} and {backends[1]} agree on every file", file=sys.stderr)
+        return 0
+    print(differences.to_string(index=False, max_colwidth=80))
+    print(f"{differences['File'].nunique()} file(s) differ between {backends[0]} and {backends[1]}", file=sys.stderr)
+    return 1
+
+def run_analytics(store, args):
+    """In nhóm thắng theo bộ lọc, hoặc kết quả 1 câu SQL trên view `numbers`"""
+    if args.sql:
+        result = store.query(args.sql)
+    else:
+        result = store.winning_groups(has_hv_mix=args.hv_mix, has_grain=args.grain, template=args.template,
+                                      since=args.since, until=args.until, limit=args.limit)
+    print(result.to_string(index=False, max_colwidth=60) if not result.empty else "No matching rows")
+    return 0
+
+def run_cli(argv):
+    """Các lệnh chạy không cần giao diện Streamlit"""
+    parser = argparse.ArgumentParser(prog='OKE Drawing.py', description="PDF Number Extraction Tool")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Tùy chọn chung cho các lệnh dùng worker pool
+    pool_options = argparse.ArgumentParser(add_help=False)
+    pool_options.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    pool_options.add_argument('--triage', action='store_true', help="Skip non-dimension pages")
+    pool_options.add_argument('--timeout', type=float, default=FILE_TIMEOUT_SECONDS,
+                              help=f"Per-file time limit in seconds, 0 = none (default: {FILE_TIMEOUT_SECONDS})")
+    pool_options.add_argument('--memory-limit', type=int, default=FILE_MEMORY_LIMIT_MB,
+                              help=f"Per-worker memory limit in MB, 0 = none (default: {FILE_MEMORY_LIMIT_MB})")
+    pool_options.add_argument('--settings', default=SETTINGS_FILE,
+                              help="JSON file of threshold profiles (default: $OKE_DRAWING_SETTINGS)")
+    pool_options.add_argument('--profile', default='default', help="Threshold profile to use (default: default)")
+    pool_options.add_argument('--stage-cache', default=STAGE_CACHE_DIR,
+                              help="Directory caching per-stage results so threshold changes only rerun later stages "
+                                   "(default: $OKE_DRAWING_STAGE_CACHE)")
+    pool_options.add_argument('--no-dedup', dest='dedup', action='store_false',
+                              help="Process re-exported copies of the same drawing instead of reusing the first result")
+    pool_options.add_argument('--backend', choices=sorted(PDF_BACKENDS), default=PDF_BACKEND,
+                              help=f"Library reading the PDF (default: $OKE_DRAWING_PDF_BACKEND or {PDF_BACKEND})")
+    pool_options.add_argument('--template-cache', dest='templates', action='store_true',
+                              help="Learn each CAD template's dimension font and note region from its first files, "
+                                   "then reuse them for later files of the same template")
+
+    # Đọc trước file từ ổ đĩa/ổ mạng cho các lệnh đọc file (batch, watch)
+    prefetch_options = argparse.ArgumentParser(add_help=False)
+    prefetch_options.add_argument('--prefetch', type=int, default=PREFETCH_FILES,
+                                  help=f"Files read ahead while workers parse, for slow or network storage "
+                                       f"(default: $OKE_DRAWING_PREFETCH or {PREFETCH_FILES})")
+    prefetch_options.add_argument('--analytics', default=ANALYTICS_DIR,
+                                  help="Parquet dataset receiving the secondary table of every run "
+                                       "(default: $OKE_DRAWING_ANALYTICS)")
+    prefetch_options.add_argument('--metrics-textfile', default=METRICS_TEXTFILE,
+                                  help=f"Prometheus textfile (.prom) for the node_exporter textfile collector, "
+                                       f"rewritten every {METRICS_TEXTFILE_INTERVAL:g}s "
+                                       f"(default: $OKE_DRAWING_METRICS_TEXTFILE)")
+
+    serve_parser = subparsers.add_parser('serve', parents=[pool_options], help="Run the HTTP extraction service")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+
+    batch_parser = subparsers.add_parser('batch', parents=[pool_options, prefetch_options], help="Process PDF files, ZIP/TAR archives or folders into an Excel summary")
+    batch_parser.add_argument('inputs', nargs='+', help="PDF files, archives (.zip, .tar, .tar.gz) or folders")
+    batch_parser.add_argument('-o', '--output', default='dimension_summary.xlsx')
+    batch_parser.add_argument('--journal', default=None, help="Resume journal (default: <output>.journal.jsonl)")
+
+    watch_parser = subparsers.add_parser('watch', parents=[pool_options, prefetch_options], help="Watch a folder and process new or changed PDFs")
+    watch_parser.add_argument('folder')
+    watch_parser.add_argument('--store', default='dimension_summary.sqlite', help="SQLite summary store")
+    watch_parser.add_argument('--interval', type=float, default=2.0, help="Polling interval in seconds")
+    watch_parser.add_argument('--poll', action='store_true', help="Poll instead of using inotify (network shares)")
+    watch_parser.add_argument('--once', action='store_true', help="Process the current files and exit")
+
+    parity_parser = subparsers.add_parser('parity', help="Report where two PDF backends disagree on a set of PDFs")
+    parity_parser.add_argument('inputs', nargs='+', help="PDF files, archives (.zip, .tar, .tar.gz) or folders")
+    parity_parser.add_argument('--backends', nargs=2, choices=sorted(PDF_BACKENDS), default=['pdfplumber', 'pymupdf'],
+                               metavar='BACKEND', help="Reference and candidate backend (default: pdfplumber pymupdf)")
+    parity_parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE,
+                               help=f"Allowed position/size difference in points (default: {PARITY_TOLERANCE})")
+    parity_parser.add_argument('--settings', default=SETTINGS_FILE,
+                               help="JSON file of threshold profiles (default: $OKE_DRAWING_SETTINGS)")
+    parity_parser.add_argument('--profile', default='default', help="Threshold profile to use (default: default)")
+
+    analytics_parser = subparsers.add_parser('analytics', help="Query the secondary tables of previous runs")
+    analytics_parser.add_argument('--store', default=ANALYTICS_DIR,
+                                  help="Parquet dataset (default: $OKE_DRAWING_ANALYTICS)")
+    analytics_parser.add_argument('--hv-mix', action=argparse.BooleanOptionalAction, default=None,
+                                  help="Winning group mixes horizontal and vertical numbers (or not)")
+    analytics_parser.add_argument('--grain', action=argparse.BooleanOptionalAction, default=None,
+                                  help="GRAIN was found for the winning group (or not)")
+    analytics_parser.add_argument('--template', default=None, help="Only runs with this settings profile")
+    analytics_parser.add_argument('--since', type=datetime.date.fromisoformat, default=None, help="YYYY-MM-DD")
+    analytics_parser.add_argument('--until', type=datetime.date.fromisoformat, default=None, help="YYYY-MM-DD")
+    analytics_parser.add_argument('--limit', type=int, default=ANALYTICS_QUERY_LIMIT)
+    analytics_parser.add_argument('--sql', default=None,
+                                  help="Run this SQL on the view `numbers` instead (partition columns: run_date, template)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'analytics':
+        if not args.store:
+            parser.error("no analytics store: pass --store or set OKE_DRAWING_ANALYTICS")
+        try:
+            return run_analytics(AnalyticsStore(args.store), args)
+        except RuntimeError as e:
+            parser.error(str(e))
+
+    try:
+        profiles = load_settings_profiles(args.settings)
+    except (OSError, ValueError) as e:
+        parser.error(f"cannot load settings: {e}")
+    if args.profile not in profiles:
+        parser.error(f"unknown profile '{args.profile}' (available: {', '.join(profiles)})")
+    settings = profiles[args.profile]
+    if args.command == 'parity':
+        try:
+            return run_parity(args.inputs, args.backends, args.tolerance, settings)
+        except (RuntimeError, ValueError) as e:
+            parser.error(str(e))
+    try:
+        resolve_pdf_backend(args.backend)
+    except (RuntimeError, ValueError) as e:
+        parser.error(str(e))
+    stage_cache = open_stage_cache(args.stage_cache)
+    try:
+        analytics = open_analytics_store(getattr(args, 'analytics', ''))
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    if args.command == 'serve':
+        return serve_http(args.host, args.port, workers=args.workers, triage=args.triage,
+                          timeout=args.timeout, memory_limit_mb=args.memory_limit,
+                          profiles=profiles, default_profile=args.profile, stage_cache=stage_cache,
+                          dedup=args.dedup, backend=args.backend, templates=args.templates)
+    if args.command == 'batch':
+        return run_batch(args.inputs, args.output, workers=args.workers, triage=args.triage,
+                         journal_path=args.journal, timeout=args.timeout, memory_limit_mb=args.memory_limit,
+                         settings=settings, stage_cache=stage_cache, dedup=args.dedup, backend=args.backend,
+                         prefetch=args.prefetch, analytics=analytics, template=args.profile,
+                         metrics_path=args.metrics_textfile, templates=args.templates)
+    if args.command == 'watch':
+        return watch_folder(args.folder, args.store, workers=args.workers, triage=args.triage,
+                            interval=args.interval, polling=args.poll, once=args.once,
+                            timeout=args.timeout, memory_limit_mb=args.memory_limit, settings=settings,
+                            stage_cache=stage_cache, dedup=args.dedup, backend=args.backend,
+                            prefetch=args.prefetch, analytics=analytics, template=args.profile,
+                            metrics_path=args.metrics_textfile, templates=args.templates)
+    return 2
 
 if __name__ == "__main__":
+    # streamlit run "OKE Drawing.py" → giao diện; python "OKE Drawing.py" serve ... → CLI
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(run_cli(sys.argv[1:]))
     main()
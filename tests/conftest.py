@@ -0,0 +1,36 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "OKE Drawing.py")
+
+
+@pytest.fixture(scope="session")
+def oke():
+    """Nạp "OKE Drawing.py" như 1 module (tên file có dấu cách → không import trực tiếp được)"""
+    spec = importlib.util.spec_from_file_location("oke_drawing", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["oke_drawing"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_number(oke, number, x_pos, y_pos, font_size=2.5, fontname="ABCDEF+Arial", orientation="Horizontal"):
+    """ExtractedNumber với metrics đơn giản: cùng font_size → cùng nhóm"""
+    return oke.ExtractedNumber(number=number, fontname=fontname, font_weight="Regular", orientation=orientation,
+                               x_pos=x_pos, y_pos=y_pos, chars_count=len(str(int(number))), font_size=font_size,
+                               char_width=font_size * 0.6, char_height=font_size, density_score=1.0,
+                               distance_from_origin=(x_pos ** 2 + y_pos ** 2) ** 0.5, aspect_ratio=0.6,
+                               char_spacing=0.1, text_angle=0.0)
+
+
+def make_file_result(oke, filename, dimensions, notes=(5.0, 8.0)):
+    """FileResult có BẢNG PHỤ đầy đủ (grouped → scored → grain) như run_secondary_stages tạo ra"""
+    numbers = [make_number(oke, value, 100 + 40 * i, 200) for i, value in enumerate(dimensions)]
+    numbers += [make_number(oke, value, 50, 400 + 20 * i, font_size=1.8) for i, value in enumerate(notes)]
+    frame = oke.numbers_to_frame(filename, numbers)
+    frame = oke.group_and_score_secondary_table(frame, oke.PageGlyphIndex(has_grain=False))
+    return oke.FileResult(filename=filename, main_numbers=[int(value) for value in dimensions], secondary=frame,
+                          metadata={"Profile": "P1"})
@@ -0,0 +1,26 @@
+import math
+
+import pytest
+
+from conftest import make_file_result
+
+
+def test_winning_group_is_chosen_per_file_result(oke):
+    """Winning_Group tính trên từng FileResult, kể cả khi cột File trùng hoặc trống"""
+    results = [make_file_result(oke, "A.pdf", (600.0, 400.0, 18.0)),
+               make_file_result(oke, "B.pdf", (1200.0, 300.0, 25.0, 16.0), notes=(5.0, 8.0, 3.0, 6.0, 9.0))]
+    expected = [oke.winning_group_flags(result.secondary).tolist() for result in results]
+    assert all(any(flags) for flags in expected)
+
+    for filename in ("same.pdf", math.nan):
+        for result in results:
+            result.secondary['File'] = filename
+        table = oke.analytics_secondary_table(results)
+        assert table['Winning_Group'].tolist() == expected[0] + expected[1]
+
+
+def test_secondary_table_without_file_column_is_rejected(oke):
+    result = make_file_result(oke, "A.pdf", (600.0, 400.0, 18.0))
+    result.secondary = result.secondary.drop(columns=['File'])
+    with pytest.raises(ValueError):
+        oke.analytics_secondary_table([result])
@@ -0,0 +1,64 @@
+import json
+
+import pandas as pd
+import pytest
+
+from conftest import make_file_result
+
+
+def test_resumed_result_keeps_full_secondary_table(oke, tmp_path):
+    """Kết quả đọc lại từ nhật ký có BẢNG PHỤ giống hệt lúc xử lý (File, font, vị trí, 8 chỉ số, Group, SCORE)"""
+    result = make_file_result(oke, "A.pdf", (600.0, 400.0, 18.0))
+    path = str(tmp_path / "batch.jsonl")
+    journal = oke.BatchJournal(path)
+    journal.record("a", result)
+    journal.record("empty", None)
+    journal.close()
+
+    resumed = oke.BatchJournal(path)
+    restored = resumed.load("a")
+    resumed.close()
+
+    pd.testing.assert_frame_equal(restored.secondary, result.secondary)
+    assert restored.main_numbers == result.main_numbers
+    assert restored.metadata == result.metadata
+    assert resumed.load("empty") is None
+
+
+def test_old_journal_records_are_processed_again(oke, tmp_path):
+    """Bản ghi dạng cũ (chỉ có grouped_numbers) không được dùng lại"""
+    path = tmp_path / "batch.jsonl"
+    old_record = {'filename': "A.pdf", 'main_numbers': [600], 'grouped_numbers': [[600.0, "GROUP_1", 1.0, ""]],
+                  'metadata': {}, 'skipped_reason': ""}
+    path.write_text(json.dumps({'key': "a", 'result': old_record}) + "\n", encoding='utf-8')
+
+    journal = oke.BatchJournal(str(path))
+    journal.close()
+    assert "a" not in journal
+
+
+def test_resumed_run_feeds_analytics(oke, tmp_path):
+    """Lô chạy lại hoàn toàn từ nhật ký vẫn ghi được BẢNG PHỤ vào AnalyticsStore với cùng Winning_Group"""
+    pytest.importorskip("duckdb")
+    pytest.importorskip("pyarrow")
+    results = [make_file_result(oke, "A.pdf", (600.0, 400.0, 18.0)),
+               make_file_result(oke, "B.pdf", (1200.0, 300.0, 25.0, 16.0))]
+    path = str(tmp_path / "batch.jsonl")
+    journal = oke.BatchJournal(path)
+    for key, result in enumerate(results):
+        journal.record(str(key), result)
+    journal.close()
+
+    resumed = oke.BatchJournal(path)
+    restored = [resumed.load(str(key)) for key in range(len(results))]
+    resumed.close()
+
+    expected = oke.concat_secondary_tables(results)
+    secondary = oke.concat_secondary_tables(restored)
+    pd.testing.assert_frame_equal(secondary, expected)
+
+    store = oke.AnalyticsStore(str(tmp_path / "analytics"))
+    assert store.append_run(restored, "P1") == len(expected)
+    stored = store.query('SELECT Winning_Group FROM numbers ORDER BY File, "Index"')
+    assert stored['Winning_Group'].tolist() == oke.analytics_secondary_table(results)['Winning_Group'].tolist()
+    assert stored['Winning_Group'].any()
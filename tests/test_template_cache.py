@@ -0,0 +1,70 @@
+import pytest
+
+
+class FakePage:
+    """Trang tối thiểu cho TemplateCache: chỉ có ký tự và kích thước trang"""
+
+    def __init__(self, chars, width=842, height=595):
+        self.chars = chars
+        self.width = width
+        self.height = height
+        self.bbox = (0, 0, width, height)
+
+
+def text_chars(text, fontname, x0, top, size=5.0):
+    """Ký tự nằm ngang của 1 chuỗi, cách nhau 0.6 × size"""
+    chars = []
+    for i, character in enumerate(text):
+        x = x0 + i * size * 0.6
+        chars.append({'text': character, 'fontname': fontname, 'size': size, 'x0': x, 'x1': x + size * 0.55,
+                      'top': top, 'bottom': top + size, 'doctop': top, 'upright': True,
+                      'width': size * 0.55, 'height': size, 'matrix': (1, 0, 0, 1, x, top)})
+    return chars
+
+
+def drawing_page(prefix, f3_top, f2_top, f3_numbers=("600", "400", "18"), f2_numbers=("1200", "300", "25")):
+    """Bản vẽ có số kích thước ở 2 font F2/F3 (pipeline chọn font có vị trí thấp hơn) và 1 dòng ghi chú"""
+    chars = text_chars("PROFILE: AB-12", f"{prefix}+Arial", 40, 60)
+    for i, number in enumerate(f3_numbers):
+        chars += text_chars(number, f"{prefix}+CIDFont+F3", 200 + 80 * i, f3_top)
+    for i, number in enumerate(f2_numbers):
+        chars += text_chars(number, f"{prefix}+CIDFont+F2", 200 + 80 * i, f2_top)
+    return FakePage(chars)
+
+
+def full_pipeline(oke, page, filename):
+    return oke.extract_number_stage(oke.build_char_table(page), filename, False, oke.DEFAULT_SETTINGS)
+
+
+def cached_pipeline(oke, cache, page, filename):
+    number_stage, _ = oke.extract_number_stage_with_template(page, oke.build_char_table(page), filename, False,
+                                                             oke.DEFAULT_SETTINGS, cache)
+    return number_stage
+
+
+@pytest.mark.parametrize("f3_top", [300, 450])
+def test_fast_path_matches_full_pipeline(oke, f3_top):
+    """Sau khi học template (F2 nằm thấp hơn F3), trang mới cho cùng kết quả như pipeline đầy đủ"""
+    cache = oke.TemplateCache()
+    for i, prefix in enumerate(("AAAAAA", "BBBBBB")):
+        page = drawing_page(prefix, f3_top=300, f2_top=400)
+        assert cached_pipeline(oke, cache, page, f"learn{i}.pdf").main_numbers == \
+            full_pipeline(oke, page, f"learn{i}.pdf").main_numbers
+
+    page = drawing_page("CCCCCC", f3_top, f2_top=400)
+    expected = full_pipeline(oke, page, "new.pdf")
+    assert cached_pipeline(oke, cache, page, "new.pdf").main_numbers == expected.main_numbers
+    # F3 chuyển xuống dưới F2 (F2 vẫn trong vùng đã học) → pipeline chọn F3 → không được đi đường tắt
+    assert cache.hits == (1 if f3_top < 400 else 0)
+
+
+def test_note_keywords_match_whole_words(oke):
+    """DRAWING/CLAMP/ALONG không phải RAW/LAM/LONG; dải ghi chú chỉ gồm dòng có từ khóa"""
+    chars = text_chars("DRAWING NO. 4009311", "AAAAAA+Arial", 40, 20)
+    chars += text_chars("CLAMP ALONG EDGE", "AAAAAA+Arial", 40, 100)
+    chars += text_chars("GLUEABLE LAM/RAW", "AAAAAA+Arial", 40, 300)
+    chars += text_chars("(2) LONG", "AAAAAA+Arial", 40, 320)
+
+    assert oke.note_keyword_counts(chars) == {'LAM': 1, 'RAW': 1, 'LONG': 1}
+    profile = oke.learn_template_profile(FakePage(chars), oke.build_char_table(FakePage(chars)))
+    assert profile.notes_band == (300, 325.0)